@@ -0,0 +1,142 @@
+# JSON billing API for self-checkout kiosks and offline till imports, mounted by main.py.
+#
+#   POST /api/purchases        one basket -> Receipt (201; 200 with Idempotent-Replayed: true
+#                              when its idempotency key was already used; 422 {"errors": ...})
+#   GET  /api/purchases/{id}   Receipt of a recorded purchase
+#   GET  /api/purchases?customer_email=...   a customer's history, newest first, a keyset
+#                              page at a time (?after= / ?before= cursors, ?limit=)
+#   POST /api/purchases/batch  many baskets -> BatchResult, one result per basket
+#
+#   GET  /api/reports/daily          per-day purchases, units, revenue and tax
+#   GET  /api/reports/tax            taxable amount and tax collected per rate
+#   GET  /api/reports/top_products   best sellers by revenue (?limit=10)
+#
+# Baskets go through the same checkout service (billing.py) as the billing form.
+# Reports take ?start=&end= (inclusive dates in REPORT_TIMEZONE, default the last
+# REPORT_DEFAULT_DAYS days) and read only the sales rollups (rollups.py).
+import os
+from datetime import date, timedelta
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+
+import billing, crud, crud_async, rollups, schemas
+from database import get_async_db, get_db
+
+API_BATCH_MAX_BASKETS = int(os.getenv("API_BATCH_MAX_BASKETS", "10000"))
+CUSTOMER_PURCHASES_MAX_LIMIT = 200
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_TOP_PRODUCTS = 100
+
+router = APIRouter(prefix="/api", tags=["api"])
+
+
+def _receipt(invoice: dict) -> schemas.Receipt:
+    return schemas.Receipt(
+        purchase_id=invoice["purchase_id"],
+        purchase_time=invoice["purchase_time"],
+        customer_email=invoice["customer_email"],
+        lines=[schemas.ReceiptLine(product_id=item["product_id"], product_name=item["product_name"],
+                                   quantity=item["quantity"], unit_price=item["unit_price"],
+                                   tax_percentage=item["tax_percentage"], subtotal=item["item_price_before_tax"],
+                                   tax=item["item_tax"], total=item["item_total_price"])
+               for item in invoice["detailed_items"]],
+        total_amount=invoice["total_bill_amount"],
+        tax_amount=invoice["total_tax_amount"],
+        paid_amount=invoice["paid_amount"],
+        balance_to_return=invoice["balance_to_return"],
+        change=invoice["change_breakdown"],
+        change_remainder=invoice["change_remainder"],
+    )
+
+
+@router.post("/purchases", response_model=schemas.Receipt, status_code=201,
+             responses={422: {"description": "Basket rejected; body is {\"errors\": {field: message}}"}})
+async def create_purchase(basket: schemas.BasketCreate, response: Response,
+                          idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                          db=Depends(get_async_db)):
+    if idempotency_key:
+        basket.idempotency_key = idempotency_key.strip() or None
+    try:
+        invoice, replayed = await billing.checkout(db, basket)
+    except billing.BasketRejected as e:
+        return JSONResponse(status_code=422, content={"errors": e.errors})
+    if invoice is None:
+        raise HTTPException(status_code=404, detail="Purchase not found")
+    if replayed:
+        response.status_code = 200
+        response.headers["Idempotent-Replayed"] = "true"
+    return _receipt(invoice)
+
+
+@router.get("/purchases", response_model=schemas.CustomerPurchasePage)
+async def customer_purchases(customer_email: str, after: Optional[int] = None, before: Optional[int] = None,
+                             limit: int = 20, db=Depends(get_async_db)):
+    customer = await crud_async.get_customer_by_email(db, customer_email)
+    if customer is None:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    limit = max(1, min(limit, CUSTOMER_PURCHASES_MAX_LIMIT))
+    purchases, has_more = await crud_async.get_customer_purchases(db, customer.id, after_id=after, before_id=before,
+                                                                  limit=limit)
+    totals = await crud_async.get_customer_totals(db, customer.id)
+    next_after, prev_before = crud.keyset_cursors(purchases, has_more, after, before)
+    return schemas.CustomerPurchasePage(
+        customer_email=customer.email,
+        totals=schemas.CustomerTotals(purchases=totals.purchases, total_spent=totals.total_spent, tax=totals.tax)
+        if totals else schemas.CustomerTotals(),
+        purchases=[schemas.PurchaseSummary(id=purchase.id, purchase_time=purchase.purchase_time,
+                                           total_amount=purchase.total_amount, tax_amount=purchase.tax_amount,
+                                           paid_amount=purchase.paid_amount) for purchase in purchases],
+        next_after=next_after,
+        prev_before=prev_before,
+    )
+
+
+@router.get("/purchases/{purchase_id}", response_model=schemas.Receipt)
+async def get_purchase(purchase_id: int, db=Depends(get_async_db)):
+    invoice = await billing.stored_invoice(db, purchase_id)
+    if invoice is None:
+        raise HTTPException(status_code=404, detail="Purchase not found")
+    return _receipt(invoice)
+
+
+# A plain def: the batch runs on a sync session in the worker thread pool
+@router.post("/purchases/batch", response_model=schemas.BatchResult)
+def create_purchases(batch: schemas.BasketBatch, db: Session = Depends(get_db)):
+    if len(batch.baskets) > API_BATCH_MAX_BASKETS:
+        raise HTTPException(status_code=413, detail=f"At most {API_BATCH_MAX_BASKETS} baskets per batch")
+    results = billing.record_baskets(db, batch.baskets, use_drawer=batch.use_drawer,
+                                     send_invoices=batch.send_invoices)
+    counts = {status: 0 for status in ("created", "replayed", "rejected")}
+    for result in results:
+        counts[result.status] += 1
+    return schemas.BatchResult(results=results, **counts)
+
+
+def _report_range(start: Optional[date], end: Optional[date]):
+    end = end or rollups.today()
+    start = start or end - timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    if start > end:
+        raise HTTPException(status_code=422, detail="start must not be after end")
+    return start, end
+
+
+@router.get("/reports/daily", response_model=List[schemas.DailySales])
+async def daily_sales(start: Optional[date] = None, end: Optional[date] = None, db=Depends(get_async_db)):
+    return await crud_async.get_daily_sales(db, *_report_range(start, end))
+
+
+@router.get("/reports/tax", response_model=List[schemas.TaxByRate])
+async def tax_by_rate(start: Optional[date] = None, end: Optional[date] = None, db=Depends(get_async_db)):
+    rows = await crud_async.get_tax_by_rate(db, *_report_range(start, end))
+    return [schemas.TaxByRate(**row._mapping) for row in rows]
+
+
+@router.get("/reports/top_products", response_model=List[schemas.TopProduct])
+async def top_products(start: Optional[date] = None, end: Optional[date] = None, limit: int = 10,
+                       db=Depends(get_async_db)):
+    limit = max(1, min(limit, REPORT_MAX_TOP_PRODUCTS))
+    rows = await crud_async.get_top_products(db, *_report_range(start, end), limit)
+    return [schemas.TopProduct(**row._mapping) for row in rows]
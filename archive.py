@@ -0,0 +1,166 @@
+# Moves purchases older than the archive horizon out of the hot tables.
+#
+# purchases, purchase_items and purchase_change only ever grow; archiving moves
+# old purchases, with their lines and change given, into purchases_archive,
+# purchase_items_archive and purchase_change_archive (models.PurchaseArchive and
+# friends), ids unchanged. With ARCHIVE_DATABASE_PATH set on SQLite, those tables
+# live in a separate file attached to every connection (see database.py).
+#
+# Work goes in batches of ARCHIVE_BATCH_SIZE purchases: copy the batch into the
+# archive, check that every row of it is there unchanged, then delete it from the
+# hot tables. In one database that is one short transaction per batch. With
+# ARCHIVE_DATABASE_PATH the copy commits first and the check and delete follow
+# in a second transaction: SQLite in WAL mode commits each attached file on its
+# own, so a single transaction could keep the delete and lose the copy. A run
+# interrupted between the two leaves the batch in both places; the next run
+# finds the rows already archived, doesn't copy them again, and deletes them.
+#
+# Ids are never handed out twice (AUTOINCREMENT on SQLite, migration 7), and the
+# newest purchase is never archived in case the database resets its counter to
+# the highest id left (MySQL before 8.0 does on restart). An archived row with
+# the id of a hot row but different contents is never overwritten: the batch
+# fails with ArchiveConflict and nothing is deleted.
+#
+# Nothing else changes: ids stay valid, /purchase_details/{id} and customer
+# history read the archive when a purchase isn't hot (crud), and the rollups
+# already count every purchase (rollups.compute reads both).
+#
+#   python archive.py run [--older-than-days N] [--batch-size N] [--max-batches N]
+#   python archive.py status
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, or_, select
+
+import models
+
+logger = logging.getLogger("archive")
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365")) # Purchases older than this are archived
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500")) # Purchases per transaction
+
+# (hot table, archive table, column linking a row to its purchase); children first for the deletes
+MOVES = (
+    (models.PurchaseChange.__table__, models.PurchaseChangeArchive.__table__, "purchase_id"),
+    (models.PurchaseItem.__table__, models.PurchaseItemArchive.__table__, "purchase_id"),
+    (models.Purchase.__table__, models.PurchaseArchive.__table__, "id"),
+)
+
+
+class ArchiveConflict(Exception):
+    """Raised when rows of a batch differ from archive rows with the same ids; nothing was deleted."""
+
+
+def cutoff(older_than_days: int = None) -> datetime:
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    # Purchase times are stored as UTC; SQLite compares them as naive strings
+    return (datetime.now(timezone.utc) - timedelta(days=days)).replace(tzinfo=None)
+
+
+def _begin_write(conn):
+    # Take SQLite's write lock up front, so the batch can't be read under another writer
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _separate_file() -> bool:
+    return models.PurchaseArchive.__table__.schema is not None
+
+
+def _not_archived(hot, cold, link, ids):
+    # Rows of the batch without an identical row in the archive
+    names = [c.name for c in cold.c]
+    identical = select(cold.c.id).where(*(cold.c[name].is_not_distinct_from(hot.c[name]) for name in names))
+    return select(*(hot.c[name] for name in names)).where(hot.c[link].in_(ids), ~identical.exists())
+
+
+def _copy_batch(conn, ids):
+    for hot, cold, link in reversed(MOVES):
+        conflicts = conn.execute(select(func.count()).select_from(hot.join(cold, cold.c.id == hot.c.id)).where(
+            hot.c[link].in_(ids), or_(*(cold.c[c.name].is_distinct_from(hot.c[c.name]) for c in cold.c)))).scalar()
+        if conflicts:
+            raise ArchiveConflict(f"{conflicts} {hot.name} rows differ from {cold.name} rows with the same ids")
+        conn.execute(cold.insert().from_select([c.name for c in cold.c], _not_archived(hot, cold, link, ids)))
+
+
+def _delete_batch(conn, ids):
+    for hot, cold, link in MOVES:
+        missing = conn.execute(select(func.count()).select_from(_not_archived(hot, cold, link, ids).subquery())).scalar()
+        if missing:
+            raise ArchiveConflict(f"{missing} {hot.name} rows are not in {cold.name}")
+    for hot, _, link in MOVES:
+        conn.execute(hot.delete().where(hot.c[link].in_(ids)))
+
+
+def archive_batch(engine, before: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Moves up to batch_size purchases made before `before` into the archive; returns how many."""
+    purchases = models.Purchase.__table__
+    newest = select(func.max(purchases.c.id)).scalar_subquery()
+    with engine.connect() as conn:
+        with conn.begin():
+            _begin_write(conn)
+            ids = conn.execute(select(purchases.c.id).where(purchases.c.purchase_time < before, purchases.c.id < newest)
+                               .order_by(purchases.c.id).limit(batch_size).with_for_update()).scalars().all()
+            if not ids:
+                return 0
+            _copy_batch(conn, ids)
+            if not _separate_file():
+                _delete_batch(conn, ids)
+                return len(ids)
+        with conn.begin():
+            _begin_write(conn)
+            _delete_batch(conn, ids)
+    return len(ids)
+
+
+def archive_purchases(engine, before: datetime = None, batch_size: int = ARCHIVE_BATCH_SIZE,
+                      max_batches: int = None) -> int:
+    """Archives every purchase made before `before` (default: the horizon), batch by batch; returns how many."""
+    before = before or cutoff()
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        count = archive_batch(engine, before, batch_size)
+        if not count:
+            break
+        moved += count
+        batches += 1
+        logger.info("Archived %d purchases (%d so far)", count, moved)
+    return moved
+
+
+def status(engine):
+    """{table name: row count} for the hot and archive tables, plus the oldest hot purchase time."""
+    with engine.connect() as conn:
+        counts = {table.name: conn.execute(select(func.count()).select_from(table)).scalar()
+                  for move in MOVES for table in move[:2]}
+        oldest = conn.execute(select(func.min(models.Purchase.__table__.c.purchase_time))).scalar()
+    return counts, oldest
+
+
+def main(argv=None):
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Move old purchases into the archive tables.")
+    parser.add_argument("command", choices=["run", "status"])
+    parser.add_argument("--older-than-days", type=int, default=None, help=f"Default: {ARCHIVE_AFTER_DAYS}")
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--max-batches", type=int, default=None, help="Stop after this many; run again to resume")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "run":
+        before = cutoff(args.older_than_days)
+        moved = archive_purchases(engine, before, args.batch_size, args.max_batches)
+        print(f"Archived {moved} purchases made before {before:%Y-%m-%d %H:%M:%S} UTC")
+    counts, oldest = status(engine)
+    for name, count in counts.items():
+        print(f"  {name:<26} {count:>12}")
+    print(f"  oldest hot purchase: {oldest or '-'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
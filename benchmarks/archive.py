@@ -0,0 +1,184 @@
+# Archival of old purchases: throughput, and that nothing visible changes.
+#
+# Seeds purchases spread over --days, records every invoice and each sampled
+# customer's full history (walked a keyset page at a time), then archives
+# everything older than --older-than-days: first a couple of batches (an
+# interrupted run), then a batch that was copied but never deleted (a crash
+# between the copy and the delete), then the rest. Afterwards every invoice and
+# history must be identical, the rollups must still match the raw rows and only
+# recent purchases may be left hot. Then a new sale must not reuse an archived
+# id, and a batch whose archive rows differ from the hot ones must fail without
+# deleting anything. Exits non-zero on any difference.
+#
+# Set ARCHIVE_DATABASE_PATH to run it against an attached archive file instead.
+#
+#   python -m benchmarks.archive --purchases 20000 --days 730 --older-than-days 365
+import argparse
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+
+import archive, billing, crud, invoices, models, rollups, schemas
+from benchmarks.common import QueryCounter, make_database, seed_products
+
+DETAIL_BUDGET_ARCHIVED = 4 # Hot lookup misses, then purchase JOIN customer, items, change given
+
+
+def _seed(SessionLocal, purchases: int, customers: int, days: int, rng: random.Random):
+    with SessionLocal() as db:
+        seed_products(db, 200)
+        start = datetime.now(timezone.utc) - timedelta(days=days)
+        baskets = sorted((schemas.OfflineBasket(
+            customer_email=f"customer{rng.randrange(customers)}@example.com",
+            items=[schemas.BasketLine(product_id=f"B{rng.randrange(200):06d}", quantity=rng.randint(1, 3))
+                   for _ in range(rng.randint(1, 6))],
+            paid_amount="100000",
+            purchase_time=start + timedelta(seconds=rng.randrange(days * 86400)),
+        ) for _ in range(purchases)), key=lambda basket: basket.purchase_time)
+        for offset in range(0, len(baskets), 5000):
+            billing.record_baskets(db, baskets[offset:offset + 5000])
+
+
+def _snapshot(SessionLocal, purchase_ids, customer_ids):
+    with SessionLocal() as db:
+        details = {purchase_id: invoices.build_invoice_for_purchase(crud.get_purchase_details(db, purchase_id))
+                   for purchase_id in purchase_ids}
+        histories = {}
+        for customer_id in customer_ids:
+            pages, after = [], None
+            while True:
+                page, has_more = crud.get_customer_purchases(db, customer_id, after_id=after, limit=20)
+                pages.append([purchase.id for purchase in page])
+                if not has_more:
+                    break
+                after = page[-1].id
+            # And one step back from the last page, across the hot/archive boundary
+            if len(pages) > 1:
+                newer, _ = crud.get_customer_purchases(db, customer_id, before_id=pages[-1][0], limit=20)
+                pages.append([purchase.id for purchase in newer])
+            histories[customer_id] = pages
+    return details, histories
+
+
+def _recent_purchases_ms(SessionLocal, runs: int = 50):
+    timings = []
+    with SessionLocal() as db:
+        for _ in range(runs):
+            started = time.perf_counter()
+            crud.get_recent_purchases(db, limit=10)
+            timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def _copy_only(engine, before: datetime, batch_size: int):
+    purchases = models.Purchase.__table__
+    with engine.begin() as conn:
+        ids = conn.execute(select(purchases.c.id).where(purchases.c.purchase_time < before)
+                           .order_by(purchases.c.id).limit(batch_size)).scalars().all()
+        archive._copy_batch(conn, ids)
+
+
+def _check_ids(SessionLocal):
+    with SessionLocal() as db:
+        customer = crud.get_customer_by_email(db, "customer0@example.com")
+        purchase = crud.create_purchase(db, customer.id, 0, [schemas.PurchaseItemCreate(product_id=1, quantity=1)])
+        failures = []
+        for model, column, ids in ((models.PurchaseArchive, models.PurchaseArchive.id, [purchase.id]),
+                                   (models.PurchaseItemArchive, models.PurchaseItemArchive.id,
+                                    [item.id for item in purchase.items]),
+                                   (models.PurchaseChangeArchive, models.PurchaseChangeArchive.id,
+                                    [note.id for note in purchase.change_notes])):
+            if ids and db.scalar(select(func.count()).select_from(model).where(column.in_(ids))):
+                failures.append(f"a new sale reused an id in {model.__tablename__}")
+    return failures
+
+
+def _check_conflict(engine):
+    # An archive row that shares a hot purchase's id but not its contents
+    hot, cold = models.Purchase.__table__, models.PurchaseArchive.__table__
+    with engine.begin() as conn:
+        row = conn.execute(select(hot).order_by(hot.c.id).limit(1)).mappings().one()
+        conn.execute(cold.insert().values(dict(row, total_amount=row["total_amount"] + 1)))
+    hot_before, _ = archive.status(engine)
+    try:
+        archive.archive_batch(engine, datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(days=1))
+        failures = ["a batch conflicting with the archive was archived"]
+    except archive.ArchiveConflict:
+        failures = []
+    hot_after, _ = archive.status(engine)
+    if hot_after != hot_before:
+        failures.append("a conflicting batch changed the tables")
+    with engine.begin() as conn:
+        conn.execute(cold.delete().where(cold.c.id == row["id"]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--purchases", type=int, default=20000)
+    parser.add_argument("--customers", type=int, default=200)
+    parser.add_argument("--days", type=int, default=730, help="Purchase history spans this many days")
+    parser.add_argument("--older-than-days", type=int, default=365)
+    parser.add_argument("--batch-size", type=int, default=archive.ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    engine, SessionLocal = make_database()
+    _seed(SessionLocal, args.purchases, args.customers, args.days, rng)
+    with SessionLocal() as db:
+        customer_ids = [crud.get_customer_by_email(db, f"customer{i}@example.com").id for i in range(3)]
+    sample = rng.sample(range(1, args.purchases + 1), min(200, args.purchases))
+    before_details, before_histories = _snapshot(SessionLocal, sample, customer_ids)
+    recent_before = _recent_purchases_ms(SessionLocal)
+
+    cutoff = archive.cutoff(args.older_than_days)
+    started = time.perf_counter()
+    moved = archive.archive_purchases(engine, cutoff, args.batch_size, max_batches=2) # Interrupted...
+    _copy_only(engine, cutoff, args.batch_size) # ...once between the copy and the delete...
+    moved += archive.archive_purchases(engine, cutoff, args.batch_size) # ...and resumed
+    elapsed = time.perf_counter() - started
+    counts, oldest = archive.status(engine)
+    print(f"Archived {moved} of {args.purchases} purchases in {elapsed:.2f} s ({moved / elapsed:.0f}/s)")
+    for name, count in counts.items():
+        print(f"  {name:<26} {count:>10}")
+    print(f"get_recent_purchases: {recent_before:.2f} ms before, {_recent_purchases_ms(SessionLocal):.2f} ms after")
+
+    failures = []
+    after_details, after_histories = _snapshot(SessionLocal, sample, customer_ids)
+    failures += [f"invoice {purchase_id} changed" for purchase_id in sample
+                 if before_details[purchase_id] != after_details[purchase_id]]
+    failures += [f"customer {customer_id}'s history changed" for customer_id in customer_ids
+                 if before_histories[customer_id] != after_histories[customer_id]]
+    if oldest is not None and oldest.replace(tzinfo=None) < cutoff:
+        failures.append(f"a purchase from {oldest} is still hot")
+    if archive.archive_purchases(engine, cutoff, args.batch_size):
+        failures.append("a second run found more to archive")
+    with engine.connect() as conn:
+        failures += rollups.diff(rollups.compute(conn), rollups.stored(conn))[:20]
+    with SessionLocal() as db:
+        archived_id = next((purchase_id for purchase_id in sample
+                            if before_details[purchase_id]["purchase_time"] < f"{cutoff:%Y-%m-%d %H:%M:%S}"), None)
+        if archived_id is not None:
+            with QueryCounter(engine) as counter:
+                crud.get_purchase_details(db, archived_id)
+            print(f"Archived invoice lookup: {counter.count} statements")
+            if counter.count > DETAIL_BUDGET_ARCHIVED:
+                failures.append(f"archived invoice lookup ran {counter.count} statements")
+
+    failures += _check_ids(SessionLocal)
+    failures += _check_conflict(engine)
+
+    for failure in failures:
+        print("FAIL:", failure)
+    if failures:
+        sys.exit(1)
+    print("OK: invoices, histories and rollups unchanged by archiving")
+
+
+if __name__ == "__main__":
+    main()
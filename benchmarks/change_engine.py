@@ -0,0 +1,133 @@
+# Change engine: property checks against brute force, then table build and lookup timings.
+#
+# Property checks (exits non-zero on a failure):
+#   * for random small drawers, ChangeTable agrees with an exhaustive search on
+#     feasibility and on the fewest notes, and never uses more notes than the drawer holds;
+#   * for random balances up to --max-amount, make_change pays out exactly
+#     balance - remainder, stays within the drawer, and with a well-stocked drawer
+#     leaves only the paise;
+#   * with unlimited notes it matches the plain greedy breakdown;
+#   * a table reused from the engine's cache gives the same change as a fresh solve.
+#
+# Timings: a cold make_change, and the next sale's (the drawer moved by that sale's
+# cash and change), which should mostly reuse the table.
+#
+#   python -m benchmarks.change_engine --cases 200 --max-amount 50000
+import argparse
+import random
+import sys
+import time
+from functools import lru_cache
+
+import change
+from benchmarks.common import percentile
+
+
+def _brute_force(counts, amount):
+    denominations = sorted(counts)
+
+    @lru_cache(maxsize=None)
+    def fewest(index, remaining):
+        if remaining == 0:
+            return 0
+        if index == len(denominations):
+            return float("inf")
+        denom = denominations[index]
+        return min(fewest(index + 1, remaining - k * denom) + k
+                   for k in range(min(counts[denom], remaining // denom) + 1))
+    return fewest(0, amount)
+
+
+def _check(condition, message):
+    if not condition:
+        print(f"FAILED: {message}")
+        sys.exit(1)
+
+
+def check_against_brute_force(cases: int, rng: random.Random):
+    for _ in range(cases):
+        counts = {d: rng.randint(0, 4) for d in change.DENOMINATIONS}
+        table = change.ChangeTable(counts, 600)
+        for amount in rng.sample(range(601), 30):
+            expected = _brute_force(counts, amount)
+            _check(table.feasible(amount) == (expected != float("inf")), f"feasibility of {amount} from {counts}")
+            if expected != float("inf"):
+                notes = table.notes_for(amount)
+                _check(sum(d * c for d, c in notes.items()) == amount, f"{notes} does not add up to {amount}")
+                _check(sum(notes.values()) == expected, f"{notes} is not the fewest notes for {amount} from {counts}")
+                _check(all(c <= counts[d] for d, c in notes.items()), f"{notes} exceeds the drawer {counts}")
+
+
+def check_make_change(cases: int, max_amount: int, rng: random.Random):
+    engine = change.ChangeEngine()
+    for _ in range(cases):
+        counts = {d: rng.randint(0, 30) for d in change.DENOMINATIONS}
+        balance_paise = rng.randint(0, max_amount * 100)
+        result = engine.make_change(balance_paise, counts)
+        given = sum(d * c for d, c in result.notes.items()) * 100
+        _check(given + result.remainder_paise == balance_paise, f"{result} does not account for {balance_paise}")
+        _check(all(c <= counts[d] for d, c in result.notes.items()), f"{result.notes} exceeds the drawer {counts}")
+
+        stocked = {d: max_amount for d in change.DENOMINATIONS}
+        _check(engine.make_change(balance_paise, stocked).remainder_paise == balance_paise % 100,
+               f"a full drawer left more than the paise of {balance_paise}")
+
+        _check(result == change.ChangeEngine().make_change(balance_paise, counts),
+               f"a cached table changed the result for {balance_paise} from {counts}")
+
+        unlimited = engine.make_change(balance_paise)
+        _check(unlimited.notes == change.unlimited_breakdown(balance_paise // 100),
+               f"unlimited breakdown of {balance_paise} is not greedy")
+
+
+def benchmark(max_amount: int, rng: random.Random):
+    print(f"{'amount':>8} {'build ms':>9} {'lookup us':>10} {'cold make_change ms':>20} {'next sale ms':>13}")
+    amounts = sorted({10 ** e for e in range(2, 8) if 10 ** e < max_amount} | {max_amount})
+    for amount in amounts:
+        counts = {d: 40 for d in change.DENOMINATIONS}
+        started = time.perf_counter()
+        table = change.ChangeTable(counts, amount)
+        build = time.perf_counter() - started
+
+        lookups = []
+        for _ in range(200):
+            target = rng.randint(0, amount)
+            started = time.perf_counter()
+            table.best_effort(target)
+            lookups.append(time.perf_counter() - started)
+
+        cold, warm = [], []
+        for _ in range(5):
+            engine = change.ChangeEngine()
+            counts = {d: rng.randint(5, 40) for d in change.DENOMINATIONS}
+            started = time.perf_counter()
+            result = engine.make_change(amount * 100 + 50, counts)
+            cold.append(time.perf_counter() - started)
+            # The next sale: its cash goes in, the change it gave comes out
+            for denom, count in result.notes.items():
+                counts[denom] -= count
+            for denom, count in change.unlimited_breakdown(rng.randint(1, 2500)).items():
+                counts[denom] += count
+            started = time.perf_counter()
+            engine.make_change(amount * 100 + 50, counts)
+            warm.append(time.perf_counter() - started)
+        print(f"{amount:>8} {build * 1000:>9.2f} {percentile(lookups, 50) * 1e6:>10.1f} "
+              f"{percentile(cold, 50) * 1000:>20.2f} {percentile(warm, 50) * 1000:>13.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cases", type=int, default=200)
+    parser.add_argument("--max-amount", type=int, default=50000, help="Largest balance in rupees")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    check_against_brute_force(args.cases, rng)
+    check_make_change(args.cases, args.max_amount, rng)
+    print(f"OK: {args.cases} brute-force and {args.cases} make_change cases passed")
+    benchmark(args.max_amount, rng)
+
+
+if __name__ == "__main__":
+    main()
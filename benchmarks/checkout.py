@@ -0,0 +1,87 @@
+# Checkout benchmark: SQL statements and latency per bill by basket size, through
+# the billing form (POST /generate_bill/) and the JSON API (POST /api/purchases).
+#
+# Fails if a bill needs more than CHECKOUT_BUDGET statements at any basket size.
+#
+#   python -m benchmarks.checkout --sizes 1 5 10 20 40 --rounds 50
+import argparse
+import logging
+import sys
+import time
+
+import crud
+from benchmarks.common import QueryCounter, app_client, make_database, percentile, seed_products
+
+# Statements per bill, whatever the basket size: customer lookup, stock (one executemany),
+# low-stock mark, drawer read and write, purchase, items and change given (one executemany
+# each), the four rollups, the purchase and its change notes read back for the invoice,
+# and the outbox email. Plus the catalog version check that catalog_cache makes now and then.
+CHECKOUT_BUDGET = 16
+
+
+def run(sizes, rounds: int, catalog_size: int):
+    engine, SessionLocal = make_database()
+    with SessionLocal() as db:
+        seed_products(db, catalog_size)
+        crud.ensure_drawer(db) # So each bill includes the cash drawer update
+    # The paid amount is far above any bill, so the drawer can never cover the change
+    logging.getLogger("sales").setLevel(logging.ERROR)
+
+    results = []
+    with app_client(SessionLocal) as client:
+        for size in sizes:
+            product_ids = [f"B{i:06d}" for i in range(size)]
+            routes = {
+                "form": lambda: client.post("/generate_bill/", data={
+                    "customer_email": "bench@example.com", "product_id": product_ids,
+                    "quantities": [1] * size, "paid_amount": 10_000_000}),
+                "api": lambda: client.post("/api/purchases", json={
+                    "customer_email": "bench@example.com", "paid_amount": "10000000",
+                    "items": [{"product_id": product_id, "quantity": 1} for product_id in product_ids]}),
+            }
+            for route, post in routes.items():
+                post() # Warm up
+                latencies = []
+                queries = []
+                for _ in range(rounds):
+                    with QueryCounter(engine) as counter:
+                        started = time.perf_counter()
+                        response = post()
+                        latencies.append((time.perf_counter() - started) * 1000)
+                    assert response.status_code in (200, 201), response.text
+                    queries.append(counter.count)
+
+                results.append({
+                    "route": route,
+                    "basket_size": size,
+                    "queries_per_bill": max(queries),
+                    "p50_ms": percentile(latencies, 50),
+                    "p99_ms": percentile(latencies, 99),
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 5, 10, 20, 40])
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--catalog-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'route':>5} {'basket':>6} {'queries':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    over = []
+    for row in run(args.sizes, args.rounds, args.catalog_size):
+        print(f"{row['route']:>5} {row['basket_size']:>6} {row['queries_per_bill']:>8} "
+              f"{row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f}")
+        if row["queries_per_bill"] > CHECKOUT_BUDGET:
+            over.append(row)
+    for row in over:
+        print(f"FAILED: a {row['basket_size']}-line {row['route']} bill ran {row['queries_per_bill']} statements "
+              f"(budget {CHECKOUT_BUDGET})")
+    if over:
+        sys.exit(1)
+    print(f"OK: at most {CHECKOUT_BUDGET} statements per bill")
+
+
+if __name__ == "__main__":
+    main()
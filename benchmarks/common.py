@@ -0,0 +1,140 @@
+# Shared helpers for the benchmark scripts in this directory.
+# Run them from the project root, e.g. `python -m benchmarks.checkout`.
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import migrations, models
+from database import create_db_engine
+
+
+def make_database(path: str = None):
+    """Creates a throwaway SQLite database and returns (engine, SessionLocal)."""
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="pos-bench-"), "bench.db")
+    engine = create_db_engine(f"sqlite:///{path}")
+    migrations.upgrade(engine)
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def seed_products(db, count: int, stock: int = 1_000_000):
+    db.add_all([
+        models.Product(name=f"Bench Product {i}", product_id=f"B{i:06d}", available_stocks=stock,
+                       price=10.0 + (i % 500), tax_percentage=(5.0, 12.0, 18.0)[i % 3])
+        for i in range(count)
+    ])
+    db.commit()
+
+
+class QueryCounter:
+    """Counts SQL statements sent through an engine while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+        self.parameters = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        return False
+
+
+@contextmanager
+def assert_max_queries(engine, limit: int, label: str = "block"):
+    """Fails if the wrapped block sends more than `limit` SQL statements through `engine`."""
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError(f"{label} ran {counter.count} queries (limit {limit}):\n  " + "\n  ".join(counter.statements))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_server(db_path: str, **env_overrides):
+    """Starts `uvicorn main:app` on a free port against db_path; returns (process, base_url)."""
+    import httpx
+
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", **env_overrides)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        if server.poll() is not None:
+            break # Failed to start; the caller sees the exit code
+        try:
+            httpx.get(base_url + "/billing/", timeout=1)
+            break
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    return server, base_url
+
+
+def percentile(values, pct: float):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+@contextmanager
+def app_sessions(session_factory, async_session_factory=None):
+    """Points main.app's database dependencies at the given session factories while active.
+
+    Without an async factory, async routes get a sync Session too, so crud_async
+    takes its thread-pool path and every statement goes through one engine.
+    """
+    import main
+
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with async_session_factory() as db:
+            yield db
+
+    main.app.dependency_overrides[main.get_db] = override_get_db
+    main.app.dependency_overrides[main.get_async_db] = override_get_async_db if async_session_factory else override_get_db
+    try:
+        yield main.app
+    finally:
+        main.app.dependency_overrides.pop(main.get_db, None)
+        main.app.dependency_overrides.pop(main.get_async_db, None)
+
+
+@contextmanager
+def app_client(session_factory):
+    """TestClient for main.app bound to the given session factory (emails stay queued in the outbox)."""
+    from fastapi.testclient import TestClient
+
+    with app_sessions(session_factory) as app:
+        yield TestClient(app)
@@ -0,0 +1,86 @@
+# Requests/sec of the async database path vs. the sync fallback under concurrency.
+#
+# Starts uvicorn once per mode (DB_ASYNC=1 and DB_ASYNC=0) against the same seeded
+# SQLite file, then drives a read-heavy mix of /, /billing/ and /purchase_details/{id}
+# with N concurrent httpx clients for a fixed duration.
+#
+#   python -m benchmarks.concurrency --clients 50 500 --duration 10
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import httpx
+
+import crud, schemas
+from benchmarks.common import make_database, percentile, run_server, seed_products
+
+PATHS = ["/", "/billing/"]
+
+
+def _seed(db_path: str, purchases: int):
+    engine, SessionLocal = make_database(db_path)
+    with SessionLocal() as db:
+        seed_products(db, 200)
+        customer = crud.create_customer(db, "bench@example.com")
+        products = {p.id: p for p in crud.get_products(db, limit=200)}
+        for i in range(purchases):
+            items = [schemas.PurchaseItemCreate(product_id=product_id, quantity=1)
+                     for product_id in random.sample(sorted(products), 5)]
+            crud.create_purchase(db, customer.id, 0, items, products=products)
+    engine.dispose()
+
+
+async def _client(client: httpx.AsyncClient, deadline: float, purchases: int, latencies: list, errors: list):
+    while time.perf_counter() < deadline:
+        path = random.choice(PATHS + [f"/purchase_details/{random.randint(1, purchases)}"])
+        started = time.perf_counter()
+        try:
+            response = await client.get(path)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        except httpx.HTTPError as e:
+            errors.append(repr(e))
+
+
+async def _drive(base_url: str, clients: int, duration: float, purchases: int):
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(_client(client, deadline, purchases, latencies, errors) for _ in range(clients)))
+    return latencies, errors
+
+
+def _run_server(db_path: str, async_mode: bool):
+    # Pool waits are expected at 500 clients
+    return run_server(db_path, DB_ASYNC="1" if async_mode else "0",
+                      DB_POOL_WAIT_WARN_MS=os.environ.get("DB_POOL_WAIT_WARN_MS", "1000"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[50, 500])
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per run")
+    parser.add_argument("--purchases", type=int, default=500, help="Purchases to seed")
+    args = parser.parse_args()
+
+    db_path = make_database()[0].url.database
+    _seed(db_path, args.purchases)
+
+    print(f"{'mode':>6} {'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for async_mode in (True, False):
+        server, base_url = _run_server(db_path, async_mode)
+        try:
+            for clients in args.clients:
+                latencies, errors = asyncio.run(_drive(base_url, clients, args.duration, args.purchases))
+                print(f"{'async' if async_mode else 'sync':>6} {clients:>8} {len(latencies) / args.duration:>8.0f} "
+                      f"{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 99) * 1000:>8.1f} {len(errors):>7}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Email outbox throughput against a local stand-in SMTP server (aiosmtpd).
+#
+# Queues N invoices in the outbox and drains them with mailer's batch sender over
+# one reused connection, then repeats with a fresh connection per message (what
+# the old BackgroundTasks sender did) for comparison. Also checks that every
+# queued message arrived exactly once.
+#
+#   pip install aiosmtpd
+#   python -m benchmarks.email_outbox --messages 2000
+import argparse
+import sys
+import time
+
+from aiosmtpd.controller import Controller
+
+import mailer, models
+from benchmarks.common import free_port, make_database
+
+INVOICE_HTML = "<html><body>" + "<p>Invoice line</p>" * 40 + "</body></html>"
+
+
+class CountingHandler:
+    def __init__(self):
+        self.received = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received.append(envelope.rcpt_tos)
+        return "250 Message accepted for delivery"
+
+
+class PerMessageSender(mailer.SMTPSender):
+    """Opens a new connection for every message, like the old send_invoice_email."""
+
+    def send(self, msg, to_addrs):
+        super().send(msg, to_addrs)
+        self.close()
+
+
+def _drain(SessionLocal, sender, count: int, batch_size: int):
+    with SessionLocal() as db:
+        for i in range(count):
+            mailer.enqueue_email(db, [f"customer{i}@example.com", "shop@example.com"], "Your Purchase Invoice",
+                                 INVOICE_HTML, commit=False)
+        db.commit()
+
+    worker = mailer.OutboxWorker(session_factory=SessionLocal, sender=sender, batch_size=batch_size)
+    started = time.perf_counter()
+    while worker.run_once():
+        pass
+    elapsed = time.perf_counter() - started
+    sender.close()
+    return worker.sent, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=mailer.OUTBOX_BATCH_SIZE)
+    args = parser.parse_args()
+
+    handler = CountingHandler()
+    port = free_port()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        results = {}
+        for label, sender_class in (("pooled", mailer.SMTPSender), ("per-message", PerMessageSender)):
+            handler.received.clear()
+            _, SessionLocal = make_database()
+            sender = sender_class(host="127.0.0.1", port=port, username="", password="", starttls=False)
+            sent, elapsed = _drain(SessionLocal, sender, args.messages, args.batch_size)
+            with SessionLocal() as db:
+                pending = db.query(models.EmailOutbox).filter(models.EmailOutbox.status != "sent").count()
+            results[label] = sent / elapsed
+            print(f"{label:>12}: {sent} sent in {elapsed:.2f}s = {sent / elapsed:,.0f} msg/s "
+                  f"over {sender.connections_opened} connection(s); received {len(handler.received)}, unsent {pending}")
+            if len(handler.received) != args.messages or pending:
+                print("FAILED: messages lost or duplicated")
+                sys.exit(1)
+        print(f"speed-up from connection reuse: {results['pooled'] / results['per-message']:.1f}x")
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
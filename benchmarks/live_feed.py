@@ -0,0 +1,222 @@
+# Live updates: hundreds of simulated dashboard / product page viewers on
+# /ws/live while cashiers post purchases.
+#
+# Everything runs in one event loop against main.app (ASGI, no network), like the
+# in-process workload. Cashiers post purchases for --seconds, first with nobody
+# watching, then with --viewers subscribers plus --slow viewers that never read
+# their socket. Reports checkout req/s both ways, the broadcaster's flush time
+# (render once + fan out), and how many renders (each a query or two) and
+# messages per viewer the purchases cost.
+#
+# Fails if a viewer misses the final state, if updates weren't coalesced, if a
+# slow viewer wasn't disconnected, or if a slow viewer's backlog grew beyond one
+# message per topic.
+#
+#   python -m benchmarks.live_feed --viewers 500 --slow 20 --seconds 5
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import sys
+import time
+
+from benchmarks.common import app_sessions, make_database, percentile, seed_products
+
+
+class Viewer:
+    """A fake browser tab on /ws/live, speaking ASGI directly to the app."""
+
+    def __init__(self, app, slow: bool = False):
+        self.app = app
+        self.slow = slow
+        self.messages = 0
+        self.purchases_shown = None # From the last "Today's Sales" fragment
+        self.closed = False
+        self._inbox = asyncio.Queue()
+        self._task = None
+
+    async def _receive(self):
+        return await self._inbox.get()
+
+    async def _send(self, message):
+        if message["type"] == "websocket.send":
+            if self.slow:
+                await asyncio.sleep(3600) # Never takes the message: a stalled tab
+            self.messages += 1
+            update = json.loads(message["text"])
+            if update["topic"] == "sales":
+                shown = re.search(r"(\d+) purchases", update["html"]["sales-today"])
+                self.purchases_shown = int(shown.group(1)) if shown else 0
+        elif message["type"] == "websocket.close":
+            self.closed = True
+
+    def connect(self):
+        scope = {"type": "websocket", "path": "/ws/live", "raw_path": b"/ws/live", "root_path": "",
+                 "query_string": b"topics=sales,products", "headers": [(b"host", b"live")], "scheme": "ws",
+                 "server": ("live", 80), "client": ("viewer", 1), "subprotocols": [], "asgi": {"version": "3.0"}}
+        self._inbox.put_nowait({"type": "websocket.connect"})
+        self._task = asyncio.create_task(self.app(scope, self._receive, self._send))
+
+    async def disconnect(self):
+        self._inbox.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        try:
+            await asyncio.wait_for(self._task, 5)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+
+    @property
+    def finished(self):
+        return self._task.done()
+
+
+async def cashiers(client, count: int, seconds: float, products: int):
+    """Posts purchases from `count` concurrent cashiers; returns per-request latencies (ms)."""
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    async def cashier(number):
+        i = 0
+        while time.perf_counter() < deadline:
+            basket = {"customer_email": f"cashier{number}@example.com", "paid_amount": "100000",
+                      "items": [{"product_id": f"B{(number * 7 + i) % products:06d}", "quantity": 1}]}
+            started = time.perf_counter()
+            response = await client.post("/api/purchases", json=basket)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError(f"purchase failed: {response.status_code} {response.text}")
+            i += 1
+
+    await asyncio.gather(*(cashier(number) for number in range(count)))
+    return latencies
+
+
+async def run(args, SessionLocal, async_session_factory):
+    import httpx
+    import live, main # main registers the renderers
+
+    live.broadcaster.interval = args.interval
+    live.LIVE_SEND_TIMEOUT = args.send_timeout
+    flush_ms = []
+    flush = live.broadcaster.flush
+
+    async def timed_flush():
+        started = time.perf_counter()
+        delivered = await flush()
+        if delivered:
+            flush_ms.append((time.perf_counter() - started) * 1000)
+        return delivered
+
+    live.broadcaster.flush = timed_flush
+    renders = dict.fromkeys(live.broadcaster.renderers, 0)
+    renderers = dict(live.broadcaster.renderers)
+
+    def counted(topic):
+        async def render(keys):
+            renders[topic] += 1
+            return await renderers[topic](keys)
+        return render
+
+    live.broadcaster.renderers.update({topic: counted(topic) for topic in renderers})
+    failures = []
+    with app_sessions(SessionLocal, async_session_factory) as app:
+        live.broadcaster.start()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://live", timeout=60) as client:
+            quiet = await cashiers(client, args.cashiers, args.seconds, args.products)
+
+            viewers = [Viewer(app) for _ in range(args.viewers)]
+            stalled = [Viewer(app, slow=True) for _ in range(args.slow)]
+            for viewer in viewers + stalled:
+                viewer.connect()
+            await asyncio.sleep(args.interval) # Let them subscribe
+            subscribed = len(live.broadcaster.subscribers)
+            backlog = 0
+
+            async def watch_backlog():
+                nonlocal backlog
+                while True:
+                    backlog = max([backlog] + [len(s._pending) for s in live.broadcaster.subscribers])
+                    await asyncio.sleep(args.interval / 2)
+
+            watcher = asyncio.create_task(watch_backlog())
+            busy = await cashiers(client, args.cashiers, args.seconds, args.products)
+            await asyncio.sleep(args.interval * 3 + 0.5) # Last updates go out
+            watcher.cancel()
+
+        # Stalled viewers must have been dropped once their send timed out
+        deadline = time.perf_counter() + args.send_timeout + args.interval * 2 + 5
+        while not all(viewer.finished for viewer in stalled) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        for viewer in viewers:
+            await viewer.disconnect()
+        for viewer in stalled:
+            if not viewer.finished:
+                await viewer.disconnect()
+        await live.broadcaster.stop()
+    live.broadcaster.flush = flush
+    live.broadcaster.renderers.update(renderers)
+
+    total_purchases = len(quiet) + len(busy)
+    messages = [viewer.messages for viewer in viewers]
+    print(f"Checkout, nobody watching:      {len(quiet) / args.seconds:7.0f} req/s  "
+          f"p50 {percentile(quiet, 50):6.1f} ms  p99 {percentile(quiet, 99):6.1f} ms")
+    print(f"Checkout, {subscribed:>4} viewers:          {len(busy) / args.seconds:7.0f} req/s  "
+          f"p50 {percentile(busy, 50):6.1f} ms  p99 {percentile(busy, 99):6.1f} ms")
+    if flush_ms:
+        print(f"Flush (render once, fan out):   p50 {statistics.median(flush_ms):6.1f} ms  "
+              f"max {max(flush_ms):6.1f} ms over {len(flush_ms)} flushes")
+    print(f"Messages per viewer:            median {statistics.median(messages):.0f} "
+          f"for {len(busy)} purchases (interval {args.interval}s)")
+    print(f"Stalled viewers disconnected:   {sum(viewer.finished for viewer in stalled)} of {len(stalled)}; "
+          f"largest backlog {backlog} message(s)")
+    print(f"Renders:                        {renders.get('sales', 0)} sales, {renders.get('products', 0)} products "
+          f"for {len(busy)} purchases x {subscribed} viewers")
+
+    if subscribed != args.viewers + args.slow:
+        failures.append(f"only {subscribed} of {args.viewers + args.slow} viewers subscribed")
+    behind = [viewer for viewer in viewers if viewer.purchases_shown != total_purchases]
+    if behind:
+        failures.append(f"{len(behind)} viewers don't show the final {total_purchases} purchases "
+                        f"(e.g. {behind[0].purchases_shown})")
+    if max(messages) > len(busy):
+        failures.append(f"a viewer got {max(messages)} messages for {len(busy)} purchases: not coalesced")
+    if not all(viewer.finished for viewer in stalled):
+        failures.append("a stalled viewer was never disconnected")
+    if backlog > len(live.TOPICS):
+        failures.append(f"a subscriber's backlog reached {backlog} messages")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--viewers", type=int, default=500)
+    parser.add_argument("--slow", type=int, default=20, help="Viewers that never read their socket")
+    parser.add_argument("--cashiers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.25, help="LIVE_UPDATE_INTERVAL for the run")
+    parser.add_argument("--send-timeout", type=float, default=2, help="LIVE_SEND_TIMEOUT for the run")
+    args = parser.parse_args()
+
+    import logging
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from database import create_async_db_engine
+
+    for name in ("database", "sales", "live"):
+        logging.getLogger(name).setLevel(logging.ERROR)
+    engine, SessionLocal = make_database()
+    with SessionLocal() as db:
+        seed_products(db, args.products)
+    async_engine = create_async_db_engine(str(engine.url))
+    failures = asyncio.run(run(args, SessionLocal,
+                               async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)))
+    for failure in failures:
+        print("FAIL:", failure)
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# Low-stock tracking: the cost of a sale as the catalog grows, and that the
+# low_stock list stays exactly what a full catalog scan would say.
+#
+# Seeds a small and a large catalog (every product with a reorder level, a share
+# of them close to it), then records the same purchases against each: the same
+# near-threshold products in the same order, so only the catalog size differs.
+# Reports the per-sale time and statements at both sizes, then restocks, edits,
+# deletes and imports products, sends the reorder digest and loads
+# /products/low_stock.
+#
+# Fails if a sale needs more statements on the large catalog, if its time grows
+# with the catalog (beyond noise), if low_stock differs from low_stock.scan()
+# after any step, if the digest doesn't queue one email covering the pending
+# products (and nothing the second time), or if the page costs more than its budget.
+#
+#   python -m benchmarks.low_stock --products 100000 --sales 2000
+import argparse
+import io
+import random
+import sys
+import time
+
+from sqlalchemy import insert, select
+
+import crud, low_stock, models, product_io, schemas
+from benchmarks.common import QueryCounter, app_client, assert_max_queries, make_database
+
+LOW_STOCK_PAGE_BUDGET = 2 # The low products (joined to low_stock), then the count
+
+
+def seed_catalog(db, count: int, rng: random.Random):
+    """Products with reorder level 20; one in ten starts at 21-40 units so sales push it under."""
+    rows = [{"name": f"Bench Product {i}", "product_id": f"B{i:06d}", "price": 10, "tax_percentage": 5,
+             "reorder_level": 20, "available_stocks": rng.randint(21, 40) if i % 10 == 0 else 1_000_000}
+            for i in range(count)]
+    for first in range(0, count, 10_000):
+        db.execute(insert(models.Product.__table__), rows[first:first + 10_000])
+    db.commit()
+
+
+def _fail(message):
+    print(f"FAILED: {message}")
+    sys.exit(1)
+
+
+def _check(engine, step: str):
+    with engine.connect() as conn:
+        expected, listed = low_stock.scan(conn), low_stock.stored(conn)
+    if expected != listed:
+        _fail(f"after {step}: {len(expected - listed)} low products not listed, "
+              f"{len(listed - expected)} listed but not low")
+    return len(listed)
+
+
+def sell(engine, SessionLocal, sales: int, rng: random.Random, near: int):
+    """(seconds per sale, statements per sale) for `sales` one-line purchases of the first `near` near-threshold products."""
+    with SessionLocal() as db:
+        customer = (crud.get_customer_by_email(db, "low-stock@example.com")
+                    or crud.create_customer(db, "low-stock@example.com"))
+        near = range(1, near * 10, 10) # Product i % 10 == 0 has id i + 1
+        with QueryCounter(engine) as counter:
+            started = time.perf_counter()
+            for _ in range(sales):
+                product_id = rng.choice(near)
+                items = [schemas.PurchaseItemCreate(product_id=product_id, quantity=1)]
+                try:
+                    crud.create_purchase(db, customer.id, 0, items)
+                except crud.InsufficientStockError:
+                    pass
+            elapsed = time.perf_counter() - started
+    return elapsed / sales, counter.count / sales
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--sales", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = {}
+    sizes = (max(args.products // 100, 100), args.products)
+    near = min(100, min(sizes) // 10) # Near-threshold products that exist in both catalogs
+    for count in sizes:
+        engine, SessionLocal = make_database()
+        with SessionLocal() as db:
+            seed_catalog(db, count, random.Random(args.seed))
+        rng = random.Random(args.seed) # The same sales at both sizes
+        sell(engine, SessionLocal, 50, rng, near) # Warm-up
+        results[count] = sell(engine, SessionLocal, args.sales, rng, near)
+        low = _check(engine, f"{args.sales} sales on {count} products")
+        print(f"{count:>7} products: {results[count][0] * 1000:6.2f} ms/sale  "
+              f"{results[count][1]:5.1f} statements/sale  {low} low")
+
+    (small_time, small_statements), (large_time, large_statements) = results.values()
+    if large_statements > small_statements:
+        _fail(f"a sale runs {large_statements:.1f} statements on the large catalog, {small_statements:.1f} on the small")
+    if large_time > small_time * 2:
+        _fail("per-sale time grows with the catalog")
+
+    # Every other way stock or levels change, on the large catalog
+    with SessionLocal() as db:
+        listed = sorted(low_stock.stored(db.connection()))
+        restocked = crud.get_product(db, listed[0])
+        crud.update_product(db, restocked.id, schemas.ProductCreate(
+            name=restocked.name, product_id=restocked.product_id, available_stocks=500,
+            price=restocked.price, tax_percentage=restocked.tax_percentage))
+        _check(engine, "a restock")
+        lowered = crud.get_product(db, listed[1])
+        crud.update_product(db, lowered.id, schemas.ProductCreate(
+            name=lowered.name, product_id=lowered.product_id, available_stocks=lowered.available_stocks,
+            price=lowered.price, tax_percentage=lowered.tax_percentage, reorder_level=0))
+        _check(engine, "a reorder level set to 0")
+        crud.delete_product(db, listed[2])
+        _check(engine, "a delete")
+        crud.create_product(db, schemas.ProductCreate(name="Nearly Out", product_id="LOW-NEW", available_stocks=2,
+                                                      price=1, tax_percentage=0, reorder_level=5))
+        _check(engine, "adding a low product")
+        rows = "product_id,name,available_stocks,price,tax_percentage,reorder_level\n" + "".join(
+            f"{product.product_id},{product.name},1,10,5,{level}\n"
+            for product, level in ((crud.get_product(db, listed[3]), ""), (crud.get_product(db, 2), 50)))
+        rows += "LOW-CSV,Imported Low,3,1,0,10\n"
+        report = product_io.import_products(db, io.BytesIO(rows.encode()), "csv")
+        if report.failed:
+            _fail(f"import failed: {report.errors}")
+        total = _check(engine, "an import")
+        if crud.get_product(db, listed[3]).reorder_level != 20:
+            _fail("an import without a reorder_level changed the product's")
+
+        low_stock.LOW_STOCK_ALERT_RECIPIENTS = "buyer@example.com"
+        emails = db.scalar(select(models.EmailOutbox.id).order_by(models.EmailOutbox.id.desc()).limit(1)) or 0
+        started = time.perf_counter()
+        reported = low_stock.send_digest(db, max_items=total + 1)
+        digest_ms = (time.perf_counter() - started) * 1000
+        queued = db.scalars(select(models.EmailOutbox).where(models.EmailOutbox.id > emails)).all()
+        if reported != total or len(queued) != 1:
+            _fail(f"the digest reported {reported} of {total} products in {len(queued)} emails")
+        if low_stock.send_digest(db):
+            _fail("a second digest reported products again")
+    print(f"Digest: {reported} products in one email, {digest_ms:.0f} ms")
+
+    with app_client(SessionLocal) as client:
+        with assert_max_queries(engine, LOW_STOCK_PAGE_BUDGET, "/products/low_stock") as counter:
+            client.get("/products/low_stock").raise_for_status()
+    print(f"/products/low_stock: {counter.count} statements for {total} low products")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Offline till import: throughput of POST /api/purchases/batch.
+#
+# Builds --sales random baskets (1-5 lines, each with an idempotency key and a
+# sale time), posts them --batch-size at a time, then checks that every sale was
+# created, that stock went down by exactly the quantities sold, and that posting
+# the first batch again only replays it. Repeat with different --chunk-size
+# values (baskets per transaction) to compare.
+#
+#   python -m benchmarks.offline_import --sales 100000 --batch-size 1000 --chunk-size 500
+import argparse
+import logging
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import billing, models
+from benchmarks.common import app_client, make_database, seed_products
+
+
+def make_baskets(count: int, catalog_size: int, rng: random.Random):
+    day = datetime(2024, 1, 1, 9, 0, 0)
+    baskets = []
+    for i in range(count):
+        lines = [{"product_id": f"B{rng.randrange(catalog_size):06d}", "quantity": rng.randint(1, 3)}
+                 for _ in range(rng.randint(1, 5))]
+        baskets.append({
+            "customer_email": f"customer{rng.randrange(count // 10 + 1)}@example.com",
+            "items": lines,
+            "paid_amount": "100000",
+            "idempotency_key": f"till-7-{i}",
+            "purchase_time": (day + timedelta(seconds=i)).isoformat(),
+        })
+    return baskets
+
+
+def _fail(message):
+    print(f"FAILED: {message}")
+    sys.exit(1)
+
+
+def run(sales: int, batch_size: int, chunk_size: int, catalog_size: int, seed: int):
+    engine, SessionLocal = make_database()
+    with SessionLocal() as db:
+        seed_products(db, catalog_size)
+    billing.BATCH_CHUNK_SIZE = chunk_size
+    logging.getLogger("sales").setLevel(logging.ERROR)
+
+    baskets = make_baskets(sales, catalog_size, random.Random(seed))
+    sold = {}
+    for basket in baskets:
+        for line in basket["items"]:
+            sold[line["product_id"]] = sold.get(line["product_id"], 0) + line["quantity"]
+
+    created = 0
+    with app_client(SessionLocal) as client:
+        started = time.perf_counter()
+        for start in range(0, sales, batch_size):
+            response = client.post("/api/purchases/batch", json={"baskets": baskets[start:start + batch_size]})
+            if response.status_code != 200:
+                _fail(response.text)
+            created += response.json()["created"]
+        elapsed = time.perf_counter() - started
+
+        replay = client.post("/api/purchases/batch", json={"baskets": baskets[:batch_size]}).json()
+        if replay["replayed"] != min(batch_size, sales):
+            _fail(f"re-posting the first batch replayed {replay['replayed']} baskets")
+
+    if created != sales:
+        _fail(f"created {created} of {sales} sales")
+    with SessionLocal() as db:
+        for product in db.query(models.Product):
+            if product.available_stocks != 1_000_000 - sold.get(product.product_id, 0):
+                _fail(f"{product.product_id} has {product.available_stocks} left, expected {1_000_000 - sold.get(product.product_id, 0)}")
+    lines = sum(len(basket["items"]) for basket in baskets)
+    return elapsed, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sales", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=1000, help="Baskets per request")
+    parser.add_argument("--chunk-size", type=int, default=billing.BATCH_CHUNK_SIZE, help="Baskets per transaction")
+    parser.add_argument("--catalog-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    elapsed, lines = run(args.sales, args.batch_size, args.chunk_size, args.catalog_size, args.seed)
+    print(f"OK: imported {args.sales} sales ({lines} lines) in {elapsed:.1f} s")
+    print(f"{args.sales / elapsed:.0f} sales/s, {lines / elapsed:.0f} lines/s "
+          f"(batch size {args.batch_size}, chunk size {args.chunk_size})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Checks that the per-page query count stays flat as purchase history grows.
+#
+# Seeds purchases in rounds and, after each round, renders the dashboard, an
+# invoice (cold, from the invoice cache, then revalidated with its ETag) and a
+# customer's history (its first and a deep keyset page), failing if any page
+# needs more statements than its budget. Exits non-zero on a regression.
+#
+#   python -m benchmarks.page_queries --rounds 4 --purchases-per-round 50
+import argparse
+import random
+import sys
+
+import crud, invoices, schemas
+from benchmarks.common import app_client, assert_max_queries, make_database, seed_products
+
+# Statements per page, independent of data size
+PAGE_BUDGETS = {
+    "dashboard": 4,        # purchases JOIN customers, then the three sales rollup widgets
+    "purchase_details": 3, # purchase JOIN customer, then items and change given (selectin)
+    "purchase_details_cached": 0, # served from invoices.invoice_cache
+    "purchase_details_revalidated": 0, # If-None-Match on a cached invoice: 304 without a lookup
+    "customer_purchases": 4, # customer, one keyset page of hot and one of archived history, lifetime totals
+    "customer_purchases_older": 4, # a page deep in the history costs the same
+}
+
+
+def _add_purchases(SessionLocal, count: int, lines: int):
+    with SessionLocal() as db:
+        products = {p.id: p for p in crud.get_products(db, limit=1000)}
+        customer = crud.get_customer_by_email(db, "history@example.com") or crud.create_customer(db, "history@example.com")
+        for _ in range(count):
+            items = [schemas.PurchaseItemCreate(product_id=product_id, quantity=1)
+                     for product_id in random.sample(sorted(products), lines)]
+            crud.create_purchase(db, customer.id, 0, items, products=products)
+        return crud.get_recent_purchases(db, limit=1)[0].id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--purchases-per-round", type=int, default=50)
+    parser.add_argument("--lines", type=int, default=10, help="Line items per purchase")
+    args = parser.parse_args()
+
+    engine, SessionLocal = make_database()
+    with SessionLocal() as db:
+        seed_products(db, 200)
+
+    with app_client(SessionLocal) as client:
+        try:
+            for round_no in range(1, args.rounds + 1):
+                latest_id = _add_purchases(SessionLocal, args.purchases_per_round, args.lines)
+                counts = {}
+                with assert_max_queries(engine, PAGE_BUDGETS["dashboard"], "dashboard") as counter:
+                    client.get("/").raise_for_status()
+                counts["dashboard"] = counter.count
+                invoices.invoice_cache.clear()
+                for page in ("purchase_details", "purchase_details_cached"):
+                    with assert_max_queries(engine, PAGE_BUDGETS[page], page) as counter:
+                        response = client.get(f"/purchase_details/{latest_id}")
+                        response.raise_for_status()
+                    counts[page] = counter.count
+                with assert_max_queries(engine, PAGE_BUDGETS["purchase_details_revalidated"],
+                                        "purchase_details_revalidated") as counter:
+                    revalidated = client.get(f"/purchase_details/{latest_id}",
+                                             headers={"If-None-Match": response.headers["etag"]})
+                if revalidated.status_code != 304:
+                    raise AssertionError(f"revalidating an invoice returned {revalidated.status_code}, not 304")
+                counts["purchase_details_revalidated"] = counter.count
+                with assert_max_queries(engine, PAGE_BUDGETS["customer_purchases"], "customer_purchases") as counter:
+                    client.post("/customer_purchases/", data={"customer_email": "history@example.com"}).raise_for_status()
+                counts["customer_purchases"] = counter.count
+                with assert_max_queries(engine, PAGE_BUDGETS["customer_purchases_older"], "customer_purchases_older") as counter:
+                    client.get("/customer_purchases/", params={"customer_email": "history@example.com",
+                                                               "after": latest_id - round_no * args.purchases_per_round // 2}).raise_for_status()
+                counts["customer_purchases_older"] = counter.count
+                print(f"purchases={round_no * args.purchases_per_round:>6} " + " ".join(f"{k}={v}" for k, v in counts.items()))
+        except AssertionError as e:
+            print(f"FAILED: {e}")
+            sys.exit(1)
+    print("OK: query counts are independent of data size")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Bulk product import/export: rows/sec of product_io against one-at-a-time
+# crud.create_product, and peak Python memory of the export at two catalog sizes.
+#
+# Fails if a re-import doesn't update every row, or if exporting the larger
+# catalog needs much more memory than the smaller one (the export must stream).
+#
+#   python -m benchmarks.product_import --rows 50000
+import argparse
+import io
+import sys
+import time
+import tracemalloc
+
+import crud, product_io, schemas
+from benchmarks.common import make_database
+
+
+def make_csv(rows: int, offset: int = 0) -> bytes:
+    lines = ["product_id,name,available_stocks,price,tax_percentage"]
+    lines.extend(f"SKU{i:07d},Imported Product {i},{i % 500},{10 + i % 997}.{i % 100:02d},{(5, 12, 18)[i % 3]}"
+                 for i in range(offset, offset + rows))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def _fail(message):
+    print(f"FAILED: {message}")
+    sys.exit(1)
+
+
+def export_peak(SessionLocal) -> int:
+    tracemalloc.start()
+    with SessionLocal() as db:
+        for _ in product_io.export_chunks(db, "csv"):
+            pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--one-at-a-time", type=int, default=500, help="Rows for the create_product baseline")
+    args = parser.parse_args()
+
+    _, SessionLocal = make_database()
+    with SessionLocal() as db:
+        started = time.perf_counter()
+        for i in range(args.one_at_a_time):
+            crud.create_product(db, schemas.ProductCreate(product_id=f"ONE{i:05d}", name=f"One {i}", available_stocks=1,
+                                                          price="1.00", tax_percentage="5"))
+        baseline = args.one_at_a_time / (time.perf_counter() - started)
+    print(f"create_product one at a time: {baseline:8.0f} rows/s")
+
+    data = make_csv(args.rows)
+    for label in ("import (insert)", "import (update)"):
+        with SessionLocal() as db:
+            started = time.perf_counter()
+            report = product_io.import_products(db, io.BytesIO(data), "csv")
+            elapsed = time.perf_counter() - started
+        if report.failed or report.created + report.updated != args.rows:
+            _fail(f"{label}: {report.created} created, {report.updated} updated, {report.failed} failed")
+        print(f"{label:<30}{args.rows / elapsed:8.0f} rows/s")
+    if report.updated != args.rows:
+        _fail(f"re-import updated {report.updated} of {args.rows} rows")
+
+    small_peak = export_peak(SessionLocal)
+    with SessionLocal() as db:
+        product_io.import_products(db, io.BytesIO(make_csv(args.rows * 3, offset=args.rows)), "csv")
+    large_peak = export_peak(SessionLocal)
+    print(f"export peak memory: {small_peak / 1024:.0f} KiB at {args.rows} rows, "
+          f"{large_peak / 1024:.0f} KiB at {args.rows * 4} rows")
+    if large_peak > small_peak * 2:
+        _fail("export memory grows with the catalog")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
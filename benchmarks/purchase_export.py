@@ -0,0 +1,178 @@
+# Purchase export: rows/sec of purchase_export as CSV.gz (and Parquet, when
+# pyarrow is installed), and the export's peak Python memory and process RSS
+# growth at two sizes.
+#
+# Part of the history is archived first, so both the archive and the hot tables
+# are read. Fails if the export is missing lines, if its line totals don't add
+# up to what the database holds, if a query it runs scans a whole table or sorts
+# in a temporary B-tree (on SQLite), or if exporting four times the lines needs
+# much more Python memory or RSS than the smaller run (the export must stream).
+#
+#   python -m benchmarks.purchase_export --purchases 20000
+import argparse
+import csv
+import gzip
+import io
+import random
+import re
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from sqlalchemy import func, select
+
+import archive, billing, models, purchase_export, schemas
+from benchmarks.common import QueryCounter, make_database, seed_products
+
+
+RSS_SLACK = 8 * 1024 * 1024 # Allocator and page cache noise
+
+
+def _seed(SessionLocal, purchases: int, days: int, rng: random.Random, offset: int = 0):
+    with SessionLocal() as db:
+        if offset == 0:
+            seed_products(db, 200)
+        start = datetime.now(timezone.utc) - timedelta(days=days)
+        baskets = [schemas.OfflineBasket(
+            customer_email=f"customer{rng.randrange(500)}@example.com",
+            items=[schemas.BasketLine(product_id=f"B{rng.randrange(200):06d}", quantity=rng.randint(1, 3))
+                   for _ in range(rng.randint(1, 6))],
+            paid_amount="100000",
+            purchase_time=start + timedelta(seconds=rng.randrange(days * 86400)),
+        ) for _ in range(purchases)]
+        for first in range(0, len(baskets), 5000):
+            billing.record_baskets(db, baskets[first:first + 5000])
+
+
+def _expected(engine):
+    """(line count, sum of line totals) over the hot and archive tables."""
+    lines, total = 0, Decimal(0)
+    with engine.connect() as conn:
+        for item in (models.PurchaseItem, models.PurchaseItemArchive):
+            count, amount = conn.execute(select(func.count(), func.coalesce(func.sum(item.line_total), 0))).one()
+            lines += count
+            total += amount
+    return lines, total
+
+
+def _fail(message):
+    print(f"FAILED: {message}")
+    sys.exit(1)
+
+
+def export(SessionLocal, fmt: str, start, end, batch_size: int):
+    """(bytes, seconds) of one export, counting the bytes rather than keeping them."""
+    size = 0
+    started = time.perf_counter()
+    with SessionLocal() as db:
+        for chunk in purchase_export.export_chunks(db, fmt, start, end, batch_size):
+            size += len(chunk)
+    return size, time.perf_counter() - started
+
+
+def export_peak(SessionLocal, fmt: str, start, end, batch_size: int) -> int:
+    tracemalloc.start()
+    export(SessionLocal, fmt, start, end, batch_size)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def _anonymous_rss() -> int:
+    # Bytes of anonymous resident memory (heap, SQLite's page cache and temp B-trees; not the
+    # mmapped database file), or 0 where /proc isn't available
+    try:
+        with open("/proc/self/status") as status:
+            return next(int(line.split()[1]) * 1024 for line in status if line.startswith("RssAnon:"))
+    except (OSError, StopIteration):
+        return 0
+
+
+def export_rss_growth(SessionLocal, fmt: str, start, end, batch_size: int) -> int:
+    """Largest growth of anonymous RSS over the export, sampled after every chunk."""
+    baseline = peak = _anonymous_rss()
+    with SessionLocal() as db:
+        for _ in purchase_export.export_chunks(db, fmt, start, end, batch_size):
+            peak = max(peak, _anonymous_rss())
+    return peak - baseline
+
+
+def query_plan_problems(engine, SessionLocal, start, end, batch_size: int):
+    """Full scans and temp B-tree sorts in the export's queries (SQLite only)."""
+    if engine.dialect.name != "sqlite":
+        return []
+    with QueryCounter(engine) as counter:
+        with SessionLocal() as db:
+            for _ in purchase_export.iter_batches(db, start, end, batch_size):
+                pass
+    problems = []
+    with engine.connect() as conn:
+        for statement, parameters in dict(zip(counter.statements, counter.parameters)).items():
+            for *_, detail in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+                if re.match(r"SCAN (?!CONSTANT)", detail) or "TEMP B-TREE" in detail:
+                    problems.append(f"{detail}: {' '.join(statement.split())[:120]}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--purchases", type=int, default=20_000)
+    parser.add_argument("--days", type=int, default=730, help="Purchase history spans this many days")
+    parser.add_argument("--batch-size", type=int, default=purchase_export.PURCHASE_EXPORT_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    engine, SessionLocal = make_database()
+    _seed(SessionLocal, args.purchases, args.days, rng)
+    archive.archive_purchases(engine, archive.cutoff(args.days // 2))
+    start = (datetime.now(timezone.utc) - timedelta(days=args.days + 1)).date()
+    end = (datetime.now(timezone.utc) + timedelta(days=1)).date()
+    lines, line_total = _expected(engine)
+
+    # The CSV must hold every line, and add up to the stored line totals
+    with SessionLocal() as db:
+        data = b"".join(purchase_export.export_chunks(db, "csv.gz", start, end, args.batch_size))
+    rows = list(csv.DictReader(io.StringIO(gzip.decompress(data).decode())))
+    if len(rows) != lines:
+        _fail(f"exported {len(rows)} of {lines} lines")
+    exported_total = sum(Decimal(row["line_total"]) for row in rows)
+    if exported_total != line_total:
+        _fail(f"exported line totals add up to {exported_total}, not {line_total}")
+    del data, rows
+    for problem in query_plan_problems(engine, SessionLocal, start, end, args.batch_size):
+        _fail(f"export query plan: {problem}")
+
+    formats = ["csv.gz"]
+    try:
+        purchase_export.check_format("parquet")
+        formats.append("parquet")
+    except ValueError:
+        print("parquet: skipped (pyarrow not installed)")
+    small_peaks, small_rss = {}, {}
+    for fmt in formats:
+        size, elapsed = export(SessionLocal, fmt, start, end, args.batch_size)
+        print(f"{fmt:<8} {lines / elapsed:9.0f} lines/s  {size / lines:6.1f} bytes/line  ({lines} lines)")
+        small_peaks[fmt] = export_peak(SessionLocal, fmt, start, end, args.batch_size)
+        small_rss[fmt] = export_rss_growth(SessionLocal, fmt, start, end, args.batch_size)
+
+    _seed(SessionLocal, args.purchases * 3, args.days, rng, offset=1)
+    more_lines, _ = _expected(engine)
+    for fmt in formats:
+        small_peak, large_peak = small_peaks[fmt], export_peak(SessionLocal, fmt, start, end, args.batch_size)
+        large_rss = export_rss_growth(SessionLocal, fmt, start, end, args.batch_size)
+        print(f"{fmt} export peak memory: {small_peak / 1024:.0f} KiB at {lines} lines, "
+              f"{large_peak / 1024:.0f} KiB at {more_lines} lines")
+        print(f"{fmt} export RSS growth:  {small_rss[fmt] / 1024:.0f} KiB at {lines} lines, "
+              f"{large_rss / 1024:.0f} KiB at {more_lines} lines")
+        if large_peak > small_peak * 2:
+            _fail(f"{fmt} export memory grows with the number of lines")
+        if large_rss > small_rss[fmt] * 2 + RSS_SLACK:
+            _fail(f"{fmt} export RSS grows with the number of lines")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
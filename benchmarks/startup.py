@@ -0,0 +1,121 @@
+# Startup cost of the app, and checks that importing it does no database work.
+#
+#   import      -> `import main` against a database path that must stay untouched
+#   migrate     -> `python migrations.py --seed` on a fresh database, then again (a no-op)
+#   refuse      -> the app must refuse to start on a database with pending migrations
+#   first byte  -> from launching uvicorn to the first response, one process at a time
+#   workers     -> that many processes started together on one database; the catalog stays seeded once
+#
+# Exits non-zero if a check fails.
+#
+#   python -m benchmarks.startup --runs 5 --workers 4
+import argparse
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import migrations
+from benchmarks.common import run_server
+
+QUIET = {"EMAIL_OUTBOX_WORKER": "0", "BACKGROUND_JOBS": "0"}
+
+
+def _env(db_path: str, **overrides):
+    return dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", **QUIET, **overrides)
+
+
+def _timed(args, env):
+    started = time.perf_counter()
+    result = subprocess.run(args, env=env, capture_output=True, text=True)
+    return time.perf_counter() - started, result
+
+
+def _product_count(db_path: str) -> int:
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+
+def _start(db_path: str):
+    started = time.perf_counter()
+    server, base_url = run_server(db_path, **QUIET)
+    return time.perf_counter() - started, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5, help="Repetitions of the timed steps")
+    parser.add_argument("--workers", type=int, default=4, help="Processes started together")
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="pos-startup-")
+    failures = []
+
+    untouched = os.path.join(workdir, "untouched.db")
+    baseline = [_timed([sys.executable, "-c", "pass"], os.environ)[0] for _ in range(args.runs)]
+    imports = []
+    for _ in range(args.runs):
+        elapsed, result = _timed([sys.executable, "-W", "ignore", "-c", "import main"], _env(untouched))
+        if result.returncode:
+            failures.append(f"import main failed:\n{result.stderr}")
+            break
+        imports.append(elapsed)
+    if os.path.exists(untouched):
+        failures.append("import main opened the database")
+    print(f"{'interpreter':<22} {statistics.median(baseline) * 1000:>8.0f} ms")
+    if imports:
+        print(f"{'import main':<22} {statistics.median(imports) * 1000:>8.0f} ms")
+
+    db_path = os.path.join(workdir, "pos.db")
+    for label in ("migrate fresh", "migrate again"):
+        elapsed, result = _timed([sys.executable, "-W", "ignore", "migrations.py", "--seed"], _env(db_path))
+        print(f"{label:<22} {elapsed * 1000:>8.0f} ms   {result.stdout.strip()}")
+        if result.returncode:
+            failures.append(f"{label} failed:\n{result.stderr}")
+    if os.path.exists(db_path) and _product_count(db_path) != len(migrations.DEMO_PRODUCTS):
+        failures.append(f"seeding twice left {_product_count(db_path)} products")
+
+    stale = os.path.join(workdir, "stale.db")
+    sqlite3.connect(stale).close()
+    elapsed, server = _start(stale)
+    if server.poll() is None:
+        failures.append("the app started on a database with pending migrations")
+        server.terminate()
+    server.wait()
+    print(f"{'refuse stale schema':<22} {elapsed * 1000:>8.0f} ms   exit code {server.returncode}")
+
+    first_byte = []
+    for _ in range(args.runs):
+        elapsed, server = _start(db_path)
+        if server.poll() is not None:
+            failures.append(f"the app exited with {server.returncode} on a migrated database")
+            break
+        first_byte.append(elapsed)
+        server.terminate()
+        server.wait()
+    if first_byte:
+        print(f"{'first response':<22} {statistics.median(first_byte) * 1000:>8.0f} ms")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as pool:
+        servers = [server for _, server in pool.map(lambda _: _start(db_path), range(args.workers))]
+    elapsed = time.perf_counter() - started
+    if any(server.poll() is not None for server in servers):
+        failures.append(f"{sum(server.poll() is not None for server in servers)} of {args.workers} workers failed to start")
+    for server in servers:
+        server.terminate()
+        server.wait()
+    print(f"{f'{args.workers} workers together':<22} {elapsed * 1000:>8.0f} ms")
+    if _product_count(db_path) != len(migrations.DEMO_PRODUCTS):
+        failures.append(f"{_product_count(db_path)} products after starting {args.workers} workers")
+
+    for failure in failures:
+        print("FAIL:", failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Multi-process stress test for crud.create_purchase stock reservation.
+#
+# Several processes hammer a handful of hot products until they sell out, then the
+# script checks that nothing was oversold: for every product, the units recorded in
+# purchase_items plus the remaining stock must equal the starting stock, and no
+# stock may go negative. Exits non-zero on any violation.
+#
+#   python -m benchmarks.stock_contention --processes 16 --attempts 200
+#   python -m benchmarks.stock_contention --url postgresql://user:pw@localhost/pos_bench
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+import crud, migrations, models, sales, schemas
+import database
+from database import create_db_engine
+
+HOT_PRODUCTS = 5
+
+
+def _engine(url: str):
+    # Tills queue for the SQLite write lock rather than failing under heavy contention
+    database.SQLITE_PRAGMAS["busy_timeout"] = 60_000
+    return create_db_engine(url)
+
+
+def _till(url: str, attempts: int, seed: int, results):
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=_engine(url))
+    rng = random.Random(seed)
+    sold = failed = 0
+    for _ in range(attempts):
+        lines = [(f"HOT{rng.randrange(HOT_PRODUCTS)}", rng.randint(1, 3)) for _ in range(rng.randint(1, 3))]
+        with SessionLocal() as db:
+            products = crud.get_products_by_product_id_strs(db, [product_id for product_id, _ in lines])
+            items = [schemas.PurchaseItemCreate(product_id=products[product_id].id, quantity=qty) for product_id, qty in lines]
+            try:
+                crud.create_purchase(db, customer_id=seed + 1, paid_amount=0, items=items,
+                                     products={p.id: p for p in products.values()})
+                sold += 1
+            except crud.InsufficientStockError:
+                failed += 1
+    results.put((sold, failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", help="Database URL (default: a temporary SQLite file)")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--attempts", type=int, default=200, help="Bills attempted per process")
+    parser.add_argument("--stock", type=int, default=300, help="Starting stock per hot product")
+    args = parser.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="pos-stress-"), "stress.db")
+    engine = _engine(url)
+    migrations.upgrade(engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with SessionLocal() as db:
+        db.add_all([models.Customer(email=f"till{i}@example.com") for i in range(args.processes)])
+        db.add_all([models.Product(name=f"Hot {i}", product_id=f"HOT{i}", available_stocks=args.stock,
+                                   price=1.0, tax_percentage=0.0) for i in range(HOT_PRODUCTS)])
+        db.commit()
+
+    results = multiprocessing.Queue()
+    tills = [multiprocessing.Process(target=_till, args=(url, args.attempts, seed, results)) for seed in range(args.processes)]
+    started = time.perf_counter()
+    for till in tills:
+        till.start()
+    outcomes = [results.get() for _ in tills]
+    for till in tills:
+        till.join()
+    elapsed = time.perf_counter() - started
+
+    sold = sum(s for s, _ in outcomes)
+    failed = sum(f for _, f in outcomes)
+    print(f"mode={sales.STOCK_RESERVATION_MODE} processes={args.processes} bills={sold} rejected={failed} "
+          f"elapsed={elapsed:.2f}s ({(sold + failed) / elapsed:.0f} attempts/s)")
+
+    violations = []
+    with SessionLocal() as db:
+        purchases = db.query(func.count(models.Purchase.id)).scalar()
+        if purchases != sold:
+            violations.append(f"{purchases} purchases recorded but {sold} reported as sold")
+        for product in db.query(models.Product).order_by(models.Product.id):
+            units_sold = db.query(func.coalesce(func.sum(models.PurchaseItem.quantity), 0))\
+                           .filter(models.PurchaseItem.product_id == product.id).scalar()
+            print(f"  {product.product_id}: sold {units_sold}, remaining {product.available_stocks}")
+            if product.available_stocks < 0:
+                violations.append(f"{product.product_id} stock went negative ({product.available_stocks})")
+            if units_sold + product.available_stocks != args.stock:
+                violations.append(f"{product.product_id} oversold: {units_sold} sold + {product.available_stocks} left != {args.stock}")
+
+    if violations:
+        print("FAILED:\n  " + "\n  ".join(violations))
+        sys.exit(1)
+    print("OK: no overselling")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Upgrading a database created by the first release (float rupees, four tables).
+#
+# Builds that schema exactly as the first release's create_all left it, fills it
+# with --purchases sales, then runs migrations.upgrade and checks the result: no
+# migration left pending, amounts converted to paise as charged, every line's
+# stored amounts matching the formulas, the rollups matching the raw rows,
+# invoices showing what was sold, and a new sale taking an id above every old
+# one. Then runs the upgrade again, which must be a no-op. Exits non-zero if a
+# check fails.
+#
+#   python -m benchmarks.upgrade --purchases 20000
+import argparse
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+import crud, invoices, migrations, reconcile, rollups, schemas
+from database import create_db_engine
+
+# The schema of the first release, as its create_all wrote it on SQLite
+BASELINE_SCHEMA = """
+CREATE TABLE products (
+    id INTEGER NOT NULL, name VARCHAR, product_id VARCHAR, available_stocks INTEGER,
+    price FLOAT, tax_percentage FLOAT, PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX ix_products_name ON products (name);
+CREATE UNIQUE INDEX ix_products_product_id ON products (product_id);
+CREATE INDEX ix_products_id ON products (id);
+CREATE TABLE customers (id INTEGER NOT NULL, email VARCHAR, PRIMARY KEY (id));
+CREATE UNIQUE INDEX ix_customers_email ON customers (email);
+CREATE INDEX ix_customers_id ON customers (id);
+CREATE TABLE purchases (
+    id INTEGER NOT NULL, customer_id INTEGER, total_amount FLOAT, paid_amount FLOAT,
+    purchase_time DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (id),
+    FOREIGN KEY(customer_id) REFERENCES customers (id)
+);
+CREATE INDEX ix_purchases_id ON purchases (id);
+CREATE TABLE purchase_items (
+    id INTEGER NOT NULL, purchase_id INTEGER, product_id INTEGER, quantity INTEGER,
+    price_at_purchase FLOAT, tax_percentage_at_purchase FLOAT, PRIMARY KEY (id),
+    FOREIGN KEY(purchase_id) REFERENCES purchases (id),
+    FOREIGN KEY(product_id) REFERENCES products (id)
+);
+CREATE INDEX ix_purchase_items_id ON purchase_items (id);
+"""
+
+
+def _seed_baseline(path: str, purchases: int, products: int, customers: int, rng: random.Random):
+    """Writes the baseline database; returns {purchase id: total_amount} as the first release stored it."""
+    catalog = [(i + 1, f"Old Product {i}", f"O{i:05d}", 1000, round(rng.uniform(1, 2000), 2),
+                (0.0, 5.0, 12.0, 18.0)[i % 4]) for i in range(products)]
+    totals, items = {}, []
+    for purchase_id in range(1, purchases + 1):
+        total = 0.0
+        for product in rng.sample(catalog, rng.randint(1, 5)):
+            quantity = rng.randint(1, 4)
+            items.append((purchase_id, product[0], quantity, product[4], product[5]))
+            total += product[4] * quantity * (1 + product[5] / 100) # As the first release summed it
+        totals[purchase_id] = total
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+        conn.executemany("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?)", catalog)
+        conn.executemany("INSERT INTO customers (id, email) VALUES (?, ?)",
+                         [(i + 1, f"old{i}@example.com") for i in range(customers)])
+        conn.executemany(
+            "INSERT INTO purchases (id, customer_id, total_amount, paid_amount, purchase_time) "
+            "VALUES (?, ?, ?, ?, datetime('now', ?))",
+            [(purchase_id, rng.randint(1, customers), total, total + rng.randint(0, 500),
+              f"-{rng.randrange(730 * 86400)} seconds") for purchase_id, total in totals.items()])
+        conn.executemany("INSERT INTO purchase_items (purchase_id, product_id, quantity, price_at_purchase, "
+                         "tax_percentage_at_purchase) VALUES (?, ?, ?, ?, ?)", items)
+    return totals, len(items)
+
+
+def _check(engine, totals: dict, rng: random.Random):
+    failures = []
+    still_pending = migrations.pending(engine)
+    if still_pending:
+        failures.append(f"migrations still pending: {still_pending}")
+    with engine.connect() as conn:
+        stored = dict(conn.execute(select(reconcile.purchases.c.id, reconcile.purchases.c.total_amount)).all())
+        converted = sum(stored.get(purchase_id) != math.floor(total * 100 + 0.5) for purchase_id, total in totals.items())
+        if converted:
+            failures.append(f"{converted} purchase totals differ from what was charged")
+        report = reconcile.verify(conn)
+        if report["line_mismatches"]:
+            failures.append(f"{report['line_mismatches']} lines disagree with the formulas, "
+                            f"e.g. {report['line_sample']}")
+        drift = rollups.diff(rollups.compute(conn), rollups.stored(conn))
+        if drift:
+            failures.append(f"rollups differ from the raw rows in {len(drift)} rows")
+
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with SessionLocal() as db:
+        for purchase_id in rng.sample(sorted(totals), min(20, len(totals))):
+            invoice = invoices.build_invoice_for_purchase(crud.get_purchase_details(db, purchase_id))
+            if invoice["total_bill_amount"] != Decimal(math.floor(totals[purchase_id] * 100 + 0.5)) / 100:
+                failures.append(f"invoice {purchase_id} shows {invoice['total_bill_amount']}")
+            if any(not (item["product_name"] or "").startswith("Old Product") for item in invoice["detailed_items"]):
+                failures.append(f"invoice {purchase_id} lost the names of the products sold")
+        purchase = crud.create_purchase(db, 1, 0, [schemas.PurchaseItemCreate(product_id=1, quantity=1)])
+        if purchase.id <= max(totals):
+            failures.append(f"a new sale took id {purchase.id}, not above the old {max(totals)}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--purchases", type=int, default=20000)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--customers", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    path = os.path.join(tempfile.mkdtemp(prefix="pos-upgrade-"), "baseline.db")
+    totals, lines = _seed_baseline(path, args.purchases, args.products, args.customers, rng)
+    engine = create_db_engine(f"sqlite:///{path}")
+    print(f"baseline: {args.purchases} purchases, {lines} lines, {len(migrations.pending(engine))} migrations pending")
+
+    started = time.perf_counter()
+    migrations.upgrade(engine)
+    elapsed = time.perf_counter() - started
+    print(f"upgrade: {elapsed:.2f} s ({args.purchases / elapsed:,.0f} purchases/s)")
+
+    failures = _check(engine, totals, rng)
+    started = time.perf_counter()
+    migrations.upgrade(engine)
+    print(f"upgrade again: {(time.perf_counter() - started) * 1000:.0f} ms")
+    if migrations.pending(engine):
+        failures.append("the second upgrade left migrations pending")
+
+    for failure in failures:
+        print("FAIL:", failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+# Mixed point-of-sale workload: throughput, latency percentiles and SQL
+# statements per request, with JSON results to compare across commits.
+#
+# Seeds a SQLite database with a catalog, customers and purchase history (the
+# history goes in through billing.record_baskets, spread over --days), then runs
+# --clients concurrent clients for --duration seconds, each picking operations
+# by weight: billing, dashboard, invoice views, history lookups, product search
+# and product edits. The app runs in-process behind httpx.ASGITransport, or as a
+# local uvicorn with --target uvicorn. Statements per request come from the
+# app's own /metrics (metrics.py), so both targets report them.
+#
+# Everything is seeded from --seed. With --db, the seeded database is kept at
+# that path and each run works on a copy, so runs on different commits start
+# from the same data.
+#
+#   python -m benchmarks.workload run --clients 20 --duration 30 --json results.json
+#   python -m benchmarks.workload run --target uvicorn --db /tmp/pos-bench.db --json new.json
+#   python -m benchmarks.workload compare old.json new.json --tolerance 0.15
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from benchmarks.common import app_sessions, make_database, percentile, run_server, seed_products
+
+# Operation -> weight in the mix
+WORKLOAD_MIX = {
+    "bill": 30,
+    "dashboard": 10,
+    "invoice": 20,
+    "history": 15,
+    "search": 20,
+    "product_edit": 5,
+}
+SEARCH_PREFIXES = ["B0", "B00", "B001", "bench", "Bench Product 1", "b01"]
+QUERY_GROWTH_ALLOWED = 0.5 # Statements per request; averages move a little with the mix actually run
+
+
+# --- Seeding ---
+
+def seed(path: str, products: int, customers: int, history: int, days: int, rng: random.Random):
+    import billing, crud, schemas
+
+    engine, SessionLocal = make_database(path)
+    with SessionLocal() as db:
+        seed_products(db, products)
+        crud.ensure_drawer(db)
+        start = datetime.now(timezone.utc) - timedelta(days=days)
+        baskets = [schemas.OfflineBasket(
+            customer_email=f"customer{rng.randrange(customers)}@example.com",
+            items=[schemas.BasketLine(product_id=f"B{rng.randrange(products):06d}", quantity=rng.randint(1, 3))
+                   for _ in range(rng.randint(1, 6))],
+            paid_amount="100000",
+            purchase_time=start + timedelta(seconds=rng.randrange(days * 86400)),
+        ) for _ in range(history)]
+        baskets.sort(key=lambda basket: basket.purchase_time)
+        for offset in range(0, len(baskets), 5000):
+            billing.record_baskets(db, baskets[offset:offset + 5000])
+    engine.dispose()
+
+
+def prepare_database(args) -> str:
+    """Path of a freshly seeded database for this run (a copy of --db when given)."""
+    run_path = os.path.join(tempfile.mkdtemp(prefix="pos-workload-"), "workload.db")
+    if args.db and os.path.exists(args.db):
+        shutil.copyfile(args.db, run_path)
+        return run_path
+    seeded_at = time.perf_counter()
+    seed(args.db or run_path, args.products, args.customers, args.history, args.days, random.Random(args.seed))
+    print(f"Seeded {args.products} products, {args.customers} customers and {args.history} purchases "
+          f"in {time.perf_counter() - seeded_at:.1f} s")
+    if args.db:
+        shutil.copyfile(args.db, run_path)
+    return run_path
+
+
+# --- Operations ---
+# Each takes (client, rng, state) and returns the response; state holds what the
+# clients have learned so far (the highest purchase id).
+
+async def op_bill(client, rng, state):
+    lines = rng.randint(1, 8)
+    response = await client.post("/generate_bill/", data={
+        "customer_email": f"customer{rng.randrange(state['customers'])}@example.com",
+        "product_id": [f"B{rng.randrange(state['products']):06d}" for _ in range(lines)],
+        "quantities": [str(rng.randint(1, 3)) for _ in range(lines)],
+        "paid_amount": "100000",
+        "idempotency_key": f"workload-{rng.getrandbits(64):016x}",
+    })
+    state["purchases"] += 1
+    return response
+
+
+async def op_dashboard(client, rng, state):
+    return await client.get("/")
+
+
+async def op_invoice(client, rng, state):
+    return await client.get(f"/purchase_details/{rng.randint(1, state['purchases'])}")
+
+
+async def op_history(client, rng, state):
+    params = {"customer_email": f"customer{rng.randrange(state['customers'])}@example.com"}
+    response = await client.get("/customer_purchases/", params=params)
+    older = re.search(r"after=(\d+)", response.text)
+    if older and rng.random() < 0.5: # Half the lookups page back once
+        response = await client.get("/customer_purchases/", params=dict(params, after=older.group(1)))
+    return response
+
+
+async def op_search(client, rng, state):
+    return await client.get("/products/search", params={"q": rng.choice(SEARCH_PREFIXES)})
+
+
+async def op_product_edit(client, rng, state):
+    index = rng.randrange(state["products"])
+    return await client.post(f"/products/edit/{index + 1}", data={
+        "name": f"Bench Product {index}",
+        "product_id": f"B{index:06d}",
+        "available_stocks": "1000000",
+        "price": f"{10 + rng.randrange(500)}.{rng.randrange(100):02d}",
+        "tax_percentage": rng.choice(["5.0", "12.0", "18.0"]),
+    })
+
+
+OPERATIONS = {
+    "bill": op_bill,
+    "dashboard": op_dashboard,
+    "invoice": op_invoice,
+    "history": op_history,
+    "search": op_search,
+    "product_edit": op_product_edit,
+}
+
+
+# --- Driver ---
+
+async def _client(client, rng, state, deadline: float, measure_from: float, samples: dict, errors: dict,
+                  first_errors: dict):
+    names = list(WORKLOAD_MIX)
+    weights = [WORKLOAD_MIX[name] for name in names]
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            response = await OPERATIONS[name](client, rng, state)
+            error = f"HTTP {response.status_code}: {response.text[:200]}" if response.status_code >= 400 else None
+        except httpx.HTTPError as e:
+            error = repr(e)
+        if started < measure_from: # Warm-up
+            continue
+        if error:
+            errors[name] = errors.get(name, 0) + 1
+            first_errors.setdefault(name, error)
+        else:
+            samples.setdefault(name, []).append(time.perf_counter() - started)
+
+
+def _sql_per_route(metrics_text: str) -> dict:
+    """route -> [statements, requests] from the http_request_sql_statements histogram."""
+    totals = {}
+    for kind, route, value in re.findall(r'^http_request_sql_statements_(sum|count)\{route="([^"]*)"\} (\S+)$',
+                                         metrics_text, re.MULTILINE):
+        totals.setdefault(route, [0.0, 0.0])[0 if kind == "sum" else 1] = float(value)
+    return totals
+
+
+async def drive(client, args, state) -> dict:
+    before = _sql_per_route((await client.get("/metrics")).text)
+    samples, errors, first_errors = {}, {}, {}
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.duration
+    await asyncio.gather(*(_client(client, random.Random(args.seed * 1000 + i), state, deadline, measure_from,
+                                   samples, errors, first_errors) for i in range(args.clients)))
+    elapsed = time.perf_counter() - measure_from
+    after = _sql_per_route((await client.get("/metrics")).text)
+
+    def summary(latencies, failed):
+        return {
+            "requests": len(latencies),
+            "errors": failed,
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    queries = {}
+    for route, (statements, requests) in after.items():
+        base_statements, base_requests = before.get(route, (0.0, 0.0))
+        if route != "/metrics" and requests > base_requests:
+            queries[route] = round((statements - base_statements) / (requests - base_requests), 2)
+    everything = [latency for latencies in samples.values() for latency in latencies]
+    return {
+        "total": summary(everything, sum(errors.values())),
+        "operations": {name: dict(summary(samples.get(name, []), errors.get(name, 0)), weight=WORKLOAD_MIX[name])
+                       for name in WORKLOAD_MIX},
+        "queries_per_request": dict(sorted(queries.items())),
+        "first_errors": first_errors,
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args) -> dict:
+    import sqlalchemy
+
+    db_path = prepare_database(args)
+    state = {"products": args.products, "customers": args.customers, "purchases": max(args.history, 1)}
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    # Pool waits and a low cash drawer are part of the load, not news
+    logging.getLogger("database").setLevel(logging.ERROR)
+    logging.getLogger("sales").setLevel(logging.ERROR)
+
+    if args.target == "uvicorn":
+        server, base_url = run_server(db_path, EMAIL_OUTBOX_WORKER="0", BACKGROUND_JOBS="0",
+                                      DB_POOL_WAIT_WARN_MS="60000")
+        try:
+            async def go():
+                async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+                    return await drive(client, args, state)
+            results = asyncio.run(go())
+        finally:
+            server.terminate()
+            server.wait()
+    else:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        from sqlalchemy.orm import sessionmaker
+        from database import create_async_db_engine, create_db_engine
+
+        os.environ.update(EMAIL_OUTBOX_WORKER="0", BACKGROUND_JOBS="0")
+        url = f"sqlite:///{db_path}"
+        engine, async_engine = create_db_engine(url), create_async_db_engine(url)
+
+        async def go():
+            with app_sessions(sessionmaker(autoflush=False, bind=engine),
+                              async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)) as app:
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://workload", timeout=60) as client:
+                    results = await drive(client, args, state)
+            await async_engine.dispose()
+            return results
+        results = asyncio.run(go())
+        engine.dispose()
+
+    return {
+        "commit": _commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "sqlalchemy": sqlalchemy.__version__,
+                        "platform": platform.platform()},
+        "config": {name: getattr(args, name) for name in ("target", "clients", "duration", "warmup", "products",
+                                                          "customers", "history", "days", "seed")},
+        **results,
+    }
+
+
+def print_results(results: dict):
+    print(f"{'operation':<14} {'req':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    rows = list(results["operations"].items()) + [("TOTAL", results["total"])]
+    for name, row in rows:
+        print(f"{name:<14} {row['requests']:>7} {row['throughput_rps']:>8.1f} {row['p50_ms']:>8.2f} "
+              f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['errors']:>7}")
+    print("\nSQL statements per request:")
+    for route, count in results["queries_per_request"].items():
+        print(f"  {route:<40} {count:>6.2f}")
+    for name, error in results["first_errors"].items():
+        print(f"\nFirst {name} error: {error}")
+
+
+# --- Comparison ---
+
+def compare(old: dict, new: dict, tolerance: float):
+    """Lines describing each metric's change, and the ones that regressed beyond `tolerance`."""
+    lines, regressions = [], []
+
+    def check(label, before, after, higher_is_better, queries=False):
+        if not before:
+            return
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        regressed = after - before > QUERY_GROWTH_ALLOWED if queries else worse > tolerance
+        flag = " REGRESSION" if regressed else ""
+        lines.append(f"  {label:<40} {before:>10.2f} -> {after:>10.2f} ({change:+.0%}){flag}")
+        if flag:
+            regressions.append(label)
+
+    for name in sorted(set(old["operations"]) & set(new["operations"])):
+        before, after = old["operations"][name], new["operations"][name]
+        check(f"{name} req/s", before["throughput_rps"], after["throughput_rps"], True)
+        check(f"{name} p95 ms", before["p95_ms"], after["p95_ms"], False)
+    check("TOTAL req/s", old["total"]["throughput_rps"], new["total"]["throughput_rps"], True)
+    for route in sorted(set(old["queries_per_request"]) & set(new["queries_per_request"])):
+        # Statement counts don't depend on machine load, so they get an absolute bound instead
+        check(f"queries {route}", old["queries_per_request"][route], new["queries_per_request"][route], False,
+              queries=True)
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mixed POS workload benchmark.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Seed, run the workload and report")
+    run_parser.add_argument("--target", choices=["inprocess", "uvicorn"], default="inprocess")
+    run_parser.add_argument("--clients", type=int, default=20)
+    run_parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds")
+    run_parser.add_argument("--warmup", type=float, default=3.0, help="Unmeasured seconds first")
+    run_parser.add_argument("--products", type=int, default=2000)
+    run_parser.add_argument("--customers", type=int, default=5000)
+    run_parser.add_argument("--history", type=int, default=20000, help="Purchases seeded before the run")
+    run_parser.add_argument("--days", type=int, default=90, help="History spread over this many days")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--db", help="Keep the seeded database here and reuse it on later runs")
+    run_parser.add_argument("--json", help="Write the results to this file")
+    compare_parser = commands.add_parser("compare", help="Compare two JSON results; exits 1 on a regression")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative change")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        lines, regressions = compare(old, new, args.tolerance)
+        print(f"{old.get('commit')} -> {new.get('commit')}")
+        print("\n".join(lines))
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}" if regressions else "No regressions")
+        return 1 if regressions else 0
+
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+    return 1 if results["total"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
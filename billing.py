@@ -0,0 +1,279 @@
+# Checkout service shared by the billing form (main.py) and the JSON API (api.py).
+#
+# price_basket validates one basket against catalog entries that are already
+# resolved and prices it, without touching the database. checkout records a
+# single basket; record_baskets records a batch (end-of-day imports from offline
+# tills) one chunk per transaction: the chunk's baskets are checked in order
+# against stock locked up front, and the accepted ones are written with one
+# executemany per table, so a rejected basket doesn't take its chunk with it.
+import logging
+import os
+from collections import ChainMap
+from datetime import datetime, timezone
+from typing import Dict, List, MutableMapping, NamedTuple
+
+from sqlalchemy.orm import Session
+
+import crud, crud_async, invoices, live, low_stock, mailer, models, money, sales, schemas
+from catalog_cache import CatalogEntry
+from database import begin_write
+
+logger = logging.getLogger("billing")
+
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "500")) # Baskets per transaction in record_baskets
+
+INVOICE_SUBJECT = "Your Purchase Invoice"
+
+
+class BasketRejected(Exception):
+    """Raised when a basket can't be billed; nothing has been written.
+
+    `errors` maps a field to a message, in the billing form's keys: customer_email,
+    products, paid_amount, idempotency_key, general, and product_<i> / quantity_<i> /
+    stock_<i> for line i.
+    """
+    def __init__(self, errors: Dict[str, str]):
+        self.errors = errors
+        super().__init__("; ".join(errors.values()))
+
+
+class PricedBasket(NamedTuple):
+    items: List[schemas.PurchaseItemCreate]
+    products: Dict[int, CatalogEntry] # Product.id -> entry, for create_purchase
+    lines: List[invoices.InvoiceLine]
+    invoice: dict
+
+
+def check_idempotency_key(key: str):
+    if key and len(key) > crud.IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise BasketRejected({"idempotency_key": "Idempotency key is too long."})
+
+
+def price_basket(basket: schemas.BasketCreate, entries: Dict[str, CatalogEntry]) -> PricedBasket:
+    """Validates `basket` against `entries` (product_id -> CatalogEntry) and builds its invoice.
+
+    Stock isn't checked here; create_purchase reserves it atomically.
+    """
+    errors = {}
+    if not basket.customer_email:
+        errors["customer_email"] = "Customer email is required."
+    if not basket.items:
+        errors["products"] = "At least one product must be added."
+    if basket.paid_amount <= 0:
+        errors["paid_amount"] = "Paid amount must be positive."
+
+    items, products, lines = [], {}, []
+    for i, line in enumerate(basket.items):
+        product = entries.get(line.product_id)
+        if not product:
+            errors[f"product_{i}"] = f"Product with ID '{line.product_id}' not found."
+            continue
+        if line.quantity <= 0:
+            errors[f"quantity_{i}"] = f"Quantity for {product.name} must be positive."
+            continue
+        items.append(schemas.PurchaseItemCreate(product_id=product.id, quantity=line.quantity))
+        products[product.id] = product
+        lines.append(invoices.InvoiceLine(product.name, product.product_id, line.quantity, product.price,
+                                          product.tax_percentage))
+    if errors:
+        raise BasketRejected(errors)
+
+    invoice = invoices.build_invoice(basket.customer_email, lines, basket.paid_amount)
+    if invoice["balance_to_return"] < 0:
+        raise BasketRejected({"paid_amount": f"Paid amount is less than total bill. "
+                                             f"Remaining: {abs(invoice['balance_to_return']):.2f}"})
+    return PricedBasket(items, products, lines, invoice)
+
+
+def _stock_errors(failures: List[dict], lines: List[invoices.InvoiceLine]) -> Dict[str, str]:
+    return {f"stock_{failure['line']}": f"Not enough stock for {lines[failure['line']].product_name}. "
+                                        f"Available: {failure['available']}, Requested: {failure['requested']}"
+            for failure in failures}
+
+
+async def stored_invoice(db, purchase_id: int):
+    """The invoice of a recorded purchase, from the cache or the database; None if there is no such purchase."""
+    invoice = invoices.invoice_cache.get(purchase_id)
+    if invoice is None:
+        purchase = await crud_async.get_purchase_details(db, purchase_id)
+        if not purchase:
+            return None
+        invoice = invoices.build_invoice_for_purchase(purchase)
+        invoices.invoice_cache.put(invoice)
+    return invoice
+
+
+async def checkout(db, basket: schemas.BasketCreate):
+    """Records one basket and queues its invoice email. Returns (invoice, replayed).
+
+    `replayed` is True when the basket's idempotency key was already used: the
+    invoice is the original purchase's and nothing new was written.
+    Raises BasketRejected.
+    """
+    key = basket.idempotency_key
+    check_idempotency_key(key)
+    if key:
+        existing_purchase_id = await crud_async.get_idempotent_purchase_id(db, key)
+        if existing_purchase_id is not None:
+            return await stored_invoice(db, existing_purchase_id), True
+
+    # Catalog data comes from the cache (one IN query for any misses)
+    entries = await crud_async.get_catalog_products_by_product_id_strs(db, [line.product_id for line in basket.items])
+    priced = price_basket(basket, entries)
+
+    # Get or create customer (committed together with the purchase)
+    customer = await crud_async.get_customer_by_email(db, basket.customer_email)
+    if not customer:
+        customer = await crud_async.create_customer(db, basket.customer_email, commit=False)
+
+    try:
+        purchase = await crud_async.create_purchase(db, customer.id, basket.paid_amount, priced.items,
+                                                    products=priced.products, idempotency_key=key)
+    except crud.DuplicateSubmissionError as e:
+        # A concurrent submission with the same key won; nothing was written by this one
+        return await stored_invoice(db, e.purchase_id), True
+    except crud.InsufficientStockError as e:
+        raise BasketRejected(_stock_errors(e.failures, priced.lines))
+
+    invoice = invoices.stamp_invoice(priced.invoice, purchase)
+    invoices.invoice_cache.put(invoice)
+
+    # Queue the invoice in the outbox; mailer.OutboxWorker sends it off the request path
+    await crud_async.enqueue_email(db, mailer.invoice_recipients(basket.customer_email), INVOICE_SUBJECT,
+                                   invoices.render_invoice_email(invoice), purchase_id=purchase.id)
+    mailer.notify_outbox()
+    return invoice, False
+
+
+# --- Batches ---
+
+def _sale_time(basket: schemas.OfflineBasket) -> datetime:
+    # UTC, like the purchase_time server default; a time without a zone is taken as UTC
+    if basket.purchase_time is None:
+        return datetime.now(timezone.utc)
+    if basket.purchase_time.tzinfo is None:
+        return basket.purchase_time.replace(tzinfo=timezone.utc)
+    return basket.purchase_time.astimezone(timezone.utc)
+
+
+def _record_chunk(db: Session, baskets: List[schemas.OfflineBasket], first_index: int,
+                  used_keys: MutableMapping[str, int], use_drawer: bool, send_invoices: bool) -> List[schemas.BasketResult]:
+    """Checks every basket against stock (and drawer) locked up front, then writes the accepted ones in bulk."""
+    begin_write(db)
+    entries = crud.get_catalog_products_by_product_id_strs(
+        db, list({line.product_id for basket in baskets for line in basket.items}))
+    keys = [basket.idempotency_key for basket in baskets if basket.idempotency_key]
+    known_keys = crud.get_idempotent_purchase_ids(db, keys) if keys else {}
+    customer_ids = crud.get_customer_ids_by_emails(db, [basket.customer_email for basket in baskets])
+    stock = crud.lock_stock_levels(db, [entry.id for entry in entries.values()])
+    tracked = crud.CASH_DRAWER_TRACKING and use_drawer
+    drawer_before = drawer = crud.get_drawer_counts(db, for_update=True) if tracked else {}
+
+    results = []
+    purchases = []   # Rows for crud.insert_purchases
+    accepted = []    # (basket, invoice, result) per entry of `purchases`
+    planned_keys = {} # Idempotency key -> position in `purchases`
+    repeats = []     # (result, position) for keys repeated within this chunk
+    sold = {}        # Product.id -> quantity
+    for index, basket in enumerate(baskets, start=first_index):
+        key = basket.idempotency_key
+        if key in planned_keys:
+            result = schemas.BasketResult(index=index, status="replayed")
+            repeats.append((result, planned_keys[key]))
+            results.append(result)
+            continue
+        replayed_purchase_id = (used_keys.get(key) or known_keys.get(key)) if key else None
+        if replayed_purchase_id is not None:
+            results.append(schemas.BasketResult(index=index, status="replayed", purchase_id=replayed_purchase_id))
+            continue
+        try:
+            check_idempotency_key(key)
+            priced = price_basket(basket, entries)
+        except BasketRejected as e:
+            results.append(schemas.BasketResult(index=index, status="rejected", errors=e.errors))
+            continue
+
+        requested = sales.requested_quantities(priced.items)
+        if any(stock.get(product_id, 0) < qty for product_id, qty in requested.items()):
+            failures = sales.stock_failures(priced.items, requested, stock)
+            results.append(schemas.BasketResult(index=index, status="rejected",
+                                                errors=_stock_errors(failures, priced.lines)))
+            continue
+        for product_id, qty in requested.items():
+            stock[product_id] -= qty
+            sold[product_id] = sold.get(product_id, 0) + qty
+
+        item_rows, total_minor, tax_minor = sales.purchase_item_rows(priced.items, priced.products)
+        change_given, drawer = sales.settle_drawer(drawer, money.from_minor(total_minor), basket.paid_amount, tracked)
+        if key:
+            planned_keys[key] = len(purchases)
+        purchases.append({"customer_id": None, "paid_amount": basket.paid_amount, "purchase_time": _sale_time(basket),
+                          "item_rows": item_rows, "total_minor": total_minor, "tax_minor": tax_minor,
+                          "change": change_given, "idempotency_key": key})
+        result = schemas.BasketResult(index=index, status="created",
+                                      total_amount=priced.invoice["total_bill_amount"],
+                                      balance_to_return=priced.invoice["balance_to_return"])
+        accepted.append((basket, priced.invoice, result))
+        results.append(result)
+
+    if not purchases:
+        return results
+    customer_ids.update(crud.create_customers(
+        db, [basket.customer_email for basket, _, _ in accepted if basket.customer_email not in customer_ids]))
+    for purchase, (basket, _, _) in zip(purchases, accepted):
+        purchase["customer_id"] = customer_ids[basket.customer_email]
+    purchase_ids = crud.insert_purchases(db, purchases)
+    if not crud.reserve_stock_totals(db, sold):
+        raise RuntimeError("stock changed while the chunk was being recorded")
+    low_stock.mark(db, sold)
+    live.publish_on_commit(db, "sales")
+    live.publish_on_commit(db, "products", sold)
+    drawer_rows = sales.drawer_update_rows(drawer_before, drawer)
+    if drawer_rows:
+        db.execute(sales.drawer_update_statement(), drawer_rows)
+
+    for purchase_id, purchase, (basket, invoice, result) in zip(purchase_ids, purchases, accepted):
+        result.purchase_id = purchase_id
+        if purchase["idempotency_key"]:
+            used_keys[purchase["idempotency_key"]] = purchase_id
+        if send_invoices:
+            stand_in = models.Purchase(id=purchase_id, purchase_time=purchase["purchase_time"],
+                                       change_notes=sales.change_notes(purchase["change"]))
+            invoices.stamp_invoice(invoice, stand_in)
+            mailer.enqueue_email(db, mailer.invoice_recipients(basket.customer_email), INVOICE_SUBJECT,
+                               invoices.render_invoice_email(invoice), purchase_id=purchase_id, commit=False)
+    for result, position in repeats:
+        result.purchase_id = purchase_ids[position]
+    return results
+
+
+def record_baskets(db: Session, baskets: List[schemas.OfflineBasket], chunk_size: int = None,
+                   use_drawer: bool = False, send_invoices: bool = False) -> List[schemas.BasketResult]:
+    """Records `baskets` in order, one transaction per `chunk_size` baskets; one result per basket.
+
+    Within a chunk, stock is locked and each basket is checked against what the
+    baskets before it took, so a basket that doesn't fit is rejected on its own.
+    If a chunk can't be committed, all of its baskets are reported as rejected;
+    earlier chunks stay committed.
+    """
+    chunk_size = chunk_size or BATCH_CHUNK_SIZE
+    results = []
+    used_keys = {} # Idempotency key -> purchase id, for repeats within the batch
+    for start in range(0, len(baskets), chunk_size):
+        chunk = baskets[start:start + chunk_size]
+        chunk_keys = {}
+        try:
+            chunk_results = _record_chunk(db, chunk, start, ChainMap(chunk_keys, used_keys), use_drawer, send_invoices)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.exception("Failed to record baskets %d-%d", start, start + len(chunk) - 1)
+            chunk_results = [schemas.BasketResult(index=index, status="rejected",
+                                                  errors={"general": f"Failed to record purchase: {e}"})
+                             for index in range(start, start + len(chunk))]
+        else:
+            used_keys.update(chunk_keys)
+        results.extend(chunk_results)
+    if send_invoices:
+        mailer.notify_outbox()
+    return results
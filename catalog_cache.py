@@ -0,0 +1,192 @@
+# In-process cache of the product catalog (names, ids, prices and tax rates).
+#
+# Stock is deliberately NOT cached: entries carry no available_stocks, and the
+# authoritative stock check is the conditional UPDATE in crud.reserve_stock, so a
+# cached entry can never approve an out-of-stock sale.
+#
+# Invalidation:
+#   * crud's product create/update/delete call `catalog.invalidate()` after commit
+#     (write-through for this process) and bump CatalogVersion in the same transaction;
+#   * other workers compare their cached version with CatalogVersion at most once
+#     every CATALOG_VERSION_CHECK_INTERVAL seconds and drop everything when it moved.
+import bisect
+import os
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "300")) # Seconds an entry may be served
+CATALOG_CACHE_MAX_ENTRIES = int(os.getenv("CATALOG_CACHE_MAX_ENTRIES", "50000")) # LRU bound
+CATALOG_VERSION_CHECK_INTERVAL = float(os.getenv("CATALOG_VERSION_CHECK_INTERVAL", "1.0")) # 0 = every lookup
+
+KEY_FIELDS = ("id", "product_id", "name")
+
+
+class CatalogEntry(NamedTuple):
+    id: int
+    product_id: str
+    name: str
+    price: Decimal
+    tax_percentage: Decimal
+
+    @classmethod
+    def from_product(cls, product):
+        return cls(product.id, product.product_id, product.name, product.price, product.tax_percentage)
+
+
+class CatalogCache:
+    def __init__(self, ttl: float = CATALOG_CACHE_TTL, max_entries: int = CATALOG_CACHE_MAX_ENTRIES,
+                 version_check_interval: float = CATALOG_VERSION_CHECK_INTERVAL):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version_check_interval = version_check_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # id -> (CatalogEntry, expires_at), oldest first
+        self._keys = {field: {} for field in KEY_FIELDS[1:]} # product_id / name -> id
+        self._search_index = None # (PrefixIndex, expires_at)
+        self._version = None
+        self._version_checked_at = float("-inf")
+        self._generation = 0 # Bumped on every clear; stops loads that raced an invalidation from being stored
+        self.hits = 0
+        self.misses = 0
+
+    # --- Cross-worker staleness ---
+
+    def version_check_due(self) -> bool:
+        return time.monotonic() - self._version_checked_at >= self.version_check_interval
+
+    def observe_version(self, version: int):
+        """Records the database catalog version, dropping everything if it changed."""
+        with self._lock:
+            if version != self._version:
+                self._clear()
+                self._version = version
+            self._version_checked_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            self._version = None
+            self._version_checked_at = float("-inf")
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    # --- Lookups ---
+
+    def get(self, field: str, key) -> Optional[CatalogEntry]:
+        with self._lock:
+            entry = self._get(field, key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def get_many(self, field: str, keys: Iterable) -> Tuple[Dict, List]:
+        """Returns ({key: entry} for cached keys, [keys that missed])."""
+        found, missing = {}, []
+        with self._lock:
+            for key in set(keys):
+                entry = self._get(field, key)
+                if entry is None:
+                    missing.append(key)
+                else:
+                    found[key] = entry
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put(self, entry: CatalogEntry, generation: int = None):
+        with self._lock:
+            if generation is None or generation == self._generation:
+                self._put(entry)
+
+    def get_search_index(self) -> Optional["PrefixIndex"]:
+        with self._lock:
+            if self._search_index is None or self._search_index[1] < time.monotonic():
+                return None
+            return self._search_index[0]
+
+    def put_search_index(self, index: "PrefixIndex", generation: int = None):
+        with self._lock:
+            if generation is None or generation == self._generation:
+                self._search_index = (index, time.monotonic() + self.ttl)
+
+    # --- Internals (call with the lock held) ---
+
+    def _get(self, field: str, key):
+        product_pk = key if field == "id" else self._keys[field].get(key)
+        cached = self._entries.get(product_pk)
+        if cached is None:
+            return None
+        entry, expires_at = cached
+        if expires_at < time.monotonic():
+            self._evict(product_pk)
+            return None
+        self._entries.move_to_end(product_pk)
+        return entry
+
+    def _put(self, entry: CatalogEntry):
+        if entry.id in self._entries:
+            self._evict(entry.id)
+        self._entries[entry.id] = (entry, time.monotonic() + self.ttl)
+        self._keys["product_id"][entry.product_id] = entry.id
+        self._keys["name"][entry.name] = entry.id
+        while len(self._entries) > self.max_entries:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, product_pk: int):
+        entry, _ = self._entries.pop(product_pk)
+        for field in KEY_FIELDS[1:]:
+            if self._keys[field].get(getattr(entry, field)) == product_pk:
+                del self._keys[field][getattr(entry, field)]
+
+    def _clear(self):
+        self._generation += 1
+        self._entries.clear()
+        for keys in self._keys.values():
+            keys.clear()
+        self._search_index = None
+
+
+class PrefixIndex:
+    """Sorted, case-insensitive index over product_id and name for autocomplete.
+
+    Built once per catalog version from the whole catalog; a lookup is a bisect
+    plus a walk over the matching run, so it stays fast at tens of thousands of SKUs.
+    """
+
+    def __init__(self, entries: Iterable[CatalogEntry]):
+        self._entries = {}
+        keys = []
+        for entry in entries:
+            self._entries[entry.id] = entry
+            keys.append((entry.product_id.casefold(), entry.id))
+            keys.append((entry.name.casefold(), entry.id))
+        keys.sort()
+        self._keys = keys
+
+    def __len__(self):
+        return len(self._entries)
+
+    def search(self, prefix: str, limit: int = 10) -> List[CatalogEntry]:
+        prefix = prefix.casefold()
+        matches = []
+        seen = set()
+        position = bisect.bisect_left(self._keys, (prefix,))
+        while position < len(self._keys) and len(matches) < limit:
+            key, entry_id = self._keys[position]
+            if not key.startswith(prefix):
+                break
+            if entry_id not in seen:
+                seen.add(entry_id)
+                matches.append(self._entries[entry_id])
+            position += 1
+        return matches
+
+
+catalog = CatalogCache()
@@ -0,0 +1,165 @@
+# Change calculation against what is actually in the cash drawer.
+#
+# Amounts are handled in paise. Notes and coins are whole rupees, so any paise in
+# the balance (and any rupees the drawer can't make up) are reported as a
+# remainder instead of being silently dropped.
+#
+# The fewest-notes breakdown under limited counts is a bounded knapsack. A
+# ChangeTable solves it once for every amount up to a limit for one drawer state;
+# each lookup afterwards is a walk over the denominations. The limit is at most
+# CHANGE_TABLE_MAX_AMOUNT (larger balances peel off big notes first), which keeps
+# a cold solve to a few milliseconds. Tables are keyed by the counts that matter
+# below the limit (a denomination can't be used more than limit // d times), so
+# a sale that only moves notes the drawer holds plenty of reuses the table.
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, NamedTuple, Tuple
+
+# Denominations available in the shop
+DENOMINATIONS = [2000, 500, 200, 100, 50, 20, 10, 5, 2, 1] # Example in INR
+
+CHANGE_TABLE_AMOUNT = int(os.getenv("CHANGE_TABLE_AMOUNT", "125")) # Smallest table limit in rupees; it doubles as needed
+CHANGE_TABLE_MAX_AMOUNT = int(os.getenv("CHANGE_TABLE_MAX_AMOUNT", "1000")) # Above this, big notes are peeled off first
+CHANGE_TABLE_CACHE_SIZE = int(os.getenv("CHANGE_TABLE_CACHE_SIZE", "16"))
+
+_UNREACHABLE = float("inf")
+
+
+class ChangeResult(NamedTuple):
+    notes: Dict[int, int] # denomination -> count, largest first
+    remainder_paise: int  # Part of the balance the drawer could not cover
+
+    @property
+    def remainder(self) -> float:
+        return self.remainder_paise / 100
+
+
+class ChangeTable:
+    """Fewest-notes breakdown of every amount 0..limit (rupees) for one drawer state."""
+
+    def __init__(self, counts: Dict[int, int], limit: int):
+        self.counts = dict(counts)
+        self.limit = limit
+        self._layers: List[Tuple[int, List[int]]] = [] # (denomination, notes of it used for each amount)
+        best = [0] + [_UNREACHABLE] * limit
+        for denom in sorted(d for d, count in counts.items() if count > 0 and d <= limit):
+            best, take = self._add_denomination(best, denom, counts[denom])
+            self._layers.append((denom, take))
+        self._best = best
+
+    def _add_denomination(self, best, denom: int, count: int):
+        # new[r + j*d] = min over j-count <= k <= j of best[r + k*d] + (j - k): a sliding
+        # window minimum per residue class, O(limit) per denomination.
+        limit = self.limit
+        new_best = [_UNREACHABLE] * (limit + 1)
+        take = [0] * (limit + 1)
+        for residue in range(min(denom, limit + 1)):
+            window = deque() # (best[r + k*d] - k, k), increasing by value
+            for j, amount in enumerate(range(residue, limit + 1, denom)):
+                value = best[amount] - j
+                while window and window[-1][0] >= value:
+                    window.pop()
+                window.append((value, j))
+                while window[0][1] < j - count:
+                    window.popleft()
+                smallest, k = window[0]
+                if smallest != _UNREACHABLE:
+                    new_best[amount] = smallest + j
+                    take[amount] = j - k
+        return new_best, take
+
+    def feasible(self, amount: int) -> bool:
+        return amount <= self.limit and self._best[amount] != _UNREACHABLE
+
+    def notes_for(self, amount: int) -> Dict[int, int]:
+        """Breakdown of exactly `amount` rupees; call only when feasible(amount)."""
+        notes = {}
+        for denom, take in reversed(self._layers):
+            used = take[amount]
+            if used:
+                notes[denom] = used
+                amount -= used * denom
+        return notes
+
+    def best_effort(self, amount: int) -> Tuple[int, Dict[int, int]]:
+        """Largest amount <= `amount` the drawer can pay out exactly, and its breakdown."""
+        payable = min(amount, self.limit)
+        while payable > 0 and self._best[payable] == _UNREACHABLE:
+            payable -= 1
+        return payable, self.notes_for(payable)
+
+
+class ChangeEngine:
+    """Computes change from drawer counts, reusing a table while the drawer is unchanged."""
+
+    def __init__(self, table_amount: int = CHANGE_TABLE_AMOUNT, cache_size: int = CHANGE_TABLE_CACHE_SIZE):
+        self.table_amount = table_amount
+        self.cache_size = cache_size
+        self._tables = OrderedDict() # (limit, counts usable below it) -> ChangeTable
+        self._lock = threading.Lock()
+
+    def table(self, counts: Dict[int, int], amount: int) -> ChangeTable:
+        amount = min(amount, sum(d * c for d, c in counts.items() if c > 0)) # Can't pay out more than the drawer holds
+        limit = self.table_amount
+        while limit < amount:
+            limit *= 2
+        state = (limit, tuple(sorted((d, min(c, limit // d)) for d, c in counts.items() if c > 0 and d <= limit)))
+        with self._lock:
+            table = self._tables.get(state)
+            if table is not None:
+                self._tables.move_to_end(state)
+                return table
+        table = ChangeTable(dict(state[1]), limit)
+        with self._lock:
+            self._tables[state] = table
+            self._tables.move_to_end(state)
+            while len(self._tables) > self.cache_size:
+                self._tables.popitem(last=False)
+        return table
+
+    def make_change(self, balance_paise: int, counts: Dict[int, int] = None) -> ChangeResult:
+        """Fewest notes for `balance_paise` from `counts` (unlimited when None)."""
+        if balance_paise <= 0:
+            return ChangeResult({}, 0)
+        rupees = balance_paise // 100
+        if counts is None:
+            notes = unlimited_breakdown(rupees)
+            paid = rupees
+        else:
+            peeled, rest = _peel_large_notes(rupees, counts)
+            peeled_value = sum(d * c for d, c in peeled.items())
+            paid, notes = self.table(rest, rupees - peeled_value).best_effort(rupees - peeled_value)
+            for denom, count in peeled.items():
+                notes[denom] = notes.get(denom, 0) + count
+            paid += peeled_value
+        notes = {d: notes[d] for d in sorted(notes, reverse=True)}
+        return ChangeResult(notes, balance_paise - paid * 100)
+
+
+def _peel_large_notes(rupees: int, counts: Dict[int, int]):
+    # Keeps the DP table bounded for very large balances: pay everything above
+    # CHANGE_TABLE_MAX_AMOUNT with the largest notes available, then solve the rest exactly.
+    peeled, rest = {}, dict(counts)
+    for denom in sorted(counts, reverse=True):
+        excess = rupees - CHANGE_TABLE_MAX_AMOUNT
+        if excess <= 0:
+            break
+        used = min(rest[denom], -(-excess // denom), rupees // denom)
+        if used > 0:
+            peeled[denom] = used
+            rest[denom] -= used
+            rupees -= used * denom
+    return peeled, rest
+
+
+def unlimited_breakdown(rupees: int, denominations: List[int] = DENOMINATIONS) -> Dict[int, int]:
+    # With unlimited notes the shop's denominations are canonical, so greedy is optimal.
+    notes = {}
+    for denom in sorted(denominations, reverse=True):
+        if rupees >= denom:
+            notes[denom], rupees = divmod(rupees, denom)
+    return notes
+
+
+engine = ChangeEngine()
@@ -1,6 +1,30 @@
-from sqlalchemy.orm import Session
-import models, schemas
-from typing import List
+import os
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import Integer, bindparam, delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload
+import change, live, low_stock, models, money, rollups, sales, schemas
+from catalog_cache import CatalogEntry, PrefixIndex, catalog
+from sales import InsufficientStockError
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+# Cash drawer: change is given from the counts in drawer_denominations and the
+# drawer is updated in the purchase transaction. With tracking off, change is
+# computed as if every note were available and the drawer is left alone.
+CASH_DRAWER_TRACKING = os.getenv("CASH_DRAWER_TRACKING", "1") == "1"
+DRAWER_INITIAL_COUNT = int(os.getenv("DRAWER_INITIAL_COUNT", "20")) # Per denomination, when the drawer is first set up
+
+# Bill submissions carrying an idempotency key are remembered this long
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+
+
+class DuplicateSubmissionError(Exception):
+    """Raised by create_purchase when its idempotency key was already used; nothing was written."""
+    def __init__(self, purchase_id: int):
+        self.purchase_id = purchase_id
+        super().__init__(f"already recorded as purchase {purchase_id}")
 
 def get_product(db: Session, product_id: int):
     return db.query(models.Product).filter(models.Product.id == product_id).first()
@@ -11,77 +35,559 @@ def get_product_by_name(db: Session, name: str):
 def get_product_by_product_id_str(db: Session, product_id_str: str):
     return db.query(models.Product).filter(models.Product.product_id == product_id_str).first()
 
+def get_products_by_product_id_strs(db: Session, product_id_strs: List[str]):
+    # Resolve a whole basket in one IN (...) query, keyed by product_id string
+    unique_ids = set(product_id_strs)
+    if not unique_ids:
+        return {}
+    products = db.query(models.Product).filter(models.Product.product_id.in_(unique_ids)).all()
+    return {product.product_id: product for product in products}
+
+def get_products_by_ids(db: Session, ids) -> Dict[int, models.Product]:
+    if not ids:
+        return {}
+    return {product.id: product for product in db.query(models.Product).filter(models.Product.id.in_(set(ids)))}
+
 def get_products(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Product).offset(skip).limit(limit).all()
 
+# --- Catalog cache (names, ids, prices, tax; never stock) ---
+
+def get_catalog_version(db: Session) -> int:
+    return db.query(models.CatalogVersion.version).filter(models.CatalogVersion.id == 1).scalar() or 0
+
+def bump_catalog_version(db: Session):
+    # Runs in the caller's transaction, so other workers only see the new version once the change is committed
+    bumped = db.execute(
+        update(models.CatalogVersion).where(models.CatalogVersion.id == 1).values(version=models.CatalogVersion.version + 1)
+    ).rowcount
+    if not bumped:
+        db.add(models.CatalogVersion(id=1, version=1))
+        db.flush()
+
+def _check_catalog_version(db: Session):
+    if catalog.version_check_due():
+        catalog.observe_version(get_catalog_version(db))
+
+def get_catalog_product(db: Session, field: str, key) -> Optional[CatalogEntry]:
+    # field is "id", "product_id" or "name"
+    _check_catalog_version(db)
+    generation = catalog.generation
+    entry = catalog.get(field, key)
+    if entry is None:
+        product = db.query(models.Product).filter(getattr(models.Product, field) == key).first()
+        if product:
+            entry = CatalogEntry.from_product(product)
+            catalog.put(entry, generation)
+    return entry
+
+def get_catalog_products_by_product_id_strs(db: Session, product_id_strs: List[str]) -> Dict[str, CatalogEntry]:
+    _check_catalog_version(db)
+    generation = catalog.generation
+    found, missing = catalog.get_many("product_id", product_id_strs)
+    if missing:
+        for product_id_str, product in get_products_by_product_id_strs(db, missing).items():
+            found[product_id_str] = CatalogEntry.from_product(product)
+            catalog.put(found[product_id_str], generation)
+    return found
+
+def _iter_catalog_entries(db: Session, batch_size: int = 5000):
+    # Only the cached columns, streamed in batches, for building the search index
+    rows = db.query(models.Product.id, models.Product.product_id, models.Product.name,
+                    models.Product.price, models.Product.tax_percentage).yield_per(batch_size)
+    return (CatalogEntry(*row) for row in rows)
+
+def search_catalog(db: Session, prefix: str, limit: int = 10) -> List[CatalogEntry]:
+    # Case-insensitive prefix match on product_id or name, served from an in-memory sorted index
+    _check_catalog_version(db)
+    generation = catalog.generation
+    index = catalog.get_search_index()
+    if index is None:
+        index = PrefixIndex(_iter_catalog_entries(db))
+        catalog.put_search_index(index, generation)
+    return index.search(prefix, limit)
+
+def get_products_page(db: Session, after_id: int = None, before_id: int = None, limit: int = 50):
+    """Keyset page of products ordered by id.
+
+    Returns (products, has_more): pass the last id as after_id for the next page,
+    or the first id as before_id for the previous one.
+    """
+    query = db.query(models.Product)
+    if before_id is not None:
+        products = query.filter(models.Product.id < before_id).order_by(models.Product.id.desc()).limit(limit + 1).all()
+        has_more = len(products) > limit
+        return list(reversed(products[:limit])), has_more
+    if after_id is not None:
+        query = query.filter(models.Product.id > after_id)
+    products = query.order_by(models.Product.id).limit(limit + 1).all()
+    return products[:limit], len(products) > limit
+
+def keyset_cursors(rows: list, has_more: bool, after_id: int = None, before_id: int = None):
+    """(next_after, prev_before) ids for the links around a keyset page; None where there is no such page."""
+    if before_id is not None:
+        return (rows[-1].id if rows else None), (rows[0].id if rows and has_more else None)
+    return (rows[-1].id if rows and has_more else None), (rows[0].id if rows and after_id is not None else None)
+
 def create_product(db: Session, product: schemas.ProductCreate):
     db_product = models.Product(**product.dict())
     db.add(db_product)
+    db.flush()
+    low_stock.refresh(db, [db_product.id])
+    bump_catalog_version(db)
     db.commit()
+    catalog.invalidate()
     db.refresh(db_product)
+    live.publish("products", [db_product.id])
     return db_product
 
 def update_product(db: Session, product_id: int, product: schemas.ProductCreate):
     db_product = get_product(db, product_id)
     if db_product:
-        for key, value in product.dict().items():
+        for key, value in product.dict(exclude_unset=True).items(): # An omitted reorder_level is kept
             setattr(db_product, key, value)
+        db.flush()
+        low_stock.refresh(db, [product_id])
+        bump_catalog_version(db)
         db.commit()
+        catalog.invalidate()
         db.refresh(db_product)
+        live.publish("products", [product_id])
     return db_product
 
 def delete_product(db: Session, product_id: int):
     db_product = get_product(db, product_id)
     if db_product:
         db.delete(db_product)
+        db.flush()
+        low_stock.refresh(db, [product_id])
+        bump_catalog_version(db)
         db.commit()
+        catalog.invalidate()
+        live.publish("products", [product_id])
     return db_product
 
+# --- Bulk product import / export (product_io.py) ---
+
+def get_product_ids_by_product_id_strs(db: Session, product_id_strs: List[str]) -> Dict[str, int]:
+    rows = db.execute(select(models.Product.product_id, models.Product.id)
+                      .where(models.Product.product_id.in_(set(product_id_strs))))
+    return {product_id_str: product_id for product_id_str, product_id in rows}
+
+def get_product_id_strs_by_names(db: Session, names: List[str]) -> Dict[str, str]:
+    rows = db.execute(select(models.Product.name, models.Product.product_id).where(models.Product.name.in_(set(names))))
+    return {name: product_id_str for name, product_id_str in rows}
+
+def _product_update_statement():
+    products_table = models.Product.__table__
+    return (
+        update(products_table)
+        .where(products_table.c.id == bindparam("b_id"))
+        .values(name=bindparam("b_name"), available_stocks=bindparam("b_available_stocks"),
+                price=bindparam("b_price"), tax_percentage=bindparam("b_tax_percentage"),
+                # NULL = the file has no reorder_level column: keep the product's
+                reorder_level=func.coalesce(bindparam("b_reorder_level", type_=Integer), products_table.c.reorder_level))
+    )
+
+def upsert_products(db: Session, products: List[schemas.ProductCreate], existing: Dict[str, int]):
+    """Inserts or updates `products` by product_id in one transaction; returns (created, updated).
+
+    `existing` maps the product_ids already in the database to Product.id
+    (get_product_ids_by_product_id_strs). One executemany per statement.
+    A reorder_level that wasn't given (not in the file) leaves an existing product's alone.
+    """
+    inserts, updates = [], []
+    for product in products:
+        if product.product_id in existing:
+            values = {"reorder_level": None, **product.dict(exclude_unset=True)}
+            updates.append({"b_id": existing[product.product_id], **{f"b_{key}": value for key, value in values.items()
+                                                                     if key != "product_id"}})
+        else:
+            inserts.append(product.dict())
+    try:
+        if inserts:
+            db.execute(insert(models.Product.__table__), inserts)
+        if updates:
+            db.execute(_product_update_statement(), updates)
+        # Low-stock list: every updated product, and the new ones that start out low
+        changed = [row["b_id"] for row in updates]
+        new_low = [values["product_id"] for values in inserts
+                   if 0 < values["reorder_level"] and values["available_stocks"] <= values["reorder_level"]]
+        if new_low:
+            changed.extend(get_product_ids_by_product_id_strs(db, new_low).values())
+        low_stock.refresh(db, changed)
+        bump_catalog_version(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    catalog.invalidate()
+    live.publish("products", [row["b_id"] for row in updates])
+    return len(inserts), len(updates)
+
+def iter_products(db: Session, batch_size: int = 1000):
+    # Streamed through a server-side cursor (where the driver has one), batch_size rows at a time
+    stmt = select(models.Product.product_id, models.Product.name, models.Product.available_stocks,
+                  models.Product.price, models.Product.tax_percentage,
+                  models.Product.reorder_level).order_by(models.Product.id)
+    return db.execute(stmt, execution_options={"yield_per": batch_size})
+
 def get_customer_by_email(db: Session, email: str):
     return db.query(models.Customer).filter(models.Customer.email == email).first()
 
-def create_customer(db: Session, email: str):
+def get_customer_ids_by_emails(db: Session, emails: List[str]) -> Dict[str, int]:
+    rows = db.execute(select(models.Customer.email, models.Customer.id).where(models.Customer.email.in_(set(emails))))
+    return {email: customer_id for email, customer_id in rows}
+
+def create_customer(db: Session, email: str, commit: bool = True):
     db_customer = models.Customer(email=email)
     db.add(db_customer)
-    db.commit()
-    db.refresh(db_customer)
+    if commit:
+        db.commit()
+        db.refresh(db_customer)
+    else:
+        db.flush() # Assign an id but leave the transaction open for the caller
     return db_customer
 
-def create_purchase(db: Session, customer_id: int, total_amount: float, paid_amount: float, items: List[schemas.PurchaseItemCreate]):
-    db_purchase = models.Purchase(
-        customer_id=customer_id,
-        total_amount=total_amount,
-        paid_amount=paid_amount
-    )
-    db.add(db_purchase)
-    db.commit()
-    db.refresh(db_purchase)
+def _get_stock_levels(db: Session, product_ids) -> Dict[int, int]:
+    rows = db.query(models.Product.id, models.Product.available_stocks).filter(models.Product.id.in_(product_ids)).all()
+    return {product_id: stock for product_id, stock in rows}
 
-    for item_data in items:
-        product = get_product(db, item_data.product_id)
-        if product:
-            db_purchase_item = models.PurchaseItem(
-                purchase_id=db_purchase.id,
-                product_id=item_data.product_id,
-                quantity=item_data.quantity,
-                price_at_purchase=product.price,
-                tax_percentage_at_purchase=product.tax_percentage
-            )
-            db.add(db_purchase_item)
-            # Decrease product stocks
-            product.available_stocks -= item_data.quantity
+def _reserve_stock_conditional(db: Session, requested: Dict[int, int]) -> bool:
+    stmt = sales.reserve_stock_statement()
+    rows = [{"b_id": product_id, "b_qty": qty} for product_id, qty in requested.items()]
+    if not rows:
+        return True
+    if db.get_bind().dialect.supports_sane_multi_rowcount:
+        # One executemany; the summed rowcount tells us whether every line was reserved
+        return db.execute(stmt, rows).rowcount == len(rows)
+    for row in rows:
+        if db.execute(stmt, row).rowcount != 1:
+            return False
+    return True
+
+def _reserve_stock_row_lock(db: Session, requested: Dict[int, int]) -> bool:
+    locked = db.query(models.Product).filter(models.Product.id.in_(requested)).order_by(models.Product.id).with_for_update().all()
+    available = {product.id: product.available_stocks for product in locked}
+    if any(available.get(product_id, 0) < qty for product_id, qty in requested.items()):
+        return False
+    for product in locked:
+        product.available_stocks -= requested[product.id]
+    db.flush()
+    return True
+
+def reserve_stock(db: Session, items: List[schemas.PurchaseItemCreate]):
+    """Atomically decrements stock for every line in the current transaction.
+
+    On failure the transaction is rolled back and InsufficientStockError is raised
+    with the per-line failures; there are no retries.
+    """
+    requested = sales.requested_quantities(items)
+    if sales.use_row_lock(db.get_bind().dialect):
+        reserved = _reserve_stock_row_lock(db, requested)
+    else:
+        reserved = _reserve_stock_conditional(db, requested)
+    if reserved:
+        return
+    db.rollback()
+    raise InsufficientStockError(sales.stock_failures(items, requested, _get_stock_levels(db, requested)))
+
+# --- Cash drawer ---
+
+def get_drawer_counts(db: Session, for_update: bool = False) -> Dict[int, int]:
+    stmt = select(models.DrawerDenomination)
+    if for_update:
+        stmt = stmt.order_by(models.DrawerDenomination.denomination).with_for_update()
+    return {row.denomination: row.count for row in db.execute(stmt).scalars()}
+
+def ensure_drawer(db: Session):
+    # Adds a row for any shop denomination the drawer doesn't track yet
+    missing = set(change.DENOMINATIONS) - set(get_drawer_counts(db))
+    if missing:
+        db.add_all(models.DrawerDenomination(denomination=d, count=DRAWER_INITIAL_COUNT) for d in missing)
+        db.commit()
+
+def set_drawer_counts(db: Session, counts: Dict[int, int]):
+    # Manual recount / float top-up
+    for denomination, count in counts.items():
+        db.merge(models.DrawerDenomination(denomination=denomination, count=count))
     db.commit()
+
+def settle_cash(db: Session, total_amount: Decimal, paid_amount: Decimal) -> change.ChangeResult:
+    # Rows are locked (FOR UPDATE; on SQLite the stock UPDATE already holds the write
+    # lock), so writing absolute counts back can't lose a concurrent sale's update.
+    counts = get_drawer_counts(db, for_update=True) if CASH_DRAWER_TRACKING else {}
+    result, after = sales.settle_drawer(counts, total_amount, paid_amount, CASH_DRAWER_TRACKING)
+    rows = sales.drawer_update_rows(counts, after)
+    if rows:
+        db.execute(sales.drawer_update_statement(), rows)
+    return result
+
+# --- Idempotency keys ---
+
+def get_idempotent_purchase_id(db: Session, key: str) -> Optional[int]:
+    return db.execute(select(models.IdempotencyKey.purchase_id).where(models.IdempotencyKey.key == key)).scalar()
+
+def get_idempotent_purchase_ids(db: Session, keys: List[str]) -> Dict[str, int]:
+    rows = db.execute(select(models.IdempotencyKey.key, models.IdempotencyKey.purchase_id)
+                      .where(models.IdempotencyKey.key.in_(set(keys))))
+    return {key: purchase_id for key, purchase_id in rows}
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def evict_idempotency_keys(db: Session, batch_size: int = 1000) -> int:
+    """Deletes keys older than IDEMPOTENCY_KEY_TTL_HOURS in batches; returns how many went."""
+    cutoff = _utcnow() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    evicted = 0
+    while True:
+        keys = db.execute(
+            select(models.IdempotencyKey.key).where(models.IdempotencyKey.created_at < cutoff).limit(batch_size)
+        ).scalars().all()
+        if not keys:
+            return evicted
+        db.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.key.in_(keys)))
+        db.commit()
+        evicted += len(keys)
+
+def create_purchase(db: Session, customer_id: int, paid_amount: Decimal, items: List[schemas.PurchaseItemCreate],
+                    products: Dict[int, models.Product] = None, idempotency_key: str = None):
+    # `products` maps Product.id -> Product (or CatalogEntry) for every line; callers that
+    # already resolved the basket pass it in so we don't query each product again.
+    # The purchase total and tax are the sums of the stored line amounts.
+    # With an idempotency key, a concurrent submission that got there first makes this
+    # raise DuplicateSubmissionError (the key's unique index decides the winner).
+    if products is None:
+        product_ids = {item_data.product_id for item_data in items}
+        products = {p.id: p for p in db.query(models.Product).filter(models.Product.id.in_(product_ids)).all()}
+    sales.check_items(items, products)
+    purchase_item_rows, total_minor, tax_minor = sales.purchase_item_rows(items, products)
+
+    try:
+        # Decrease product stocks first; this is the authoritative stock check
+        reserve_stock(db, items)
+        low_stock.mark(db, {item.product_id for item in items}) # Only the sold products can have become low
+        change_given = settle_cash(db, money.from_minor(total_minor), paid_amount)
+
+        db_purchase = models.Purchase(
+            customer_id=customer_id,
+            total_amount=money.from_minor(total_minor),
+            tax_amount=money.from_minor(tax_minor),
+            paid_amount=paid_amount,
+            purchase_time=datetime.now(timezone.utc) # Set here, not by the server, so the rollups get the same day
+        )
+        db.add(db_purchase)
+        db.flush() # Assigns db_purchase.id without committing
+
+        for row in purchase_item_rows:
+            row["purchase_id"] = db_purchase.id
+        db.execute(insert(models.PurchaseItem), purchase_item_rows) # One executemany for all lines
+        change_rows = sales.change_rows(db_purchase.id, change_given)
+        if change_rows:
+            db.execute(insert(models.PurchaseChange.__table__), change_rows) # Likewise, however many notes
+        if idempotency_key:
+            db.add(models.IdempotencyKey(key=idempotency_key, purchase_id=db_purchase.id, created_at=_utcnow()))
+        sale = rollups.SalesTotals()
+        sale.add_sale(db_purchase.purchase_time, customer_id, total_minor, tax_minor, purchase_item_rows)
+        rollups.record(db, sale) # Last, so the shared per-day rollup rows stay locked briefly
+
+        # Purchase, items, stock, drawer changes, the key and the rollups go out in a single transaction
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        existing = get_idempotent_purchase_id(db, idempotency_key) if idempotency_key else None
+        if existing is None:
+            raise
+        raise DuplicateSubmissionError(existing)
+    except Exception:
+        db.rollback()
+        raise
+    live.publish("sales")
+    live.publish("products", {item.product_id for item in items}) # Their stock moved
     db.refresh(db_purchase)
+    db_purchase.change_notes # Load now; callers may be outside this thread/session
     return db_purchase
 
-def get_customer_purchases(db: Session, customer_id: int):
-    return db.query(models.Purchase).filter(models.Purchase.customer_id == customer_id).order_by(models.Purchase.purchase_time.desc()).all()
+# --- Bulk purchases (billing.record_baskets) ---
+
+def lock_stock_levels(db: Session, product_ids) -> Dict[int, int]:
+    stmt = select(models.Product.id, models.Product.available_stocks)\
+        .where(models.Product.id.in_(set(product_ids))).order_by(models.Product.id)
+    if db.get_bind().dialect.name in sales.ROW_LOCK_DIALECTS:
+        stmt = stmt.with_for_update()
+    return {product_id: stock for product_id, stock in db.execute(stmt)}
+
+def reserve_stock_totals(db: Session, requested: Dict[int, int]) -> bool:
+    """Decrements stock by `requested` (Product.id -> quantity); False if any product fell short."""
+    return _reserve_stock_conditional(db, dict(sorted(requested.items())))
+
+def _insert_returning_ids(db: Session, table, rows: List[dict]) -> List[int]:
+    if db.get_bind().dialect.insert_executemany_returning_sort_by_parameter_order:
+        return db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows).scalars().all()
+    return [db.execute(insert(table), row).inserted_primary_key[0] for row in rows] # e.g. MySQL: no RETURNING
+
+def create_customers(db: Session, emails: List[str]) -> Dict[str, int]:
+    emails = list(dict.fromkeys(emails))
+    ids = _insert_returning_ids(db, models.Customer.__table__, [{"email": email} for email in emails]) if emails else []
+    return dict(zip(emails, ids))
+
+def insert_purchases(db: Session, purchases: List[dict]) -> List[int]:
+    """Writes already priced purchases with one executemany per table; returns their ids in order.
+
+    Each dict has customer_id, paid_amount, purchase_time, item_rows and the
+    total_minor / tax_minor from sales.purchase_item_rows, change (a ChangeResult) and
+    idempotency_key (or None). The sales rollups are updated too; stock and the
+    drawer are left to the caller.
+    """
+    if not purchases:
+        return []
+    purchase_ids = _insert_returning_ids(db, models.Purchase.__table__, [{
+        "customer_id": purchase["customer_id"],
+        "total_amount": money.from_minor(purchase["total_minor"]),
+        "tax_amount": money.from_minor(purchase["tax_minor"]),
+        "paid_amount": purchase["paid_amount"],
+        "purchase_time": purchase["purchase_time"],
+    } for purchase in purchases])
+
+    item_rows, change_rows, key_rows = [], [], []
+    created_at = _utcnow()
+    totals = rollups.SalesTotals()
+    for purchase_id, purchase in zip(purchase_ids, purchases):
+        totals.add_sale(purchase["purchase_time"], purchase["customer_id"], purchase["total_minor"], purchase["tax_minor"],
+                        purchase["item_rows"])
+        item_rows.extend(dict(row, purchase_id=purchase_id) for row in purchase["item_rows"])
+        change_rows.extend(sales.change_rows(purchase_id, purchase["change"]))
+        if purchase["idempotency_key"]:
+            key_rows.append({"key": purchase["idempotency_key"], "purchase_id": purchase_id, "created_at": created_at})
+    for model, rows in ((models.PurchaseItem, item_rows), (models.PurchaseChange, change_rows),
+                        (models.IdempotencyKey, key_rows)):
+        if rows:
+            db.execute(insert(model.__table__), rows)
+    rollups.record(db, totals)
+    return purchase_ids
+
+# Loader options for the purchase pages, so templates don't trigger one lazy
+# SELECT per row. Shared with crud_async, where lazy loading isn't possible at all.
+RECENT_PURCHASE_OPTIONS = (joinedload(models.Purchase.customer),)
+PURCHASE_DETAIL_OPTIONS = (
+    joinedload(models.Purchase.customer),
+    selectinload(models.Purchase.items),
+    selectinload(models.Purchase.change_notes),
+)
+PURCHASE_ITEMS_OPTIONS = (selectinload(models.Purchase.items),)
+# The same for purchases moved to the archive tables (archive.py)
+ARCHIVED_PURCHASE_DETAIL_OPTIONS = (
+    joinedload(models.PurchaseArchive.customer),
+    selectinload(models.PurchaseArchive.items),
+    selectinload(models.PurchaseArchive.change_notes),
+)
+ARCHIVED_PURCHASE_ITEMS_OPTIONS = (selectinload(models.PurchaseArchive.items),)
+# Where a customer's history lives: (model, loader options with items); hot first
+PURCHASE_SOURCES = (
+    (models.Purchase, PURCHASE_ITEMS_OPTIONS),
+    (models.PurchaseArchive, ARCHIVED_PURCHASE_ITEMS_OPTIONS),
+)
+
+def _customer_purchases_statement(customer_id: int, after_id: int = None, before_id: int = None, limit: int = 20,
+                                  purchase=models.Purchase):
+    # Newest first by (purchase_time, id), served from ix_purchases_customer_id_purchase_time
+    # (or its twin on the archive table, `purchase`). The cursor is a purchase id; its
+    # time is looked up, hot or archived, in the same statement. The redundant
+    # `purchase_time <= t` keeps it an index range scan on every backend.
+    # Fetches limit + 1 rows; for before_id they come oldest first.
+    stmt = select(purchase).where(purchase.customer_id == customer_id)
+    cursor_id = before_id if before_id is not None else after_id
+    if cursor_id is None:
+        return stmt.order_by(purchase.purchase_time.desc(), purchase.id.desc()).limit(limit + 1)
+    cursor_time = func.coalesce(*(select(source.purchase_time).where(source.id == cursor_id).scalar_subquery()
+                                  for source, _ in PURCHASE_SOURCES))
+    if before_id is not None:
+        return stmt.where(purchase.purchase_time >= cursor_time,
+                          or_(purchase.purchase_time > cursor_time, purchase.id > cursor_id))\
+                   .order_by(purchase.purchase_time, purchase.id).limit(limit + 1)
+    return stmt.where(purchase.purchase_time <= cursor_time,
+                      or_(purchase.purchase_time < cursor_time, purchase.id < cursor_id))\
+               .order_by(purchase.purchase_time.desc(), purchase.id.desc()).limit(limit + 1)
+
+def _customer_purchases_page(purchases: list, limit: int, before_id: int = None):
+    # `purchases` holds each source's rows, hot first. A purchase archived between the two
+    # reads shows up in both; the hot copy is kept. Then the sources are merged in page order.
+    unique = {}
+    for purchase in purchases:
+        unique.setdefault(purchase.id, purchase)
+    purchases = sorted(unique.values(), key=lambda p: (p.purchase_time, p.id), reverse=before_id is None)[:limit + 1]
+    has_more = len(purchases) > limit
+    purchases = purchases[:limit]
+    return (list(reversed(purchases)) if before_id is not None else purchases), has_more
+
+def get_customer_purchases(db: Session, customer_id: int, after_id: int = None, before_id: int = None,
+                           limit: int = 20, with_items: bool = False):
+    """Keyset page of a customer's purchases, newest first.
+
+    Returns (purchases, has_more) like get_products_page: pass the last id as
+    after_id for older purchases, or the first id as before_id for newer ones.
+    """
+    purchases = []
+    for source, item_options in PURCHASE_SOURCES:
+        stmt = _customer_purchases_statement(customer_id, after_id, before_id, limit, source)
+        if with_items:
+            stmt = stmt.options(*item_options)
+        purchases.extend(db.execute(stmt).scalars().all())
+    return _customer_purchases_page(purchases, limit, before_id)
+
+def get_customer_totals(db: Session, customer_id: int) -> Optional[models.CustomerTotals]:
+    # Lifetime totals kept by rollups.py; None until the customer's first purchase
+    return db.get(models.CustomerTotals, customer_id)
 
 def get_purchase_details(db: Session, purchase_id: int):
-    return db.query(models.Purchase).filter(models.Purchase.id == purchase_id).first()
+    # Hot first; an archived purchase costs one more lookup
+    purchase = db.query(models.Purchase).options(*PURCHASE_DETAIL_OPTIONS).filter(models.Purchase.id == purchase_id).first()
+    if purchase is None:
+        purchase = db.query(models.PurchaseArchive).options(*ARCHIVED_PURCHASE_DETAIL_OPTIONS)\
+                     .filter(models.PurchaseArchive.id == purchase_id).first()
+    return purchase
 
 def get_recent_purchases(db: Session, limit: int = 10):
     return db.query(models.Purchase)\
+             .options(*RECENT_PURCHASE_OPTIONS)\
              .order_by(models.Purchase.purchase_time.desc())\
              .limit(limit)\
-             .all()
\ No newline at end of file
+             .all()
+
+# --- Sales reports (read only the rollups kept by rollups.py) ---
+
+def _daily_sales_statement(start: date, end: date):
+    return select(models.SalesDaily).where(models.SalesDaily.day.between(start, end)).order_by(models.SalesDaily.day)
+
+def _tax_by_rate_statement(start: date, end: date):
+    rollup = models.SalesDailyTax
+    return select(rollup.tax_percentage,
+                  func.sum(rollup.taxable_amount).label("taxable_amount"),
+                  func.sum(rollup.tax).label("tax"))\
+        .where(rollup.day.between(start, end))\
+        .group_by(rollup.tax_percentage)\
+        .order_by(rollup.tax_percentage)
+
+def _top_products_statement(start: date, end: date, limit: int):
+    rollup = models.SalesDailyProduct
+    revenue = func.sum(rollup.revenue).label("revenue")
+    top = select(rollup.product_id, func.sum(rollup.quantity).label("quantity"), revenue)\
+        .where(rollup.day.between(start, end))\
+        .group_by(rollup.product_id)\
+        .order_by(revenue.desc(), rollup.product_id)\
+        .limit(limit)\
+        .subquery()
+    # Names are looked up for the top rows only; a deleted product keeps its sales with no name
+    return select(models.Product.product_id, models.Product.name, top.c.quantity, top.c.revenue)\
+        .select_from(top)\
+        .outerjoin(models.Product, models.Product.id == top.c.product_id)\
+        .order_by(top.c.revenue.desc(), top.c.product_id)
+
+def get_daily_sales(db: Session, start: date, end: date) -> List[models.SalesDaily]:
+    return db.execute(_daily_sales_statement(start, end)).scalars().all()
+
+def get_tax_by_rate(db: Session, start: date, end: date):
+    return db.execute(_tax_by_rate_statement(start, end)).all()
+
+def get_top_products(db: Session, start: date, end: date, limit: int = 10):
+    return db.execute(_top_products_statement(start, end, limit)).all()
@@ -0,0 +1,300 @@
+# Async versions of the crud functions used by the hot routes
+# (/, /billing/, /generate_bill/ and /purchase_details/{id}).
+#
+# Every function accepts either an AsyncSession or, when database.get_async_db
+# falls back to the sync path, a regular Session; in that case the matching
+# function from crud runs in Starlette's worker thread pool so it doesn't block
+# the event loop.
+import functools
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import Dict, List
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from starlette.concurrency import run_in_threadpool
+
+import crud, live, low_stock, mailer, models, money, rollups, sales, schemas
+from catalog_cache import CatalogEntry, PrefixIndex, catalog
+
+
+def _sync_fallback(sync_function):
+    def decorator(async_function):
+        @functools.wraps(async_function)
+        async def wrapper(db, *args, **kwargs):
+            if isinstance(db, AsyncSession):
+                return await async_function(db, *args, **kwargs)
+            return await run_in_threadpool(sync_function, db, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@_sync_fallback(crud.get_products_by_product_id_strs)
+async def get_products_by_product_id_strs(db: AsyncSession, product_id_strs: List[str]):
+    unique_ids = set(product_id_strs)
+    if not unique_ids:
+        return {}
+    result = await db.execute(select(models.Product).where(models.Product.product_id.in_(unique_ids)))
+    return {product.product_id: product for product in result.scalars()}
+
+@_sync_fallback(crud.get_products_by_ids)
+async def get_products_by_ids(db: AsyncSession, ids):
+    if not ids:
+        return {}
+    result = await db.execute(select(models.Product).where(models.Product.id.in_(set(ids))))
+    return {product.id: product for product in result.scalars()}
+
+@_sync_fallback(crud.get_products)
+async def get_products(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.execute(select(models.Product).offset(skip).limit(limit))
+    return result.scalars().all()
+
+async def _check_catalog_version(db: AsyncSession):
+    if catalog.version_check_due():
+        result = await db.execute(select(models.CatalogVersion.version).where(models.CatalogVersion.id == 1))
+        catalog.observe_version(result.scalar() or 0)
+
+@_sync_fallback(crud.get_catalog_products_by_product_id_strs)
+async def get_catalog_products_by_product_id_strs(db: AsyncSession, product_id_strs: List[str]):
+    await _check_catalog_version(db)
+    generation = catalog.generation
+    found, missing = catalog.get_many("product_id", product_id_strs)
+    if missing:
+        for product_id_str, product in (await get_products_by_product_id_strs(db, missing)).items():
+            found[product_id_str] = CatalogEntry.from_product(product)
+            catalog.put(found[product_id_str], generation)
+    return found
+
+@_sync_fallback(crud.search_catalog)
+async def search_catalog(db: AsyncSession, prefix: str, limit: int = 10):
+    await _check_catalog_version(db)
+    generation = catalog.generation
+    index = catalog.get_search_index()
+    if index is None:
+        result = await db.stream(select(models.Product.id, models.Product.product_id, models.Product.name,
+                                        models.Product.price, models.Product.tax_percentage))
+        index = PrefixIndex([CatalogEntry(*row) async for row in result])
+        catalog.put_search_index(index, generation)
+    return index.search(prefix, limit)
+
+@_sync_fallback(crud.get_customer_by_email)
+async def get_customer_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(models.Customer).where(models.Customer.email == email).limit(1))
+    return result.scalars().first()
+
+@_sync_fallback(crud.create_customer)
+async def create_customer(db: AsyncSession, email: str, commit: bool = True):
+    db_customer = models.Customer(email=email)
+    db.add(db_customer)
+    if commit:
+        await db.commit()
+        await db.refresh(db_customer)
+    else:
+        await db.flush()
+    return db_customer
+
+
+async def _reserve_stock(db: AsyncSession, items: List[schemas.PurchaseItemCreate]):
+    # Same semantics as crud.reserve_stock
+    requested = sales.requested_quantities(items)
+    dialect = db.get_bind().dialect
+    if sales.use_row_lock(dialect):
+        result = await db.execute(
+            select(models.Product).where(models.Product.id.in_(requested)).order_by(models.Product.id).with_for_update()
+        )
+        locked = result.scalars().all()
+        available = {product.id: product.available_stocks for product in locked}
+        reserved = all(available.get(product_id, 0) >= qty for product_id, qty in requested.items())
+        if reserved:
+            for product in locked:
+                product.available_stocks -= requested[product.id]
+            await db.flush()
+    else:
+        stmt = sales.reserve_stock_statement()
+        rows = [{"b_id": product_id, "b_qty": qty} for product_id, qty in requested.items()]
+        if dialect.supports_sane_multi_rowcount:
+            reserved = (await db.execute(stmt, rows)).rowcount == len(rows)
+        else:
+            reserved = True
+            for row in rows:
+                if (await db.execute(stmt, row)).rowcount != 1:
+                    reserved = False
+                    break
+    if reserved:
+        return
+    await db.rollback()
+    result = await db.execute(
+        select(models.Product.id, models.Product.available_stocks).where(models.Product.id.in_(requested))
+    )
+    available = {product_id: stock for product_id, stock in result.all()}
+    raise crud.InsufficientStockError(sales.stock_failures(items, requested, available))
+
+async def _settle_cash(db: AsyncSession, total_amount: Decimal, paid_amount: Decimal):
+    # Same semantics as crud.settle_cash
+    counts = {}
+    if crud.CASH_DRAWER_TRACKING:
+        result = await db.execute(
+            select(models.DrawerDenomination).order_by(models.DrawerDenomination.denomination).with_for_update()
+        )
+        counts = {row.denomination: row.count for row in result.scalars()}
+    # The change solve is CPU work; keep it off the event loop
+    change_given, after = await run_in_threadpool(sales.settle_drawer, counts, total_amount, paid_amount,
+                                                  crud.CASH_DRAWER_TRACKING)
+    rows = sales.drawer_update_rows(counts, after)
+    if rows:
+        await db.execute(sales.drawer_update_statement(), rows)
+    return change_given
+
+@_sync_fallback(crud.get_drawer_counts)
+async def get_drawer_counts(db: AsyncSession, for_update: bool = False):
+    stmt = select(models.DrawerDenomination)
+    if for_update:
+        stmt = stmt.order_by(models.DrawerDenomination.denomination).with_for_update()
+    return {row.denomination: row.count for row in (await db.execute(stmt)).scalars()}
+
+@_sync_fallback(crud.set_drawer_counts)
+async def set_drawer_counts(db: AsyncSession, counts: Dict[int, int]):
+    for denomination, count in counts.items():
+        await db.merge(models.DrawerDenomination(denomination=denomination, count=count))
+    await db.commit()
+
+@_sync_fallback(crud.get_idempotent_purchase_id)
+async def get_idempotent_purchase_id(db: AsyncSession, key: str):
+    result = await db.execute(select(models.IdempotencyKey.purchase_id).where(models.IdempotencyKey.key == key))
+    return result.scalar()
+
+@_sync_fallback(crud.create_purchase)
+async def create_purchase(db: AsyncSession, customer_id: int, paid_amount: Decimal,
+                          items: List[schemas.PurchaseItemCreate], products: Dict[int, models.Product] = None,
+                          idempotency_key: str = None):
+    if products is None:
+        result = await db.execute(
+            select(models.Product).where(models.Product.id.in_({item_data.product_id for item_data in items}))
+        )
+        products = {p.id: p for p in result.scalars()}
+    sales.check_items(items, products)
+    purchase_item_rows, total_minor, tax_minor = sales.purchase_item_rows(items, products)
+
+    try:
+        await _reserve_stock(db, items)
+        await db.execute(low_stock.mark_statement({item.product_id for item in items}))
+        change_given = await _settle_cash(db, money.from_minor(total_minor), paid_amount)
+
+        db_purchase = models.Purchase(
+            customer_id=customer_id,
+            total_amount=money.from_minor(total_minor),
+            tax_amount=money.from_minor(tax_minor),
+            paid_amount=paid_amount,
+            purchase_time=datetime.now(timezone.utc)
+        )
+        db.add(db_purchase)
+        await db.flush()
+
+        for row in purchase_item_rows:
+            row["purchase_id"] = db_purchase.id
+        await db.execute(insert(models.PurchaseItem), purchase_item_rows)
+        change_rows = sales.change_rows(db_purchase.id, change_given)
+        if change_rows:
+            await db.execute(insert(models.PurchaseChange.__table__), change_rows)
+        # Invoices read change_notes, which an AsyncSession can't lazy-load
+        set_committed_value(db_purchase, "change_notes", sales.change_notes(change_given))
+        if idempotency_key:
+            db.add(models.IdempotencyKey(key=idempotency_key, purchase_id=db_purchase.id, created_at=crud._utcnow()))
+        sale = rollups.SalesTotals()
+        sale.add_sale(db_purchase.purchase_time, customer_id, total_minor, tax_minor, purchase_item_rows)
+        for stmt, rows in sale.statements(db.get_bind().dialect.name):
+            await db.execute(stmt, rows)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        existing = await get_idempotent_purchase_id(db, idempotency_key) if idempotency_key else None
+        if existing is None:
+            raise
+        raise crud.DuplicateSubmissionError(existing)
+    except Exception:
+        await db.rollback()
+        raise
+    live.publish("sales")
+    live.publish("products", {item.product_id for item in items})
+    return db_purchase # Still loaded: expire_on_commit=False
+
+
+@_sync_fallback(mailer.enqueue_email)
+async def enqueue_email(db: AsyncSession, recipients: List[str], subject: str, body_html: str, purchase_id: int = None,
+                        commit: bool = True):
+    db_email = models.EmailOutbox(
+        recipients=",".join(recipients),
+        subject=subject,
+        body_html=body_html,
+        purchase_id=purchase_id,
+        status="pending",
+        next_attempt_at=datetime.now(timezone.utc).replace(tzinfo=None)
+    )
+    db.add(db_email)
+    if commit:
+        await db.commit()
+    return db_email
+
+
+# Templates walk these relationships, and an AsyncSession can't lazy-load them,
+# so both queries use crud's eager-loading options.
+@_sync_fallback(crud.get_purchase_details)
+async def get_purchase_details(db: AsyncSession, purchase_id: int):
+    result = await db.execute(
+        select(models.Purchase)
+        .where(models.Purchase.id == purchase_id)
+        .options(*crud.PURCHASE_DETAIL_OPTIONS)
+    )
+    purchase = result.scalars().first()
+    if purchase is None:
+        result = await db.execute(
+            select(models.PurchaseArchive)
+            .where(models.PurchaseArchive.id == purchase_id)
+            .options(*crud.ARCHIVED_PURCHASE_DETAIL_OPTIONS)
+        )
+        purchase = result.scalars().first()
+    return purchase
+
+@_sync_fallback(crud.get_customer_purchases)
+async def get_customer_purchases(db: AsyncSession, customer_id: int, after_id: int = None, before_id: int = None,
+                                 limit: int = 20, with_items: bool = False):
+    purchases = []
+    for source, item_options in crud.PURCHASE_SOURCES:
+        stmt = crud._customer_purchases_statement(customer_id, after_id, before_id, limit, source)
+        if with_items:
+            stmt = stmt.options(*item_options)
+        result = await db.execute(stmt)
+        purchases.extend(result.scalars().all())
+    return crud._customer_purchases_page(purchases, limit, before_id)
+
+@_sync_fallback(crud.get_customer_totals)
+async def get_customer_totals(db: AsyncSession, customer_id: int):
+    return await db.get(models.CustomerTotals, customer_id)
+
+@_sync_fallback(crud.get_recent_purchases)
+async def get_recent_purchases(db: AsyncSession, limit: int = 10):
+    result = await db.execute(
+        select(models.Purchase)
+        .options(*crud.RECENT_PURCHASE_OPTIONS)
+        .order_by(models.Purchase.purchase_time.desc())
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+
+# Sales reports for the dashboard; the statements are crud's, over the rollup tables only
+@_sync_fallback(crud.get_daily_sales)
+async def get_daily_sales(db: AsyncSession, start: date, end: date):
+    return (await db.execute(crud._daily_sales_statement(start, end))).scalars().all()
+
+
+@_sync_fallback(crud.get_tax_by_rate)
+async def get_tax_by_rate(db: AsyncSession, start: date, end: date):
+    return (await db.execute(crud._tax_by_rate_statement(start, end))).all()
+
+
+@_sync_fallback(crud.get_top_products)
+async def get_top_products(db: AsyncSession, start: date, end: date, limit: int = 10):
+    return (await db.execute(crud._top_products_statement(start, end, limit))).all()
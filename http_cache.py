@@ -0,0 +1,213 @@
+# HTTP caching and compression for the HTML pages and static files.
+#
+#   Validators: pages send a weak ETag (and Last-Modified where there is one) and
+#   answer a matching conditional GET with 304 before rendering anything.
+#     /purchase_details/{id} -> ETag from the stored invoice (lines keep the names and prices they
+#                               were sold at); revalidated each time, answered from the invoice cache
+#     /products/             -> ETag from the page's rows (stock moves with every sale), revalidated each time
+#   Every ETag includes release(), a digest of templates/ and static/, so a deploy
+#   that changes the markup invalidates what browsers hold.
+#
+#   Static files: templates link them with static_url(), which appends the file's
+#   content digest (?v=...). Requests carrying the current digest are cacheable
+#   for a year; anything else must revalidate (StaticFiles sends ETag / Last-Modified).
+#
+#   Compression: CompressionMiddleware gzips (or, with the brotli package
+#   installed, brotli-compresses) complete text responses - rendered HTML, CSS,
+#   JSON - above HTTP_COMPRESSION_MIN_BYTES. Streamed responses (exports) pass through.
+import functools
+import gzip
+import hashlib
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError: # Optional; gzip only
+    brotli = None
+
+HTTP_COMPRESSION = os.getenv("HTTP_COMPRESSION", "1") == "1"
+HTTP_COMPRESSION_MIN_BYTES = int(os.getenv("HTTP_COMPRESSION_MIN_BYTES", "1024")) # Smaller bodies go as they are
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 # Fast enough to run per response
+
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE_TYPES = ("text/html", "text/css", "text/plain", "application/json", "application/javascript")
+
+STATIC_DIR = "static"
+TEMPLATE_DIR = "templates"
+
+
+# --- Asset fingerprints ---
+
+@functools.lru_cache(maxsize=None)
+def asset_digest(path: str) -> str:
+    """Content digest of a file under static/; computed once per process."""
+    with open(os.path.join(STATIC_DIR, path), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def static_url(path: str) -> str:
+    path = path.lstrip("/")
+    return f"/static/{path}?v={asset_digest(path)}"
+
+
+@functools.lru_cache(maxsize=None)
+def release() -> str:
+    """Digest of every template and static file: changes whenever a deploy changes what pages look like."""
+    digest = hashlib.sha256()
+    for directory in (TEMPLATE_DIR, STATIC_DIR):
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(path.encode())
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class FingerprintedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers keep a file for a year when the URL names its current digest."""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        version = dict(_query_pairs(scope)).get("v")
+        fingerprinted = version is not None and version == asset_digest(self.get_path(scope).replace(os.sep, "/"))
+        response.headers["Cache-Control"] = STATIC_IMMUTABLE if fingerprinted else REVALIDATE
+        return response
+
+
+def _query_pairs(scope):
+    for pair in scope.get("query_string", b"").decode("latin-1").split("&"):
+        name, _, value = pair.partition("=")
+        yield name, value
+
+
+# --- Validators ---
+
+def etag(*parts) -> str:
+    """Weak ETag over `parts` and the release; weak, because compression changes the bytes."""
+    digest = hashlib.sha256(repr((release(),) + parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def http_date(moment: datetime) -> str:
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc) # Stored times are UTC
+    return format_datetime(moment.astimezone(timezone.utc).replace(microsecond=0), usegmt=True)
+
+
+def is_fresh(request_headers: Headers, tag: str, last_modified: datetime = None) -> bool:
+    """True if the client's copy is current: If-None-Match decides when present, else If-Modified-Since."""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        wanted = tag.removeprefix("W/")
+        return any(candidate.strip() == "*" or candidate.strip().removeprefix("W/") == wanted
+                   for candidate in if_none_match.split(","))
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        return since is not None and since.tzinfo is not None and last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def validator_headers(tag: str, cache_control: str, last_modified: datetime = None) -> dict:
+    headers = {"ETag": tag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
+
+
+# --- Compression ---
+
+def _choose_encoding(accept_encoding: str):
+    offered = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        offered[name.strip()] = quality
+    if brotli is not None and offered.get("br", 0) > 0:
+        return "br"
+    if offered.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing complete (unstreamed) text responses for clients that accept it."""
+
+    def __init__(self, app, minimum_size: int = HTTP_COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = _choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None # Held back until we know whether the body is compressed
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if passthrough or message["type"] not in ("http.response.start", "http.response.body"):
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "").split(";")[0].strip()
+                if content_type not in COMPRESSIBLE_TYPES or "content-encoding" in headers:
+                    passthrough = True
+                    await send(message)
+                else:
+                    start = message
+                    MutableHeaders(scope=start).append("Vary", "Accept-Encoding")
+                return
+            body = message.get("body", b"")
+            if message.get("more_body", False) or len(body) < self.minimum_size:
+                # Streamed, or too small to be worth it: send as is
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            compressed = compress(body, encoding)
+            headers = MutableHeaders(scope=start)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            if headers.get("etag", "").startswith('"'):
+                headers["ETag"] = "W/" + headers["etag"] # Same entity, different bytes
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
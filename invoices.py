@@ -0,0 +1,144 @@
+# Invoice view-model shared by generate_bill, view_purchase_details and the
+# invoice email, plus a small per-process cache of finished invoices.
+#
+# A completed purchase never changes, so its view-model can be cached by
+# purchase_id and repeat views of /purchase_details/{id} skip the database and
+# the per-line price/tax math entirely.
+import os
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Iterable, List, NamedTuple
+
+import jinja2
+
+import change, metrics, money
+
+INVOICE_CACHE_SIZE = int(os.getenv("INVOICE_CACHE_SIZE", "2048"))
+
+
+class InvoiceLine(NamedTuple):
+    product_name: str
+    product_id: str
+    quantity: int
+    unit_price: Decimal
+    tax_percentage: Decimal
+
+
+def _detailed_item(line: InvoiceLine, subtotal: Decimal, tax: Decimal, total: Decimal) -> dict:
+    return {
+        "product_name": line.product_name,
+        "product_id": line.product_id,
+        "quantity": line.quantity,
+        "unit_price": line.unit_price,
+        "tax_percentage": line.tax_percentage,
+        "item_price_before_tax": subtotal,
+        "item_tax": tax,
+        "item_total_price": total
+    }
+
+
+def price_lines(lines: Iterable[InvoiceLine]):
+    """Per-line price/tax breakdown. Returns (detailed_items, total_bill_amount, total_tax_amount)."""
+    detailed_items = []
+    total_minor = tax_minor = 0
+    for line in lines:
+        subtotal, tax, total = money.line_amounts(line.unit_price, line.quantity, line.tax_percentage)
+        total_minor += total
+        tax_minor += tax
+        detailed_items.append(_detailed_item(line, money.from_minor(subtotal), money.from_minor(tax), money.from_minor(total)))
+    return detailed_items, money.from_minor(total_minor), money.from_minor(tax_minor)
+
+
+def _invoice(customer_email: str, detailed_items: List[dict], total_bill_amount: Decimal, total_tax_amount: Decimal,
+             paid_amount) -> dict:
+    paid_amount = money.from_minor(money.to_minor(paid_amount))
+    return {
+        "customer_email": customer_email,
+        "detailed_items": detailed_items,
+        "total_bill_amount": total_bill_amount,
+        "total_tax_amount": total_tax_amount,
+        "paid_amount": paid_amount,
+        "balance_to_return": paid_amount - total_bill_amount,
+    }
+
+
+def build_invoice(customer_email: str, lines: Iterable[InvoiceLine], paid_amount) -> dict:
+    """Template context for bill_details.html and bill_details_email.html.
+
+    generate_bill builds it before the purchase exists (to check the paid amount)
+    and fills in the id, time and change handed out afterwards with stamp_invoice.
+    """
+    detailed_items, total_bill_amount, total_tax_amount = price_lines(lines)
+    return _invoice(customer_email, detailed_items, total_bill_amount, total_tax_amount, paid_amount)
+
+
+def stamp_invoice(invoice: dict, purchase) -> dict:
+    # `purchase` needs change_notes loaded (crud.create_purchase and PURCHASE_DETAIL_OPTIONS do this)
+    invoice["purchase_id"] = purchase.id
+    invoice["purchase_time"] = purchase.purchase_time.strftime("%Y-%m-%d %H:%M:%S")
+    change_breakdown = {note.denomination: note.count for note in purchase.change_notes if note.denomination}
+    balance_paise = money.to_minor(invoice["balance_to_return"])
+    if not purchase.change_notes and balance_paise >= 100:
+        # Purchases from before the drawer was tracked stored no change; show the unlimited breakdown
+        change_breakdown = change.unlimited_breakdown(balance_paise // 100)
+    given_paise = sum(denomination * count for denomination, count in change_breakdown.items()) * 100
+    invoice["change_breakdown"] = change_breakdown
+    invoice["change_remainder"] = money.from_minor(max(balance_paise - given_paise, 0))
+    return invoice
+
+
+def build_invoice_for_purchase(purchase) -> dict:
+    # `purchase` needs customer, items and change_notes loaded (crud.PURCHASE_DETAIL_OPTIONS).
+    # Names, codes and amounts are read as stored at checkout, not from the current catalog.
+    detailed_items = [
+        _detailed_item(InvoiceLine(item.product_name_at_purchase, item.product_code_at_purchase, item.quantity,
+                                   item.price_at_purchase, item.tax_percentage_at_purchase),
+                       item.line_subtotal, item.line_tax, item.line_total)
+        for item in purchase.items
+    ]
+    invoice = _invoice(purchase.customer.email, detailed_items, purchase.total_amount, purchase.tax_amount,
+                       purchase.paid_amount)
+    return stamp_invoice(invoice, purchase)
+
+
+# --- Email rendering ---
+
+# Compiled once and rendered directly; no Response object or request needed
+_email_environment = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"), autoescape=True)
+metrics.instrument_templates(_email_environment)
+
+def render_invoice_email(invoice: dict) -> str:
+    return _email_environment.get_template("bill_details_email.html").render(invoice)
+
+
+# --- Cache of finished invoices ---
+
+class InvoiceCache:
+    """Thread-safe LRU of invoice view-models keyed by purchase_id."""
+
+    def __init__(self, max_entries: int = INVOICE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, purchase_id: int):
+        with self._lock:
+            invoice = self._entries.get(purchase_id)
+            if invoice is not None:
+                self._entries.move_to_end(purchase_id)
+            return invoice
+
+    def put(self, invoice: dict):
+        with self._lock:
+            self._entries[invoice["purchase_id"]] = invoice
+            self._entries.move_to_end(invoice["purchase_id"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+invoice_cache = InvoiceCache()
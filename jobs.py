@@ -0,0 +1,99 @@
+# Periodic maintenance jobs, run by one background thread (started by main on
+# startup) or as their own process (`python jobs.py`).
+#
+# Each job is a function taking a Session, registered with @periodic(interval).
+# A failing job is logged and retried at its next interval; it never stops the others.
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+import archive, crud, low_stock
+from database import SessionLocal
+
+logger = logging.getLogger("jobs")
+
+IDEMPOTENCY_EVICT_INTERVAL = float(os.getenv("IDEMPOTENCY_EVICT_INTERVAL", "600")) # Seconds
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "86400")) # Seconds; 0 leaves archiving to `python archive.py run`
+LOW_STOCK_DIGEST_INTERVAL = float(os.getenv("LOW_STOCK_DIGEST_INTERVAL", "3600")) # Seconds; 0 = no reorder emails
+
+JOBS = [] # (name, interval seconds, function(db))
+
+
+def periodic(interval: float, name: str = None):
+    def register(function):
+        JOBS.append((name or function.__name__, interval, function))
+        return function
+    return register
+
+
+@periodic(IDEMPOTENCY_EVICT_INTERVAL)
+def evict_idempotency_keys(db: Session):
+    evicted = crud.evict_idempotency_keys(db)
+    if evicted:
+        logger.info("Evicted %d expired idempotency keys", evicted)
+
+
+if ARCHIVE_INTERVAL > 0:
+    @periodic(ARCHIVE_INTERVAL)
+    def archive_purchases(db: Session):
+        moved = archive.archive_purchases(db.get_bind())
+        if moved:
+            logger.info("Archived %d purchases older than %d days", moved, archive.ARCHIVE_AFTER_DAYS)
+
+
+if LOW_STOCK_DIGEST_INTERVAL > 0:
+    @periodic(LOW_STOCK_DIGEST_INTERVAL)
+    def low_stock_digest(db: Session):
+        reported = low_stock.send_digest(db)
+        if reported:
+            logger.info("Queued a reorder digest for %d low-stock products", reported)
+
+
+class JobRunner(threading.Thread):
+    """Runs every registered job once per its interval until stop() is called."""
+
+    def __init__(self, session_factory=SessionLocal, jobs=None):
+        super().__init__(name="periodic-jobs", daemon=True)
+        self.session_factory = session_factory
+        self.jobs = list(JOBS if jobs is None else jobs)
+        self._next_run = {name: time.monotonic() for name, _, _ in self.jobs} # Everything runs once at start
+        self._stopping = threading.Event()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        self.join(timeout)
+
+    def run_due(self):
+        for name, interval, function in self.jobs:
+            if time.monotonic() < self._next_run[name]:
+                continue
+            try:
+                with self.session_factory() as db:
+                    function(db)
+            except Exception:
+                logger.exception("Periodic job %s failed", name)
+            self._next_run[name] = time.monotonic() + interval
+
+    def run(self):
+        while not self._stopping.is_set():
+            self.run_due()
+            wait = min(self._next_run.values(), default=time.monotonic() + 60) - time.monotonic()
+            self._stopping.wait(max(wait, 0.1))
+
+
+# The runner started by main on app startup (None when disabled or running elsewhere)
+job_runner = None
+
+
+if __name__ == "__main__":
+    # Run the jobs as their own process: `python jobs.py`
+    logging.basicConfig(level=logging.INFO)
+    runner = JobRunner()
+    logger.info("Running periodic jobs: %s", ", ".join(name for name, _, _ in runner.jobs))
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,189 @@
+# Live updates for the dashboard and product pages, pushed over WebSockets
+# (/ws/live) instead of viewers reloading the pages.
+#
+# Writers publish after commit: publish("sales") when a purchase is recorded,
+# publish("products", ids) when products' stock or details change. Publishing only
+# marks the topic (and keys) dirty, from any thread, and costs nothing when no
+# one is watching. Every LIVE_UPDATE_INTERVAL seconds the broadcaster turns each
+# dirty topic into ONE message - main's renderer for the topic does the queries
+# and rendering once - and hands that same string to every subscriber of the
+# topic: a burst of sales costs one dashboard refresh per interval, however many
+# managers are watching.
+#
+# Backpressure: a subscriber holds at most the latest unsent message per topic;
+# a newer one replaces it, so a slow viewer skips straight to the current state
+# instead of queueing. A viewer that can't take a message within
+# LIVE_SEND_TIMEOUT seconds is disconnected (its page reconnects and catches up).
+#
+# Per process: with several workers, a page hears about the changes made
+# through the worker serving its WebSocket.
+import asyncio
+import logging
+import os
+import threading
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("live")
+
+LIVE_UPDATES = os.getenv("LIVE_UPDATES", "1") == "1"
+LIVE_UPDATE_INTERVAL = float(os.getenv("LIVE_UPDATE_INTERVAL", "1.0")) # Seconds; changes within one are coalesced
+LIVE_SEND_TIMEOUT = float(os.getenv("LIVE_SEND_TIMEOUT", "10")) # Seconds a viewer may take to accept a message
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "2000")) # Per process
+
+TOPICS = ("sales", "products")
+
+
+class Subscriber:
+    """One viewer's mailbox: the latest unsent message per topic."""
+
+    def __init__(self, topics: Iterable[str]):
+        self.topics = frozenset(topics)
+        self.skipped = 0 # Messages replaced before they were sent
+        self._pending: Dict[str, str] = {}
+        self._ready = asyncio.Event()
+
+    def offer(self, topic: str, message: str):
+        if topic in self._pending:
+            self.skipped += 1
+        self._pending[topic] = message
+        self._ready.set()
+
+    async def next_messages(self):
+        await self._ready.wait()
+        self._ready.clear()
+        messages, self._pending = list(self._pending.values()), {}
+        return messages
+
+
+class Broadcaster:
+    def __init__(self, interval: float = LIVE_UPDATE_INTERVAL, max_subscribers: int = LIVE_MAX_SUBSCRIBERS):
+        self.interval = interval
+        self.max_subscribers = max_subscribers
+        self.renderers: Dict[str, Callable[[Set], Awaitable[Optional[str]]]] = {}
+        self.subscribers: Set[Subscriber] = set()
+        self._dirty: Dict[str, set] = {} # Topic -> keys changed since the last flush
+        self._lock = threading.Lock() # publish() is called from worker threads too
+        self._task = None
+
+    def renderer(self, topic: str):
+        """Registers `async def render(keys) -> message` for a topic; None means nothing to send."""
+        def register(function):
+            self.renderers[topic] = function
+            return function
+        return register
+
+    def publish(self, topic: str, keys: Iterable = ()):
+        if self._task is None:
+            return # Not serving (scripts, jobs process): nobody to tell
+        with self._lock:
+            self._dirty.setdefault(topic, set()).update(keys)
+
+    def subscribe(self, topics: Iterable[str]) -> Optional[Subscriber]:
+        """A new Subscriber, or None when the process already serves max_subscribers."""
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        subscriber = Subscriber(topics)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def flush(self) -> int:
+        """Renders each dirty topic once and offers it to its subscribers; returns messages handed out."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        delivered = 0
+        for topic, keys in dirty.items():
+            audience = [subscriber for subscriber in self.subscribers if topic in subscriber.topics]
+            if not audience or topic not in self.renderers:
+                continue
+            try:
+                message = await self.renderers[topic](keys)
+            except Exception:
+                logger.exception("Rendering the live %s update failed", topic)
+                continue
+            if message is None:
+                continue
+            for subscriber in audience:
+                subscriber.offer(topic, message)
+            delivered += len(audience)
+        return delivered
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        """Starts flushing on the running event loop (main's startup)."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="live-updates")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        with self._lock:
+            self._dirty.clear()
+
+
+async def serve(websocket, subscriber: Subscriber, send_timeout: float = None):
+    """Sends the subscriber's messages over an accepted WebSocket until either side gives up."""
+    send_timeout = send_timeout or LIVE_SEND_TIMEOUT
+
+    async def send():
+        while True:
+            for message in await subscriber.next_messages():
+                await asyncio.wait_for(websocket.send_text(message), send_timeout)
+
+    async def receive():
+        # Viewers send nothing; this only notices the disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(send()), asyncio.ensure_future(receive())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        if isinstance(task.exception(), asyncio.TimeoutError):
+            logger.info("Dropping a live viewer that stopped reading")
+            try:
+                await websocket.close(code=1013) # Try again later
+            except Exception:
+                pass
+        elif task.exception() is not None:
+            logger.debug("Live viewer went away: %r", task.exception()) # Usually a send after the client left
+
+
+# The broadcaster started by main on app startup
+broadcaster = Broadcaster()
+
+
+def publish(topic: str, keys: Iterable = ()):
+    broadcaster.publish(topic, keys)
+
+
+def publish_on_commit(db: Session, topic: str, keys: Iterable = ()):
+    """publish() once `db` commits (dropped on rollback), for code that leaves the commit to its caller."""
+    db.info.setdefault("live_updates", []).append((topic, tuple(keys)))
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed(db):
+    for topic, keys in db.info.pop("live_updates", ()):
+        publish(topic, keys)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_rolled_back(db):
+    db.info.pop("live_updates", None)
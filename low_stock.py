@@ -0,0 +1,191 @@
+# Low-stock tracking and the reorder digest.
+#
+# A product is low when it has a reorder level (Product.reorder_level > 0) and
+# available_stocks <= reorder_level. The low_stock table (models.LowStock) holds
+# exactly the low products, kept in the same transaction as every stock change and
+# only for the products that changed, never by scanning the catalog:
+#   sales (crud.create_purchase, crud_async, billing.record_baskets) -> mark(sold ids):
+#       one INSERT ... SELECT over the sold products' rows (a sale only lowers stock)
+#   product add / edit / delete / import -> refresh(ids): that, plus a DELETE of
+#       those that are no longer low (restocked, level lowered, deleted)
+# So a sale costs one statement by primary key whatever the catalog size, and
+# /products/low_stock reads only the low rows.
+#
+# The digest (jobs.py, every LOW_STOCK_DIGEST_INTERVAL seconds) emails the
+# products that went low since the last one to LOW_STOCK_ALERT_RECIPIENTS through
+# the outbox, marking them alerted in the same transaction. A product that is
+# restocked and runs low again is reported again.
+#
+#   python low_stock.py check    -> compares low_stock with a full scan; exits 1 on a mismatch
+#   python low_stock.py rebuild  -> replaces low_stock with the full scan (alerts already sent are kept)
+#   python low_stock.py digest   -> queues the digest now
+import argparse
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Iterable, List
+
+import jinja2
+from sqlalchemy import DateTime, and_, func, literal, select
+from sqlalchemy.orm import Session
+
+import mailer, metrics, models
+from database import begin_write
+
+LOW_STOCK_ALERT_RECIPIENTS = os.getenv("LOW_STOCK_ALERT_RECIPIENTS", "") # Comma-separated; empty (default) = no digest
+LOW_STOCK_DIGEST_MAX_ITEMS = int(os.getenv("LOW_STOCK_DIGEST_MAX_ITEMS", "500")) # Products per email
+DIGEST_SUBJECT = "Low stock: products to reorder"
+
+products = models.Product.__table__
+low_stock = models.LowStock.__table__
+
+
+def _is_low():
+    return and_(products.c.reorder_level > 0, products.c.available_stocks <= products.c.reorder_level)
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# --- Incremental maintenance ---
+
+def mark_statement(product_ids: Iterable[int]):
+    """INSERT into low_stock the given products that are low and not listed yet."""
+    ids = sorted(set(product_ids))
+    listed = select(low_stock.c.product_id).where(low_stock.c.product_id.in_(ids))
+    return low_stock.insert().from_select(
+        ["product_id", "since"],
+        select(products.c.id, literal(_utcnow(), DateTime(timezone=True)))
+        .where(products.c.id.in_(ids), _is_low(), products.c.id.not_in(listed)))
+
+
+def clear_statement(product_ids: Iterable[int]):
+    """DELETE from low_stock the given products that are no longer low (or no longer exist)."""
+    ids = sorted(set(product_ids))
+    still_low = select(products.c.id).where(products.c.id.in_(ids), _is_low())
+    return low_stock.delete().where(low_stock.c.product_id.in_(ids), low_stock.c.product_id.not_in(still_low))
+
+
+def mark(db: Session, product_ids: Iterable[int]):
+    """After a sale took stock from `product_ids`, in its transaction."""
+    product_ids = list(product_ids)
+    if product_ids:
+        db.execute(mark_statement(product_ids))
+
+
+def refresh(db: Session, product_ids: Iterable[int]):
+    """After `product_ids` were added, edited or deleted, in the same transaction."""
+    product_ids = list(product_ids)
+    if product_ids:
+        db.execute(clear_statement(product_ids))
+        db.execute(mark_statement(product_ids))
+
+
+# --- Reading ---
+
+def get_low_stock(db: Session, limit: int = 200):
+    """(rows, total): the lowest-stocked low products first, each with its low_stock row's since / alerted_at."""
+    rows = db.execute(
+        select(models.Product, models.LowStock.since, models.LowStock.alerted_at)
+        .join(models.LowStock, models.LowStock.product_id == models.Product.id)
+        .order_by(models.Product.available_stocks, models.Product.id)
+        .limit(limit)
+    ).all()
+    return rows, db.scalar(select(func.count()).select_from(low_stock))
+
+
+# --- Digest ---
+
+_email_environment = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"), autoescape=True)
+metrics.instrument_templates(_email_environment)
+
+
+def recipients() -> List[str]:
+    return [address.strip() for address in LOW_STOCK_ALERT_RECIPIENTS.split(",") if address.strip()]
+
+
+def send_digest(db: Session, max_items: int = None) -> int:
+    """Queues one email per max_items products that went low since the last digest; returns how many products."""
+    to = recipients()
+    if not to:
+        return 0
+    max_items = max_items or LOW_STOCK_DIGEST_MAX_ITEMS
+    reported = 0
+    while True:
+        begin_write(db) # So two job runners can't report the same products
+        rows = db.execute(
+            select(products.c.id, products.c.product_id, products.c.name, products.c.available_stocks,
+                   products.c.reorder_level, low_stock.c.since)
+            .join(low_stock, low_stock.c.product_id == products.c.id)
+            .where(low_stock.c.alerted_at.is_(None))
+            .order_by(products.c.available_stocks, products.c.id)
+            .limit(max_items)
+        ).all()
+        if not rows:
+            db.rollback()
+            break
+        total = db.scalar(select(func.count()).select_from(low_stock))
+        body = _email_environment.get_template("low_stock_email.html").render(products=rows, total_low=total)
+        mailer.enqueue_email(db, to, DIGEST_SUBJECT, body, commit=False)
+        db.execute(low_stock.update().where(low_stock.c.product_id.in_([row.id for row in rows]))
+                   .values(alerted_at=_utcnow()))
+        db.commit() # The email and the alerted marks go together
+        reported += len(rows)
+        if len(rows) < max_items:
+            break
+    if reported:
+        mailer.notify_outbox()
+    return reported
+
+
+# --- Check / rebuild ---
+
+def scan(conn) -> set:
+    """Ids of every low product, from a full scan of the catalog."""
+    return set(conn.execute(select(products.c.id).where(_is_low())).scalars())
+
+
+def stored(conn) -> set:
+    return set(conn.execute(select(low_stock.c.product_id)).scalars())
+
+
+def rebuild(conn) -> int:
+    expected, listed = scan(conn), stored(conn)
+    gone = sorted(listed - expected)
+    if gone:
+        conn.execute(low_stock.delete().where(low_stock.c.product_id.in_(gone)))
+    missing = sorted(expected - listed)
+    if missing:
+        now = _utcnow()
+        conn.execute(low_stock.insert(), [{"product_id": product_id, "since": now} for product_id in missing])
+    return len(expected)
+
+
+def main(argv=None):
+    from database import SessionLocal, engine
+
+    parser = argparse.ArgumentParser(description="Check, rebuild or send the low-stock list.")
+    parser.add_argument("command", choices=["check", "rebuild", "digest"])
+    args = parser.parse_args(argv)
+
+    if args.command == "digest":
+        with SessionLocal() as db:
+            print(f"Queued a digest of {send_digest(db)} products" if recipients() else "No LOW_STOCK_ALERT_RECIPIENTS")
+        return 0
+    with engine.begin() as conn:
+        if args.command == "rebuild":
+            print(f"{rebuild(conn)} products are low")
+            return 0
+        expected, listed = scan(conn), stored(conn)
+    missing, extra = sorted(expected - listed), sorted(listed - expected)
+    for product_id in missing[:100]:
+        print(f"product {product_id}: low but not listed")
+    for product_id in extra[:100]:
+        print(f"product {product_id}: listed but not low")
+    print(f"{len(missing) + len(extra)} products differ" if missing or extra else "low_stock matches the catalog")
+    return 1 if missing or extra else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+# Outgoing email: the durable outbox table (models.EmailOutbox) and the worker
+# that drains it.
+#
+# Requests only INSERT a row (enqueue_email), so nothing on the request path
+# touches SMTP. OutboxWorker runs in a background thread (started by main on
+# startup) or as its own process (`python mailer.py`). It claims rows in batches,
+# sends them over one reused, authenticated SMTP connection, and retries failures
+# with exponential backoff. Rows survive restarts; a row left in "sending" by a
+# crashed worker is picked up again once its lease expires.
+import logging
+import os
+import random
+import smtplib
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import List
+
+from sqlalchemy import or_, update
+from sqlalchemy.orm import Session
+
+import metrics, models
+from database import SessionLocal
+
+logger = logging.getLogger("mailer")
+
+# --- Configuration for Email (Replace with your actual details, or set the environment variables) ---
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS", "") # Sender; the outbox isn't drained until it is set
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "") # Use app-specific passwords if available
+EMAIL_CC = os.getenv("EMAIL_CC", "") # Shop copy of every invoice; empty to disable
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com") # e.g., smtp.gmail.com
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587")) # or 465 for SSL
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+
+# --- Outbox worker ---
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50")) # Messages claimed and sent per round
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2.0")) # Seconds between polls when idle
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300")) # A claimed row is retried after this
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")) # Then the row is marked "dead"
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30")) # Seconds; doubles per attempt
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+OUTBOX_IDLE_DISCONNECT = float(os.getenv("OUTBOX_IDLE_DISCONNECT", "60")) # Close SMTP after this long idle
+
+
+def utcnow() -> datetime:
+    # Naive UTC, matching how next_attempt_at is stored
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def configured() -> bool:
+    return bool(EMAIL_ADDRESS)
+
+
+def invoice_recipients(customer_email: str):
+    return [customer_email] + ([EMAIL_CC] if EMAIL_CC else [])
+
+
+def enqueue_email(db: Session, recipients: List[str], subject: str, body_html: str, purchase_id: int = None,
+                  commit: bool = True):
+    # The row is the durable hand-off to OutboxWorker; nothing here talks to SMTP
+    db_email = models.EmailOutbox(
+        recipients=",".join(recipients),
+        subject=subject,
+        body_html=body_html,
+        purchase_id=purchase_id,
+        status="pending",
+        next_attempt_at=utcnow()
+    )
+    db.add(db_email)
+    if commit:
+        db.commit()
+    return db_email
+
+
+def build_message(row: models.EmailOutbox) -> MIMEMultipart:
+    recipients = row.recipients.split(",")
+    msg = MIMEMultipart()
+    msg['From'] = EMAIL_ADDRESS
+    msg['To'] = recipients[0]
+    if len(recipients) > 1:
+        msg['Cc'] = ", ".join(recipients[1:])
+    msg['Subject'] = row.subject
+    msg.attach(MIMEText(row.body_html, 'html'))
+    return msg
+
+
+def backoff_delay(attempts: int) -> float:
+    # Exponential with +/-20% jitter so a burst of failures doesn't retry in lockstep
+    delay = min(OUTBOX_BACKOFF_BASE * (2 ** max(attempts - 1, 0)), OUTBOX_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class SMTPSender:
+    """One authenticated SMTP connection, opened lazily and reused across messages."""
+
+    def __init__(self, host: str = None, port: int = None, username: str = None, password: str = None,
+                 starttls: bool = None, timeout: float = None):
+        self.host = host or SMTP_SERVER
+        self.port = port or SMTP_PORT
+        self.username = EMAIL_ADDRESS if username is None else username
+        self.password = EMAIL_PASSWORD if password is None else password
+        self.starttls = SMTP_STARTTLS if starttls is None else starttls
+        self.timeout = timeout or SMTP_TIMEOUT
+        self._server = None
+        self.connections_opened = 0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            server.starttls() # Secure the connection
+        if self.username and self.password:
+            server.login(self.username, self.password)
+        self._server = server
+        self.connections_opened += 1
+
+    def send(self, msg: MIMEMultipart, to_addrs):
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.send_message(msg, to_addrs=to_addrs)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped an idle connection; reconnect once and retry this message
+            self._server = None
+            self._connect()
+            self._server.send_message(msg, to_addrs=to_addrs)
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+
+def claim_batch(db: Session, limit: int = OUTBOX_BATCH_SIZE):
+    """Claims up to `limit` due rows for this worker and returns them.
+
+    Each row is claimed with a conditional UPDATE on the next_attempt_at value we
+    read, so several worker processes can share one outbox without sending twice.
+    """
+    now = utcnow()
+    candidates = db.query(models.EmailOutbox.id, models.EmailOutbox.next_attempt_at)\
+                   .filter(or_(models.EmailOutbox.status == "pending", models.EmailOutbox.status == "sending"))\
+                   .filter(models.EmailOutbox.next_attempt_at <= now)\
+                   .order_by(models.EmailOutbox.next_attempt_at, models.EmailOutbox.id)\
+                   .limit(limit).all()
+    lease_until = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+    claimed = []
+    for row_id, seen_next_attempt_at in candidates:
+        won = db.execute(
+            update(models.EmailOutbox)
+            .where(models.EmailOutbox.id == row_id)
+            .where(models.EmailOutbox.next_attempt_at == seen_next_attempt_at)
+            .values(status="sending", next_attempt_at=lease_until)
+        ).rowcount
+        if won:
+            claimed.append(row_id)
+    db.commit()
+    if not claimed:
+        return []
+    return db.query(models.EmailOutbox).filter(models.EmailOutbox.id.in_(claimed)).order_by(models.EmailOutbox.id).all()
+
+
+def send_batch(db: Session, sender: SMTPSender, rows):
+    """Sends claimed rows over `sender` and records the outcome. Returns the number sent.
+
+    Each row's outcome is committed as soon as it is known, and any error (a
+    message that won't build or encode as well as SMTP trouble) counts as a failed
+    attempt of that row alone, so rows already sent are never sent again.
+    """
+    sent = 0
+    for row in rows:
+        started = time.perf_counter()
+        try:
+            sender.send(build_message(row), to_addrs=row.recipients.split(","))
+        except Exception as e:
+            metrics.EMAIL_SEND.observe(time.perf_counter() - started, "failed")
+            sender.close() # Don't reuse a connection in an unknown state
+            row.attempts += 1
+            row.last_error = f"{type(e).__name__}: {e}"
+            if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+                row.status = "dead"
+                logger.error("Giving up on email %s to %s after %d attempts: %s", row.id, row.recipients, row.attempts, e)
+            else:
+                row.status = "pending"
+                row.next_attempt_at = utcnow() + timedelta(seconds=backoff_delay(row.attempts))
+                logger.warning("Email %s to %s failed (attempt %d), retrying at %s: %s",
+                               row.id, row.recipients, row.attempts, row.next_attempt_at, e)
+        else:
+            metrics.EMAIL_SEND.observe(time.perf_counter() - started, "sent")
+            row.attempts += 1
+            row.status = "sent"
+            row.sent_at = utcnow()
+            row.last_error = None
+            sent += 1
+        db.commit()
+    return sent
+
+
+class OutboxWorker(threading.Thread):
+    """Background thread that drains the outbox until stop() is called."""
+
+    def __init__(self, session_factory=SessionLocal, sender: SMTPSender = None, batch_size: int = OUTBOX_BATCH_SIZE,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL):
+        super().__init__(name="email-outbox", daemon=True)
+        self.session_factory = session_factory
+        self.sender = sender or SMTPSender()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.sent = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        """Tells the worker new mail was queued, so it doesn't wait for the next poll."""
+        self._wake.set()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        self._wake.set()
+        self.join(timeout)
+
+    def run_once(self) -> int:
+        """Claims and sends one batch; returns how many rows were claimed."""
+        with self.session_factory() as db:
+            rows = claim_batch(db, self.batch_size)
+            if rows:
+                self.sent += send_batch(db, self.sender, rows)
+            return len(rows)
+
+    def run(self):
+        idle_since = time.monotonic()
+        while not self._stopping.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception:
+                logger.exception("Email outbox worker round failed")
+                claimed = 0
+            if claimed:
+                idle_since = time.monotonic()
+                continue # More may be due; keep draining
+            if time.monotonic() - idle_since > OUTBOX_IDLE_DISCONNECT:
+                self.sender.close()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+        self.sender.close()
+
+
+# The worker started by main on app startup (None when disabled or running elsewhere)
+outbox_worker = None
+
+
+def notify_outbox():
+    if outbox_worker is not None:
+        outbox_worker.wake()
+
+
+if __name__ == "__main__":
+    # Run the sender as its own process: `python mailer.py`
+    logging.basicConfig(level=logging.INFO)
+    if not configured():
+        sys.exit("EMAIL_ADDRESS is not set; nothing will be sent")
+    worker = OutboxWorker()
+    logger.info("Draining the email outbox via %s:%s", worker.sender.host, worker.sender.port)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.sender.close()
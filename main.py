@@ -1,127 +1,232 @@
 import asyncio
-from fastapi import FastAPI, Depends, Request, Form, HTTPException, BackgroundTasks
-from fastapi.responses import HTMLResponse, RedirectResponse
+import contextlib
+import inspect
+import json
+import logging
+import os
+import uuid
+from fastapi import FastAPI, Depends, Request, File, Form, Header, HTTPException, UploadFile, WebSocket
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
-from typing import List, Dict, Union
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import models, crud, schemas
-from database import engine, get_db
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import List, Dict, Optional, Union
+from sqlalchemy.ext.asyncio import AsyncSession
+import models, crud, crud_async, api, billing, http_cache, jobs, live, low_stock, mailer, metrics, migrations, product_io, purchase_export, rollups, sales, schemas
+from change import DENOMINATIONS
+from database import SessionLocal, engine, get_db, get_async_db
 
-models.Base.metadata.create_all(bind=engine)
+logger = logging.getLogger("main")
 
 app = FastAPI()
+if http_cache.HTTP_COMPRESSION:
+    app.add_middleware(http_cache.CompressionMiddleware) # gzip / brotli for rendered pages; see http_cache.py
+app.add_middleware(metrics.MetricsMiddleware) # Latency, SQL and template time per route; see /metrics
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", http_cache.FingerprintedStaticFiles(directory="static"), name="static")
+app.include_router(api.router)
 templates = Jinja2Templates(directory="templates")
-
-# --- Configuration for Email (Replace with your actual details) ---
-EMAIL_ADDRESS = "dhineshparamasivam91@gmail.com"
-EMAIL_PASSWORD = "xldz veuu efjw pure" # Use app-specific passwords if available
-SMTP_SERVER = "smtp.gmail.com" # e.g., smtp.gmail.com
-SMTP_PORT = 587 # or 465 for SSL
-
-# Denominations available in the shop
-DENOMINATIONS = [2000, 500, 200, 100, 50, 20, 10, 5, 2, 1] # Example in INR
-
-# --- Helper Functions ---
-def calculate_change_denominations(balance: float, available_denominations: List[int]) -> Dict[int, int]:
-    change_breakdown = {}
-    remaining_balance = int(balance) # Work with integers for denominations
-
-    for denom in sorted(available_denominations, reverse=True):
-        if remaining_balance >= denom:
-            count = remaining_balance // denom
-            change_breakdown[denom] = count
-            remaining_balance %= denom
-    return change_breakdown
-
-async def send_invoice_email(customer_email: str, invoice_details: str):
-    msg = MIMEMultipart()
-    msg['From'] = EMAIL_ADDRESS
-    msg['To'] = customer_email
-    msg['Cc'] = "dhineshmsc2014@gmail.com"   # Add your copy here
-    msg['Subject'] = "Your Purchase Invoice"
-    msg.attach(MIMEText(invoice_details, 'html'))
-
-    # Combine main and CC recipients for sending
-    recipients = [customer_email, "dhineshmsc2014@gmail.com"]
-
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()  # Secure the connection
-            server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            server.send_message(msg, to_addrs=recipients)
-        print(f"Invoice email sent successfully to {customer_email} (CC to dhineshmsc2014@gmail.com)")
-    except Exception as e:
-        print(f"Failed to send email to {customer_email}: {e}")
+templates.env.globals["static_url"] = http_cache.static_url
+metrics.instrument_templates(templates.env)
+
+# Start the email outbox sender in this process (set to 0 when running `python mailer.py` separately)
+EMAIL_OUTBOX_WORKER = os.getenv("EMAIL_OUTBOX_WORKER", "1") == "1"
+# Run periodic jobs (jobs.py) in this process (set to 0 when running `python jobs.py` separately)
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS", "1") == "1"
+# Apply pending migrations on start; only for a single process (with several workers, run `python migrations.py` first)
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "0") == "1"
+# Dashboard sales widgets: the daily trend and the tax / top product tables cover this many days
+DASHBOARD_TREND_DAYS = 7
+DASHBOARD_REPORT_DAYS = 30
+DASHBOARD_RECENT_PURCHASES = 10
+# A live products update naming more products than this (a bulk import) asks pages to reload instead
+LIVE_MAX_PRODUCT_ROWS = 500
 
 # --- Routes ---
 
 @app.on_event("startup")
 async def startup_event():
-    """Seeds initial product data if the database is empty."""
-    db = next(get_db())
-    if not crud.get_products(db):
-        print("Seeding initial product data...")
-        crud.create_product(db, schemas.ProductCreate(name="Laptop", product_id="P001", available_stocks=50, price=1200.00, tax_percentage=18.0))
-        crud.create_product(db, schemas.ProductCreate(name="Mouse", product_id="P002", available_stocks=200, price=25.00, tax_percentage=18.0))
-        crud.create_product(db, schemas.ProductCreate(name="Keyboard", product_id="P003", available_stocks=100, price=75.00, tax_percentage=18.0))
-        crud.create_product(db, schemas.ProductCreate(name="Monitor", product_id="P004", available_stocks=30, price=300.00, tax_percentage=18.0))
-        crud.create_product(db, schemas.ProductCreate(name="Webcam", product_id="P005", available_stocks=150, price=50.00, tax_percentage=18.0))
-        crud.create_product(db, schemas.ProductCreate(name="Speaker", product_id="P006", available_stocks=80, price=80.00, tax_percentage=12.0))
-        print("Product data seeded.")
-    db.close()
+    """Checks the schema is current (one query), then starts the background workers.
+
+    Migrations and seeding are a deploy step, `python migrations.py [--seed]`,
+    so workers don't each pay for them or race each other on a fresh database.
+    """
+    if AUTO_MIGRATE:
+        await asyncio.to_thread(migrations.prepare, engine)
+    pending = await asyncio.to_thread(migrations.pending, engine)
+    if pending:
+        raise RuntimeError(f"Database has {len(pending)} pending migration(s) "
+                           f"({', '.join(name for _, name in pending)}); run `python migrations.py` first")
+
+    if EMAIL_OUTBOX_WORKER and not mailer.configured():
+        logger.warning("EMAIL_ADDRESS is not set; invoice emails stay queued in the outbox")
+    elif EMAIL_OUTBOX_WORKER:
+        mailer.outbox_worker = mailer.OutboxWorker()
+        mailer.outbox_worker.start()
+    if BACKGROUND_JOBS:
+        jobs.job_runner = jobs.JobRunner()
+        jobs.job_runner.start()
+    if live.LIVE_UPDATES:
+        live.broadcaster.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await live.broadcaster.stop()
+    if mailer.outbox_worker is not None:
+        await asyncio.to_thread(mailer.outbox_worker.stop)
+        mailer.outbox_worker = None
+    if jobs.job_runner is not None:
+        await asyncio.to_thread(jobs.job_runner.stop)
+        jobs.job_runner = None
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request, db: Session = Depends(get_db)): # Add db dependency
-    recent_purchases = crud.get_recent_purchases(db, limit=10) # Fetch recent purchases
+async def read_root(request: Request, db: AsyncSession = Depends(get_async_db)): # Add db dependency
+    recent_purchases = await crud_async.get_recent_purchases(db, limit=DASHBOARD_RECENT_PURCHASES)
+    # Sales widgets, all from the rollup tables (rollups.py)
+    today = rollups.today()
+    last_week = await crud_async.get_daily_sales(db, today - timedelta(days=DASHBOARD_TREND_DAYS - 1), today)
+    report_start = today - timedelta(days=DASHBOARD_REPORT_DAYS - 1)
     return templates.TemplateResponse(
         "dashboard.html", # Render the new dashboard template
         {
             "request": request,
-            "recent_purchases": recent_purchases # Pass the data to the template
+            "recent_purchases": recent_purchases, # Pass the data to the template
+            "today": next((day for day in last_week if day.day == today), None),
+            "last_week": last_week,
+            "report_days": DASHBOARD_REPORT_DAYS,
+            "tax_by_rate": await crud_async.get_tax_by_rate(db, report_start, today),
+            "top_products": await crud_async.get_top_products(db, report_start, today, limit=5),
         }
     )
+# --- Live updates (live.py): the dashboard and product pages subscribe instead of reloading ---
+
+@app.websocket("/ws/live")
+async def live_updates(websocket: WebSocket, topics: str = "sales,products"):
+    wanted = {topic for topic in topics.split(",") if topic in live.TOPICS}
+    subscriber = live.broadcaster.subscribe(wanted) if live.LIVE_UPDATES and wanted else None
+    if subscriber is None:
+        await websocket.close(code=1013) # Off, or too many viewers: the page keeps working without
+        return
+    try:
+        await websocket.accept()
+        await live.serve(websocket, subscriber)
+    finally:
+        live.broadcaster.unsubscribe(subscriber)
+
+@contextlib.asynccontextmanager
+async def _live_session():
+    # Same session source as the routes (tests and benchmarks override get_async_db, maybe with a sync Session)
+    dependency = app.dependency_overrides.get(get_async_db, get_async_db)
+    if inspect.isasyncgenfunction(dependency):
+        async with contextlib.asynccontextmanager(dependency)() as db:
+            yield db
+    else:
+        with contextlib.contextmanager(dependency)() as db:
+            yield db
+
+@live.broadcaster.renderer("sales")
+async def render_live_sales(keys) -> str:
+    """The dashboard's "Today's Sales" and "Recent Purchases", rendered once for every viewer."""
+    today = rollups.today()
+    async with _live_session() as db:
+        recent_purchases = await crud_async.get_recent_purchases(db, limit=DASHBOARD_RECENT_PURCHASES)
+        days = await crud_async.get_daily_sales(db, today, today)
+    sections = templates.env.get_template("dashboard_live.html").module
+    return json.dumps({"topic": "sales", "html": {
+        "sales-today": str(sections.sales_today(days[0] if days else None)),
+        "recent-purchases": str(sections.recent_purchases_table(recent_purchases)),
+    }})
+
+@live.broadcaster.renderer("products")
+async def render_live_products(keys) -> str:
+    """Current rows of the products that changed; pages patch the ones they show."""
+    if len(keys) > LIVE_MAX_PRODUCT_ROWS:
+        return json.dumps({"topic": "products", "reload": True})
+    async with _live_session() as db:
+        products = await crud_async.get_products_by_ids(db, keys)
+    return json.dumps({
+        "topic": "products",
+        "products": [{"id": p.id, "name": p.name, "product_id": p.product_id, "available_stocks": p.available_stocks,
+                      "price": f"{p.price:.2f}", "tax_percentage": f"{p.tax_percentage:.2f}"}
+                     for p in products.values()],
+        "deleted": sorted(key for key in keys if key not in products),
+    })
+
 # --- Product CRUD (Admin Pages) ---
+PRODUCTS_PAGE_SIZE = 50
+
+# The admin pages below are plain `def` routes on the sync session: Starlette runs
+# them in its thread pool, so their queries don't block the event loop.
+
 @app.get("/products/", response_class=HTMLResponse)
-async def list_products(request: Request, db: Session = Depends(get_db)):
-    products = crud.get_products(db)
-    return templates.TemplateResponse("products.html", {"request": request, "products": products})
+def list_products(request: Request, after: Optional[int] = None, before: Optional[int] = None,
+                        limit: int = PRODUCTS_PAGE_SIZE, db: Session = Depends(get_db)):
+    limit = max(1, min(limit, 500))
+    products, has_more = crud.get_products_page(db, after_id=after, before_id=before, limit=limit)
+    # Keyset cursors: ids of the last/first row on this page
+    next_after, prev_before = crud.keyset_cursors(products, has_more, after, before)
+    # Validator from what the page shows; stock changes with every sale, so there is no cheaper key
+    tag = http_cache.etag("products", limit, next_after, prev_before,
+                          [(p.id, p.product_id, p.name, p.available_stocks, str(p.price), str(p.tax_percentage))
+                           for p in products])
+    headers = http_cache.validator_headers(tag, http_cache.REVALIDATE)
+    if http_cache.is_fresh(request.headers, tag):
+        return http_cache.not_modified(headers)
+    return templates.TemplateResponse("products.html", {"request": request, "products": products, "limit": limit,
+                                                        "next_after": next_after, "prev_before": prev_before},
+                                      headers=headers)
+
+@app.get("/products/low_stock", response_class=HTMLResponse)
+def low_stock_products(request: Request, limit: int = 200, db: Session = Depends(get_db)):
+    """Products at or below their reorder level, read from the low_stock list (not a catalog scan)."""
+    rows, total = low_stock.get_low_stock(db, max(1, min(limit, 1000)))
+    return templates.TemplateResponse("low_stock.html", {"request": request, "rows": rows, "total": total})
+
+@app.get("/products/search")
+async def search_products(q: str = "", limit: int = 10, db: AsyncSession = Depends(get_async_db)):
+    """Autocomplete: products whose product_id or name starts with `q` (case-insensitive)."""
+    if not q.strip():
+        return []
+    matches = await crud_async.search_catalog(db, q.strip(), max(1, min(limit, 50)))
+    return [{"product_id": entry.product_id, "name": entry.name, "price": str(entry.price)} for entry in matches]
 
 @app.get("/products/add/", response_class=HTMLResponse)
 async def add_product_form(request: Request):
     return templates.TemplateResponse("add_product.html", {"request": request, "errors": {}})
 
 @app.post("/products/add/", response_class=HTMLResponse)
-async def create_product_route(
+def create_product_route(
     request: Request,
     name: str = Form(...),
     product_id: str = Form(...),
     available_stocks: int = Form(...),
-    price: float = Form(...),
-    tax_percentage: float = Form(...),
+    price: Decimal = Form(...),
+    tax_percentage: Decimal = Form(...),
+    reorder_level: int = Form(0),
     db: Session = Depends(get_db)
 ):
     errors = {}
-    if crud.get_product_by_name(db, name):
+    if crud.get_catalog_product(db, "name", name):
         errors["name"] = "Product with this name already exists."
-    if crud.get_product_by_product_id_str(db, product_id):
+    if crud.get_catalog_product(db, "product_id", product_id):
         errors["product_id"] = "Product with this Product ID already exists."
 
     if errors:
         return templates.TemplateResponse("add_product.html", {"request": request, "errors": errors,
                                                                 "name": name, "product_id": product_id,
                                                                 "available_stocks": available_stocks,
-                                                                "price": price, "tax_percentage": tax_percentage})
+                                                                "price": price, "tax_percentage": tax_percentage,
+                                                                "reorder_level": reorder_level})
 
     try:
         product_schema = schemas.ProductCreate(
             name=name, product_id=product_id, available_stocks=available_stocks,
-            price=price, tax_percentage=tax_percentage
+            price=price, tax_percentage=tax_percentage, reorder_level=reorder_level
         )
         crud.create_product(db, product_schema)
         return RedirectResponse(url="/products/", status_code=303)
@@ -130,24 +235,26 @@ async def create_product_route(
         return templates.TemplateResponse("add_product.html", {"request": request, "errors": errors,
                                                                 "name": name, "product_id": product_id,
                                                                 "available_stocks": available_stocks,
-                                                                "price": price, "tax_percentage": tax_percentage})
+                                                                "price": price, "tax_percentage": tax_percentage,
+                                                                "reorder_level": reorder_level})
 
 @app.get("/products/edit/{product_id}", response_class=HTMLResponse)
-async def edit_product_form(request: Request, product_id: int, db: Session = Depends(get_db)):
+def edit_product_form(request: Request, product_id: int, db: Session = Depends(get_db)):
     product = crud.get_product(db, product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     return templates.TemplateResponse("add_product.html", {"request": request, "product": product, "errors": {}})
 
 @app.post("/products/edit/{product_id}", response_class=HTMLResponse)
-async def update_product_route(
+def update_product_route(
     request: Request,
     product_id: int,
     name: str = Form(...),
     product_id_str: str = Form(..., alias="product_id"), # Renamed to avoid conflict with path param
     available_stocks: int = Form(...),
-    price: float = Form(...),
-    tax_percentage: float = Form(...),
+    price: Decimal = Form(...),
+    tax_percentage: Decimal = Form(...),
+    reorder_level: int = Form(0),
     db: Session = Depends(get_db)
 ):
     product = crud.get_product(db, product_id)
@@ -155,20 +262,21 @@ async def update_product_route(
         raise HTTPException(status_code=404, detail="Product not found")
 
     errors = {}
-    if name != product.name and crud.get_product_by_name(db, name):
+    if name != product.name and crud.get_catalog_product(db, "name", name):
         errors["name"] = "Product with this name already exists."
-    if product_id_str != product.product_id and crud.get_product_by_product_id_str(db, product_id_str):
+    if product_id_str != product.product_id and crud.get_catalog_product(db, "product_id", product_id_str):
         errors["product_id"] = "Product with this Product ID already exists."
 
     if errors:
         return templates.TemplateResponse("add_product.html", {"request": request, "errors": errors, "product": product,
                                                                 "name": name, "product_id": product_id_str, # Use product_id_str here
                                                                 "available_stocks": available_stocks,
-                                                                "price": price, "tax_percentage": tax_percentage})
+                                                                "price": price, "tax_percentage": tax_percentage,
+                                                                "reorder_level": reorder_level})
     try:
         product_schema = schemas.ProductCreate(
             name=name, product_id=product_id_str, available_stocks=available_stocks,
-            price=price, tax_percentage=tax_percentage
+            price=price, tax_percentage=tax_percentage, reorder_level=reorder_level
         )
         crud.update_product(db, product_id, product_schema)
         return RedirectResponse(url="/products/", status_code=303)
@@ -177,215 +285,189 @@ async def update_product_route(
         return templates.TemplateResponse("add_product.html", {"request": request, "errors": errors, "product": product,
                                                                 "name": name, "product_id": product_id_str,
                                                                 "available_stocks": available_stocks,
-                                                                "price": price, "tax_percentage": tax_percentage})
+                                                                "price": price, "tax_percentage": tax_percentage,
+                                                                "reorder_level": reorder_level})
 
 
 @app.post("/products/delete/{product_id}", response_class=HTMLResponse)
-async def delete_product_route(product_id: int, db: Session = Depends(get_db)):
+def delete_product_route(product_id: int, db: Session = Depends(get_db)):
     crud.delete_product(db, product_id)
     return RedirectResponse(url="/products/", status_code=303)
 
+@app.get("/products/import", response_class=HTMLResponse)
+async def import_products_form(request: Request):
+    return templates.TemplateResponse("products_import.html", {"request": request, "report": None, "errors": {}})
+
+@app.post("/products/import", response_class=HTMLResponse)
+def import_products_route(request: Request, file: UploadFile = File(...), db: Session = Depends(get_db)):
+    try:
+        fmt = product_io.format_for(file.filename)
+    except ValueError as e:
+        return templates.TemplateResponse("products_import.html", {"request": request, "report": None,
+                                                                   "errors": {"file": str(e)}})
+    # Large uploads are spooled to disk and read back a row at a time, in the thread pool like the route
+    report = product_io.import_products(db, file.file, fmt)
+    return templates.TemplateResponse("products_import.html", {"request": request, "report": report,
+                                                               "filename": file.filename, "errors": {}})
+
+@app.get("/products/export")
+async def export_products(format: str = "csv"):
+    if format not in product_io.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be csv or jsonl")
+
+    def chunks():
+        # Its own session: request dependencies are closed before a streamed body is sent
+        with SessionLocal() as db:
+            yield from product_io.export_chunks(db, format)
+
+    return StreamingResponse(chunks(), media_type=product_io.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="products.{format}"'})
+
+@app.get("/purchases/export")
+async def export_purchases(start: date, end: date, format: str = "csv.gz"):
+    """Every purchase line from start to end (inclusive) for accounting; see purchase_export.py."""
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    try:
+        purchase_export.check_format(format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def chunks():
+        # Its own session: request dependencies are closed before a streamed body is sent
+        with SessionLocal() as db:
+            yield from purchase_export.export_chunks(db, format, start, end)
+
+    filename = f"purchases-{start}-{end}.{format}"
+    return StreamingResponse(chunks(), media_type=purchase_export.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# --- Cash Drawer ---
+
+@app.get("/drawer/", response_class=HTMLResponse)
+async def drawer_page(request: Request, db: AsyncSession = Depends(get_async_db)):
+    counts = await crud_async.get_drawer_counts(db)
+    return templates.TemplateResponse("drawer.html", {"request": request, "counts": counts,
+                                                      "low": sales.low_denominations(counts), "errors": {}})
+
+@app.post("/drawer/", response_class=HTMLResponse)
+async def update_drawer(request: Request, db: AsyncSession = Depends(get_async_db)):
+    form = await request.form()
+    counts = await crud_async.get_drawer_counts(db)
+    errors = {}
+    new_counts = {}
+    for denomination in counts:
+        value = form.get(f"count_{denomination}", "")
+        try:
+            new_counts[denomination] = int(value)
+        except ValueError:
+            errors[denomination] = "Enter a whole number."
+            continue
+        if new_counts[denomination] < 0:
+            errors[denomination] = "Count cannot be negative."
+    if errors:
+        return templates.TemplateResponse("drawer.html", {"request": request, "counts": counts,
+                                                          "low": sales.low_denominations(counts), "errors": errors})
+    await crud_async.set_drawer_counts(db, new_counts)
+    return RedirectResponse(url="/drawer/", status_code=303)
+
 # --- Billing Page (Page 1) ---
 
 @app.get("/billing/", response_class=HTMLResponse)
-async def billing_page(request: Request, db: Session = Depends(get_db)):
-    products = crud.get_products(db) # To display product IDs
-    return templates.TemplateResponse("billing.html", {"request": request, "products": products, "denominations": DENOMINATIONS, "errors": {}})
+async def billing_page(request: Request):
+    # Product suggestions are fetched on demand from /products/search
+    # Each rendered form carries a fresh key, so a resubmission of it records one purchase
+    return templates.TemplateResponse("billing.html", {"request": request, "denominations": DENOMINATIONS, "errors": {},
+                                                       "idempotency_key": uuid.uuid4().hex})
 
 @app.post("/generate_bill/", response_class=HTMLResponse)
 async def generate_bill(
     request: Request,
-    background_tasks: BackgroundTasks,
     customer_email: str = Form(...),
     product_ids: List[str] = Form(..., alias="product_id"), # Renamed alias to avoid conflict
     quantities: List[int] = Form(...),
-    paid_amount: float = Form(...),
-    db: Session = Depends(get_db)
+    paid_amount: Decimal = Form(...),
+    form_idempotency_key: Optional[str] = Form(None, alias="idempotency_key"),
+    header_idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    errors = {}
-    items_to_purchase = []
-    total_bill_amount = 0.0
-    total_tax_amount = 0.0
+    # A resubmitted bill (retry, double click) returns the purchase already recorded for its key
+    idempotency_key = (header_idempotency_key or form_idempotency_key or "").strip() or None
+    if idempotency_key and len(idempotency_key) > crud.IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency key is too long")
 
-    # Validate inputs
-    if not customer_email:
-        errors["customer_email"] = "Customer email is required."
-    if not product_ids or not quantities:
-        errors["products"] = "At least one product must be added."
+    errors = {}
     if len(product_ids) != len(quantities):
         errors["products"] = "Mismatch in product IDs and quantities."
-    if paid_amount <= 0:
-        errors["paid_amount"] = "Paid amount must be positive."
-
-    detailed_items = []
-
-    for i in range(len(product_ids)):
-        prod_id_str = product_ids[i]
-        qty = quantities[i]
-
-        product = crud.get_product_by_product_id_str(db, prod_id_str)
-        if not product:
-            errors[f"product_{i}"] = f"Product with ID '{prod_id_str}' not found."
-            continue
-        if qty <= 0:
-            errors[f"quantity_{i}"] = f"Quantity for {product.name} must be positive."
-            continue
-        if product.available_stocks < qty:
-            errors[f"stock_{i}"] = f"Not enough stock for {product.name}. Available: {product.available_stocks}, Requested: {qty}"
-            continue
-
-        item_price_before_tax = product.price * qty
-        item_tax = item_price_before_tax * (product.tax_percentage / 100)
-        item_total_price = item_price_before_tax + item_tax
-
-        total_bill_amount += item_total_price
-        total_tax_amount += item_tax
-
-        items_to_purchase.append(schemas.PurchaseItemCreate(product_id=product.id, quantity=qty))
-        detailed_items.append({
-            "product_name": product.name,
-            "product_id": product.product_id,
-            "quantity": qty,
-            "unit_price": product.price,
-            "tax_percentage": product.tax_percentage,
-            "item_price_before_tax": round(item_price_before_tax, 2),
-            "item_tax": round(item_tax, 2),
-            "item_total_price": round(item_total_price, 2)
-        })
+    else:
+        basket = schemas.BasketCreate(
+            customer_email=customer_email, paid_amount=paid_amount, idempotency_key=idempotency_key,
+            items=[schemas.BasketLine(product_id=product_id, quantity=qty) for product_id, qty in zip(product_ids, quantities)]
+        )
+        try:
+            invoice, replayed = await billing.checkout(db, basket)
+        except billing.BasketRejected as e:
+            errors = e.errors
+        except Exception as e:
+            errors["general"] = f"Failed to record purchase: {e}"
 
     if errors:
-        products = crud.get_products(db)
-        return templates.TemplateResponse("billing.html", {"request": request, "products": products, "denominations": DENOMINATIONS, "errors": errors,
-                                                            "customer_email": customer_email, "old_product_ids": product_ids, "old_quantities": quantities,
-                                                            "paid_amount": paid_amount})
-
-    # Get or create customer
-    customer = crud.get_customer_by_email(db, customer_email)
-    if not customer:
-        customer = crud.create_customer(db, customer_email)
-
-    # Calculate balance
-    balance_to_return = paid_amount - total_bill_amount
-    if balance_to_return < 0:
-        errors["paid_amount"] = f"Paid amount is less than total bill. Remaining: {abs(balance_to_return):.2f}"
-        products = crud.get_products(db)
-        return templates.TemplateResponse("billing.html", {"request": request, "products": products, "denominations": DENOMINATIONS, "errors": errors,
+        return templates.TemplateResponse("billing.html", {"request": request, "denominations": DENOMINATIONS, "errors": errors,
                                                             "customer_email": customer_email, "old_product_ids": product_ids, "old_quantities": quantities,
-                                                            "paid_amount": paid_amount})
-
-
-    # Create purchase record
-    try:
-        purchase = crud.create_purchase(db, customer.id, total_bill_amount, paid_amount, items_to_purchase)
-    except Exception as e:
-        errors["general"] = f"Failed to record purchase: {e}"
-        products = crud.get_products(db)
-        return templates.TemplateResponse("billing.html", {"request": request, "products": products, "denominations": DENOMINATIONS, "errors": errors,
-                                                            "customer_email": customer_email, "old_product_ids": product_ids, "old_quantities": quantities,
-                                                            "paid_amount": paid_amount})
+                                                            "paid_amount": paid_amount, "idempotency_key": idempotency_key})
+    if invoice is None:
+        raise HTTPException(status_code=404, detail="Purchase not found")
 
-    # Calculate change denominations
-    change_breakdown = calculate_change_denominations(balance_to_return, DENOMINATIONS)
+    # Render bill details page
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return templates.TemplateResponse("bill_details.html", {"request": request, **invoice}, headers=headers)
 
-    # Prepare invoice details for email
-    invoice_html = templates.TemplateResponse(
-        "bill_details_email.html",
-        {
-            "request": request, # This is not used in the email template but required by TemplateResponse
-            "customer_email": customer_email,
-            "purchase_id": purchase.id,
-            "detailed_items": detailed_items,
-            "total_bill_amount": round(total_bill_amount, 2),
-            "total_tax_amount": round(total_tax_amount, 2),
-            "paid_amount": round(paid_amount, 2),
-            "balance_to_return": round(balance_to_return, 2),
-            "change_breakdown": change_breakdown,
-            "purchase_time": purchase.purchase_time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-    ).body.decode("utf-8") # Get the rendered HTML content
+# --- View Previous Purchases ---
 
-    # Send email in background
-    background_tasks.add_task(send_invoice_email, customer_email, invoice_html)
+CUSTOMER_PURCHASES_PAGE_SIZE = 20
 
-    # Render bill details page
-    return templates.TemplateResponse(
-        "bill_details.html",
-        {
-            "request": request,
-            "customer_email": customer_email,
-            "purchase_id": purchase.id,
-            "detailed_items": detailed_items,
-            "total_bill_amount": round(total_bill_amount, 2),
-            "total_tax_amount": round(total_tax_amount, 2),
-            "paid_amount": round(paid_amount, 2),
-            "balance_to_return": round(balance_to_return, 2),
-            "change_breakdown": change_breakdown,
-            "purchase_time": purchase.purchase_time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-    )
+async def _render_customer_purchases(request: Request, db: AsyncSession, customer_email: str,
+                                     after: Optional[int] = None, before: Optional[int] = None,
+                                     limit: int = CUSTOMER_PURCHASES_PAGE_SIZE):
+    context = {"request": request, "customer_email": customer_email, "purchases": [], "totals": None,
+               "limit": limit, "next_after": None, "prev_before": None, "errors": {}}
+    if not customer_email:
+        return templates.TemplateResponse("customer_purchases.html", context)
+    customer = await crud_async.get_customer_by_email(db, customer_email)
+    if not customer:
+        context["errors"]["customer_email"] = "No customer found with this email."
+        return templates.TemplateResponse("customer_purchases.html", context)
 
-# --- View Previous Purchases ---
+    limit = max(1, min(limit, 200))
+    purchases, has_more = await crud_async.get_customer_purchases(db, customer.id, after_id=after, before_id=before,
+                                                                  limit=limit)
+    next_after, prev_before = crud.keyset_cursors(purchases, has_more, after, before) # Older pages come after
+    context.update(purchases=purchases, totals=await crud_async.get_customer_totals(db, customer.id), limit=limit,
+                   next_after=next_after, prev_before=prev_before)
+    return templates.TemplateResponse("customer_purchases.html", context)
 
 @app.get("/customer_purchases/", response_class=HTMLResponse)
-async def get_customer_purchases_page(request: Request):
-    return templates.TemplateResponse("customer_purchases.html", {"request": request, "customer_email": "", "purchases": [], "errors": {}})
+async def get_customer_purchases_page(request: Request, customer_email: str = "", after: Optional[int] = None,
+                                      before: Optional[int] = None, limit: int = CUSTOMER_PURCHASES_PAGE_SIZE,
+                                      db: AsyncSession = Depends(get_async_db)):
+    return await _render_customer_purchases(request, db, customer_email, after, before, limit)
 
 @app.post("/customer_purchases/", response_class=HTMLResponse)
 async def post_customer_purchases_page(
     request: Request,
     customer_email: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    errors = {}
-    customer = crud.get_customer_by_email(db, customer_email)
-    if not customer:
-        errors["customer_email"] = "No customer found with this email."
-        return templates.TemplateResponse("customer_purchases.html", {"request": request, "customer_email": customer_email, "purchases": [], "errors": errors})
-
-    purchases = crud.get_customer_purchases(db, customer.id)
-    return templates.TemplateResponse("customer_purchases.html", {"request": request, "customer_email": customer_email, "purchases": purchases, "errors": {}})
+    return await _render_customer_purchases(request, db, customer_email)
 
 @app.get("/purchase_details/{purchase_id}", response_class=HTMLResponse)
-async def view_purchase_details(request: Request, purchase_id: int, db: Session = Depends(get_db)):
-    purchase = crud.get_purchase_details(db, purchase_id)
-    if not purchase:
+async def view_purchase_details(request: Request, purchase_id: int, db: AsyncSession = Depends(get_async_db)):
+    # `reconcile.py recompute --totals` can still rewrite a stored purchase, so the ETag covers the
+    # invoice itself and browsers revalidate; a cached invoice answers that without the database
+    invoice = await billing.stored_invoice(db, purchase_id)
+    if invoice is None:
         raise HTTPException(status_code=404, detail="Purchase not found")
-
-    detailed_items = []
-    total_tax_amount = 0.0
-    for item in purchase.items:
-        item_price_before_tax = item.price_at_purchase * item.quantity
-        item_tax = item_price_before_tax * (item.tax_percentage_at_purchase / 100)
-        item_total_price = item_price_before_tax + item_tax
-        total_tax_amount += item_tax
-
-        detailed_items.append({
-            "product_name": item.product.name,
-            "product_id": item.product.product_id,
-            "quantity": item.quantity,
-            "unit_price": item.price_at_purchase,
-            "tax_percentage": item.tax_percentage_at_purchase,
-            "item_price_before_tax": round(item_price_before_tax, 2),
-            "item_tax": round(item_tax, 2),
-            "item_total_price": round(item_total_price, 2)
-        })
-
-    balance_to_return = purchase.paid_amount - purchase.total_amount
-    change_breakdown = calculate_change_denominations(balance_to_return, DENOMINATIONS)
-
-
-    return templates.TemplateResponse(
-        "bill_details.html",
-        {
-            "request": request,
-            "customer_email": purchase.customer.email,
-            "purchase_id": purchase.id,
-            "detailed_items": detailed_items,
-            "total_bill_amount": round(purchase.total_amount, 2),
-            "total_tax_amount": round(total_tax_amount, 2),
-            "paid_amount": round(purchase.paid_amount, 2),
-            "balance_to_return": round(balance_to_return, 2),
-            "change_breakdown": change_breakdown,
-            "purchase_time": purchase.purchase_time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-    )
\ No newline at end of file
+    headers = http_cache.validator_headers(http_cache.etag("purchase", invoice), http_cache.REVALIDATE)
+    if http_cache.is_fresh(request.headers, headers["ETag"]):
+        return http_cache.not_modified(headers)
+    return templates.TemplateResponse("bill_details.html", {"request": request, **invoice}, headers=headers)
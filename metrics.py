@@ -0,0 +1,264 @@
+# Request-level performance metrics, exposed in Prometheus text format on /metrics.
+#
+#   http_request_duration_seconds{method,route,status}  histogram, per route template
+#   http_request_sql_statements{route}                  histogram of statements per request
+#   http_request_sql_seconds{route}                     histogram of SQL time per request
+#   template_render_seconds{template}                   histogram of Jinja render time
+#   email_send_seconds{outcome}                         histogram of SMTP sends (mailer.py)
+#   db_statements_total, db_statement_seconds_total     counters for all SQL, in requests or not
+#
+# SQL is timed with engine events on every Engine (the async engines too), and
+# templates by the Jinja template class set up with instrument_templates. Each
+# request's share is gathered in a context variable set by MetricsMiddleware;
+# worker threads and SQLAlchemy's async greenlets inherit it. Metrics are per
+# process: with several uvicorn workers, scrape each one or run a single worker.
+#
+# Opt-in slow request profiling: with PROFILE_SLOW_REQUESTS_MS set, a sampler
+# thread records the stacks of the threads serving each request, and requests
+# slower than that threshold are written to PROFILE_DIR as collapsed stacks
+# ("frame;frame;frame count" lines) for flamegraph.pl, speedscope or inferno.
+import bisect
+import contextvars
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import jinja2
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Seconds
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+PROFILE_SLOW_REQUESTS_MS = float(os.getenv("PROFILE_SLOW_REQUESTS_MS", "0")) # 0 disables the profiler
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) # Sampling period
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.label_names = name, help_text, tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {} # label values -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket{_labels(self.label_names + ('le',), label_values + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, label_values)} {total!r}"
+            yield f"{self.name}_count{_labels(self.label_names, label_values)} {cumulative}"
+
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help_text = name, help_text
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        yield f"{self.name} {self.value!r}"
+
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Request latency by route template.",
+                             ("method", "route", "status"))
+REQUEST_SQL_STATEMENTS = Histogram("http_request_sql_statements", "SQL statements executed per request.",
+                                   ("route",), STATEMENT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram("http_request_sql_seconds", "Time spent in SQL per request.", ("route",))
+TEMPLATE_RENDER = Histogram("template_render_seconds", "Jinja template render time.", ("template",))
+EMAIL_SEND = Histogram("email_send_seconds", "SMTP send time per message.", ("outcome",))
+DB_STATEMENTS = CounterMetric("db_statements_total", "SQL statements executed.")
+DB_STATEMENT_SECONDS = CounterMetric("db_statement_seconds_total", "Time spent executing SQL.")
+
+METRICS = [REQUEST_DURATION, REQUEST_SQL_STATEMENTS, REQUEST_SQL_SECONDS, TEMPLATE_RENDER, EMAIL_SEND,
+           DB_STATEMENTS, DB_STATEMENT_SECONDS]
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.collect()) + "\n"
+
+
+# --- Per-request accounting ---
+
+class RequestStats:
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.threads = {threading.get_ident()} # Threads that worked on the request, for the profiler
+
+    def touch(self):
+        self.threads.add(threading.get_ident())
+
+
+_current = contextvars.ContextVar("request_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("query_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    DB_STATEMENTS.inc()
+    DB_STATEMENT_SECONDS.inc(elapsed)
+    stats = _current.get()
+    if stats is not None:
+        stats.sql_statements += 1
+        stats.sql_seconds += elapsed
+        stats.touch()
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
+
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            TEMPLATE_RENDER.observe(time.perf_counter() - started, self.name or "<string>")
+            stats = _current.get()
+            if stats is not None:
+                stats.touch()
+
+
+def instrument_templates(environment: jinja2.Environment):
+    """Times every template the environment loads from now on."""
+    environment.template_class = TimedTemplate
+
+
+# --- Slow request profiler ---
+
+class _Sampler(threading.Thread):
+    """Samples the stacks of one request's threads until stopped."""
+
+    def __init__(self, stats: RequestStats):
+        super().__init__(name="request-profiler", daemon=True)
+        self.stats = stats
+        self.samples = Counter()
+        self._stopping = threading.Event()
+
+    def run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while not self._stopping.wait(interval):
+            frames = sys._current_frames()
+            for ident in list(self.stats.threads):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[_collapse(frame)] += 1
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def _write_profile(method: str, route: str, duration: float, samples: Counter):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%f")
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    path = os.path.join(PROFILE_DIR, f"{stamp}-{method}-{slug}-{duration * 1000:.0f}ms.folded")
+    with open(path, "w", encoding="utf-8") as out:
+        for stack, count in samples.most_common():
+            out.write(f"{stack} {count}\n")
+    return path
+
+
+# --- Middleware ---
+
+def _route_template(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched" # Templates, not raw paths, to bound the label set
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, SQL and (opt-in) profiles per HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = _current.set(stats)
+        sampler = _Sampler(stats) if PROFILE_SLOW_REQUESTS_MS > 0 else None
+        if sampler is not None:
+            sampler.start()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - started # Includes streaming the body
+            _current.reset(token)
+            route = _route_template(scope)
+            REQUEST_DURATION.observe(duration, scope["method"], route, status)
+            REQUEST_SQL_STATEMENTS.observe(stats.sql_statements, route)
+            REQUEST_SQL_SECONDS.observe(stats.sql_seconds, route)
+            if sampler is not None:
+                sampler.stop()
+                if duration * 1000 >= PROFILE_SLOW_REQUESTS_MS and sampler.samples:
+                    _write_profile(scope["method"], route, duration, sampler.samples)
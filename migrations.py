@@ -0,0 +1,314 @@
+# Schema migrations for databases created by earlier versions of the app.
+#
+# Applied versions are recorded in schema_migrations. A brand-new database is
+# created straight from models and stamped with every version; an existing one
+# runs the migrations it is missing, in order, each in its own transaction.
+#
+# This is a deploy step, run once before the app starts: the app itself only
+# checks that nothing is pending (see main.startup_event).
+#
+#   python migrations.py            -> upgrade the database in DATABASE_URL and add missing drawer rows
+#   python migrations.py --seed     -> the same, plus the demo products if the catalog is empty
+#   python migrations.py --status   -> list applied and pending migrations
+import argparse
+import logging
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+
+import models, reconcile, rollups
+from money import BASIS_POINTS, MINOR_UNITS
+
+logger = logging.getLogger("migrations")
+
+_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations", _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+MIGRATIONS = [] # (version, name, function(connection)), in order
+
+# (product_id, name, available_stocks, price, tax_percentage) for --seed
+DEMO_PRODUCTS = (
+    ("P001", "Laptop", 50, "1200.00", "18.0"),
+    ("P002", "Mouse", 200, "25.00", "18.0"),
+    ("P003", "Keyboard", 100, "75.00", "18.0"),
+    ("P004", "Monitor", 30, "300.00", "18.0"),
+    ("P005", "Webcam", 150, "50.00", "18.0"),
+    ("P006", "Speaker", 80, "80.00", "12.0"),
+)
+
+
+def migration(version: int, name: str):
+    def register(function):
+        MIGRATIONS.append((version, name, function))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return function
+    return register
+
+
+# --- Helpers ---
+
+def _quote(conn, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _columns(conn, table_name: str):
+    return {c["name"] for c in inspect(conn).get_columns(table_name)}
+
+
+def _retype_as_integer(conn, table_name: str, column_name: str, scale: int):
+    """Replaces a REAL column with BIGINT holding ROUND(value * scale).
+
+    Add / copy / drop / rename works the same on SQLite (3.35+), PostgreSQL and MySQL.
+    """
+    table, old = _quote(conn, table_name), _quote(conn, column_name)
+    new = _quote(conn, f"{column_name}__int")
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {new} BIGINT"))
+    conn.execute(text(f"UPDATE {table} SET {new} = CAST(ROUND({old} * {scale}) AS BIGINT)"))
+    conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {old}"))
+    conn.execute(text(f"ALTER TABLE {table} RENAME COLUMN {new} TO {old}"))
+
+
+def _rebuild_sqlite_table(conn, table):
+    """Recreates `table` on SQLite from its model definition, keeping its rows.
+
+    SQLite can't ALTER a table's primary key, so: create the new table beside the
+    old one, copy, drop the old one, rename, and recreate the indexes.
+    """
+    name, staging = _quote(conn, table.name), _quote(conn, f"{table.name}__new")
+    existing = _columns(conn, table.name) # Columns a later migration adds are left NULL here
+    create = str(CreateTable(table).compile(dialect=conn.dialect)).strip()
+    conn.execute(text(create.replace(f"CREATE TABLE {name} (", f"CREATE TABLE {staging} (", 1)))
+    columns = ", ".join(_quote(conn, column.name) for column in table.c if column.name in existing)
+    conn.execute(text(f"INSERT INTO {staging} ({columns}) SELECT {columns} FROM {name}"))
+    conn.execute(text(f"DROP TABLE {name}"))
+    conn.execute(text(f"ALTER TABLE {staging} RENAME TO {name}"))
+    for index in table.indexes:
+        index.create(conn)
+
+
+def _add_column(conn, column):
+    """Adds a nullable model column to its existing table (which may be in the archive schema)."""
+    table = column.table
+    if column.name not in {c["name"] for c in inspect(conn).get_columns(table.name, schema=table.schema)}:
+        conn.execute(text(f"ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} "
+                          f"ADD COLUMN {_quote(conn, column.name)} {column.type.compile(dialect=conn.dialect)}"))
+
+
+def _add_money_column(conn, table_name: str, column_name: str):
+    if column_name not in _columns(conn, table_name):
+        conn.execute(text(f"ALTER TABLE {_quote(conn, table_name)} ADD COLUMN {_quote(conn, column_name)} "
+                          f"BIGINT NOT NULL DEFAULT 0"))
+
+
+# --- Migrations ---
+
+@migration(1, "money_minor_units")
+def _money_minor_units(conn):
+    # Float rupees / percent -> integer paise / basis points (see money.py), plus the
+    # stored per-line and per-purchase tax columns, backfilled with reconcile's SQL.
+    for table_name, column_name, scale in (
+        ("products", "price", MINOR_UNITS),
+        ("products", "tax_percentage", BASIS_POINTS // 100),
+        ("purchases", "total_amount", MINOR_UNITS),
+        ("purchases", "paid_amount", MINOR_UNITS),
+        ("purchase_items", "price_at_purchase", MINOR_UNITS),
+        ("purchase_items", "tax_percentage_at_purchase", BASIS_POINTS // 100),
+    ):
+        _retype_as_integer(conn, table_name, column_name, scale)
+    _add_money_column(conn, "purchases", "tax_amount")
+    for column_name in ("line_subtotal", "line_tax", "line_total"):
+        _add_money_column(conn, "purchase_items", column_name)
+    # Summing each purchase's lines scans purchase_items per purchase without migration 6's index
+    _purchase_items_purchase_id(conn)
+    reconcile.recompute_lines(conn)
+    reconcile.recompute_purchases(conn) # Historical totals are kept as charged; see `reconcile.py verify`
+
+
+@migration(2, "sales_rollups")
+def _sales_rollups(conn):
+    # Rollup tables for the reports, filled from the purchases recorded so far
+    for model in (models.SalesDaily, models.SalesDailyTax, models.SalesDailyProduct):
+        model.__table__.create(conn, checkfirst=True)
+    rollups.rebuild(conn, table_names={"sales_daily", "sales_daily_tax", "sales_daily_product"})
+
+
+@migration(3, "customer_history")
+def _customer_history(conn):
+    # Keyset index for a customer's history, newest first, and the lifetime totals shown above it
+    next(index for index in models.Purchase.__table__.indexes
+         if index.name == "ix_purchases_customer_id_purchase_time").create(conn, checkfirst=True)
+    models.CustomerTotals.__table__.create(conn, checkfirst=True)
+    rollups.rebuild(conn, table_names={"customer_totals"})
+
+
+@migration(4, "purchase_archive")
+def _purchase_archive(conn):
+    # Recent purchases are read by time; older ones move to the archive tables (archive.py)
+    next(index for index in models.Purchase.__table__.indexes
+         if index.name == "ix_purchases_purchase_time").create(conn, checkfirst=True)
+    for model in (models.PurchaseArchive, models.PurchaseItemArchive, models.PurchaseChangeArchive):
+        model.__table__.create(conn, checkfirst=True)
+
+
+@migration(5, "low_stock")
+def _low_stock(conn):
+    # Per-product reorder levels (0 = off, so nothing is low yet) and the table of low products
+    if "reorder_level" not in _columns(conn, "products"):
+        conn.execute(text("ALTER TABLE products ADD COLUMN reorder_level INTEGER NOT NULL DEFAULT 0"))
+    models.LowStock.__table__.create(conn, checkfirst=True)
+
+
+@migration(6, "purchase_items_purchase_id")
+def _purchase_items_purchase_id(conn):
+    # Loading a purchase's items (selectinload, the invoice, the export) looks them up by purchase
+    next(index for index in models.PurchaseItem.__table__.indexes
+         if index.name == "ix_purchase_items_purchase_id").create(conn, checkfirst=True)
+
+
+@migration(7, "purchase_ids_never_reused")
+def _purchase_ids_never_reused(conn):
+    # Without AUTOINCREMENT SQLite hands out max(id) + 1, so once the newest purchase is
+    # archived its id (and its lines' and change rows' ids) would be given to a new sale.
+    # The counters start above every id in the archive too. Other databases never reuse ids.
+    if conn.dialect.name != "sqlite":
+        return
+    for model, archive_model in ((models.Purchase, models.PurchaseArchive),
+                                 (models.PurchaseItem, models.PurchaseItemArchive),
+                                 (models.PurchaseChange, models.PurchaseChangeArchive)):
+        table = model.__table__
+        for created in (table, archive_model.__table__): # purchase_change and the archive may be newer than the database
+            created.create(conn, checkfirst=True)
+        create = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                              {"name": table.name}).scalar()
+        if "AUTOINCREMENT" not in create.upper():
+            _rebuild_sqlite_table(conn, table)
+        issued = max(conn.execute(select(func.max(table.c.id))).scalar() or 0,
+                     conn.execute(select(func.max(archive_model.__table__.c.id))).scalar() or 0)
+        conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {"name": table.name})
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"),
+                     {"name": table.name, "seq": issued})
+
+
+@migration(8, "purchases_archive_purchase_time")
+def _purchases_archive_purchase_time(conn):
+    # purchase_export pages through archived purchases by time, like the hot ones
+    models.PurchaseArchive.__table__.create(conn, checkfirst=True)
+    next(index for index in models.PurchaseArchive.__table__.indexes
+         if index.name == "ix_purchases_archive_purchase_time").create(conn, checkfirst=True)
+
+
+@migration(9, "purchase_item_product_snapshot")
+def _purchase_item_product_snapshot(conn):
+    # Lines keep the product's name and code as sold, so renaming or deleting a product
+    # doesn't change old invoices. Existing lines get the product's current ones.
+    products = models.Product.__table__
+    for model in (models.PurchaseItem, models.PurchaseItemArchive):
+        items = model.__table__
+        _add_column(conn, items.c.product_name_at_purchase)
+        _add_column(conn, items.c.product_code_at_purchase)
+        product = select(products).where(products.c.id == items.c.product_id)
+        conn.execute(update(items).where(items.c.product_name_at_purchase.is_(None)).values(
+            product_name_at_purchase=product.with_only_columns(products.c.name).scalar_subquery(),
+            product_code_at_purchase=product.with_only_columns(products.c.product_id).scalar_subquery(),
+        ))
+
+
+# --- Runner ---
+
+def applied_versions(conn):
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def pending(engine=None):
+    """(version, name) of the migrations not applied yet; all of them for a database never set up."""
+    if engine is None:
+        from database import engine
+    with engine.connect() as conn:
+        applied = applied_versions(conn) if inspect(conn).has_table("schema_migrations") else set()
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in applied]
+
+
+def upgrade(engine=None):
+    """Brings the database up to date; safe to call on every start."""
+    if engine is None:
+        from database import engine
+    with engine.begin() as conn:
+        fresh = not inspect(conn).has_table("products")
+        schema_migrations.create(conn, checkfirst=True)
+        if fresh:
+            models.Base.metadata.create_all(conn)
+            pending = [m for m in MIGRATIONS if m[0] not in applied_versions(conn)]
+            if pending:
+                conn.execute(schema_migrations.insert(), [{"version": v, "name": n} for v, n, _ in pending])
+            return
+        applied = applied_versions(conn)
+        # Tables added since the database was created, before any migration reads them.
+        # Only missing tables are created; existing ones are left to the migrations.
+        models.Base.metadata.create_all(conn)
+
+    for version, name, function in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.warning("Applying migration %d (%s)", version, name)
+        with engine.begin() as conn:
+            function(conn)
+            conn.execute(schema_migrations.insert().values(version=version, name=name))
+
+
+def seed(engine=None, demo_products: bool = False) -> int:
+    """Adds missing drawer rows and, with demo_products, the demo catalog if there are no products.
+
+    Safe to run again: an existing catalog is left alone. The products go in as one
+    executemany; returns how many were added.
+    """
+    import crud, schemas
+
+    if engine is None:
+        from database import engine
+    with Session(engine) as db:
+        crud.ensure_drawer(db)
+        if not demo_products or db.scalar(select(models.Product.id).limit(1)) is not None:
+            return 0
+        products = [schemas.ProductCreate(product_id=product_id, name=name, available_stocks=stocks,
+                                          price=price, tax_percentage=tax)
+                    for product_id, name, stocks, price, tax in DEMO_PRODUCTS]
+        try:
+            created, _ = crud.upsert_products(db, products, {})
+        except IntegrityError:
+            return 0 # Another seeder got there first
+    return created
+
+
+def prepare(engine=None, demo_products: bool = False) -> int:
+    """upgrade, then seed."""
+    upgrade(engine)
+    return seed(engine, demo_products)
+
+
+def main(argv=None):
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations.")
+    parser.add_argument("--status", action="store_true", help="List migrations without applying them")
+    parser.add_argument("--seed", action="store_true", help="Also add the demo products to an empty catalog")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.status:
+        waiting = {version for version, _ in pending(engine)}
+        for version, name, _ in MIGRATIONS:
+            print(f"{version:>4} {name:<30} {'pending' if version in waiting else 'applied'}")
+        return
+    created = prepare(engine, args.seed)
+    print("Database is up to date." + (f" Added {created} demo products." if created else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
-from database import Base
+from database import ARCHIVE_SCHEMA, Base
+from money import Money, TaxRate
 
 class Product(Base):
     __tablename__ = "products"
@@ -10,8 +11,9 @@ class Product(Base):
     name = Column(String, unique=True, index=True)
     product_id = Column(String, unique=True, index=True) # Unique product identifier
     available_stocks = Column(Integer, default=0)
-    price = Column(Float)
-    tax_percentage = Column(Float) # e.g., 5.0 for 5%
+    price = Column(Money) # Stored in paise, see money.py
+    tax_percentage = Column(TaxRate) # e.g., 5.0 for 5%, stored as 500 basis points
+    reorder_level = Column(Integer, nullable=False, default=0) # Low stock at or below this; 0 = never alert
 
     purchase_items = relationship("PurchaseItem", back_populates="product")
 
@@ -28,22 +30,188 @@ class Purchase(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"))
-    total_amount = Column(Float)
-    paid_amount = Column(Float)
+    total_amount = Column(Money) # Sum of the items' line_total
+    tax_amount = Column(Money, nullable=False, default=0) # Sum of the items' line_tax
+    paid_amount = Column(Money)
     purchase_time = Column(DateTime(timezone=True), server_default=func.now())
 
     customer = relationship("Customer", back_populates="purchases")
     items = relationship("PurchaseItem", back_populates="purchase")
+    change_notes = relationship("PurchaseChange", order_by="PurchaseChange.denomination.desc()")
+
+    # A customer's history, newest first; id breaks ties so it can serve keyset pages.
+    # purchase_time alone: the dashboard's recent purchases and archive.py's age cutoff.
+    __table_args__ = (Index("ix_purchases_customer_id_purchase_time", "customer_id", "purchase_time", "id"),
+                      Index("ix_purchases_purchase_time", "purchase_time"),
+                      {"sqlite_autoincrement": True}) # Archived ids must never be handed out again
 
 class PurchaseItem(Base):
     __tablename__ = "purchase_items"
 
     id = Column(Integer, primary_key=True, index=True)
-    purchase_id = Column(Integer, ForeignKey("purchases.id"))
+    purchase_id = Column(Integer, ForeignKey("purchases.id"), index=True)
     product_id = Column(Integer, ForeignKey("products.id"))
     quantity = Column(Integer)
-    price_at_purchase = Column(Float) # Price of one unit at the time of purchase
-    tax_percentage_at_purchase = Column(Float) # Tax at the time of purchase
+    price_at_purchase = Column(Money) # Price of one unit at the time of purchase
+    tax_percentage_at_purchase = Column(TaxRate) # Tax at the time of purchase
+    product_name_at_purchase = Column(String) # Product name and code as sold; invoices show these, not the
+    product_code_at_purchase = Column(String) # product's current ones (NULL if it was deleted before migration 9)
+    line_subtotal = Column(Money, nullable=False, default=0) # price_at_purchase * quantity
+    line_tax = Column(Money, nullable=False, default=0) # Rounded per line (money.line_amounts)
+    line_total = Column(Money, nullable=False, default=0)
 
     purchase = relationship("Purchase", back_populates="items")
-    product = relationship("Product", back_populates="purchase_items")
\ No newline at end of file
+    product = relationship("Product", back_populates="purchase_items")
+
+    __table_args__ = {"sqlite_autoincrement": True} # Like purchases: ids stay unique across the archive
+
+class CatalogVersion(Base):
+    # Single row (id=1) bumped by every product create/update/delete, so each
+    # worker's catalog cache can tell cheaply when another worker changed it.
+    __tablename__ = "catalog_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class EmailOutbox(Base):
+    # Durable queue of outgoing mail, drained by mailer.OutboxWorker
+    __tablename__ = "email_outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    recipients = Column(String, nullable=False) # Comma-separated; first is the To address, the rest are Cc
+    subject = Column(String, nullable=False)
+    body_html = Column(Text, nullable=False)
+    purchase_id = Column(Integer, nullable=True) # Informational, no FK so archived purchases don't block cleanup
+    status = Column(String, nullable=False, default="pending") # pending -> sending -> sent | dead
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False) # Naive UTC; also the lease expiry while "sending"
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_email_outbox_status_next_attempt", "status", "next_attempt_at"),)
+
+class DrawerDenomination(Base):
+    # Notes/coins currently in the cash drawer, one row per denomination (rupees)
+    __tablename__ = "drawer_denominations"
+
+    denomination = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class PurchaseChange(Base):
+    # Change actually handed out for a purchase, so invoices don't depend on the drawer later.
+    # A row with denomination 0 records, in paise, the part of the balance the drawer couldn't cover.
+    __tablename__ = "purchase_change"
+
+    id = Column(Integer, primary_key=True, index=True)
+    purchase_id = Column(Integer, ForeignKey("purchases.id"), index=True)
+    denomination = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = {"sqlite_autoincrement": True} # Like purchases: ids stay unique across the archive
+
+class IdempotencyKey(Base):
+    # One row per accepted bill submission key; a resubmission with the same key
+    # returns this purchase instead of creating another. Evicted by jobs.py.
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(64), primary_key=True)
+    purchase_id = Column(Integer, nullable=False) # No FK so archived purchases don't block eviction
+    created_at = Column(DateTime, nullable=False, index=True) # Naive UTC
+
+# Sales rollups, kept by rollups.py in the same transaction as the purchases they
+# count. Days are calendar days in REPORT_TIMEZONE. Reports read only these tables.
+class SalesDaily(Base):
+    __tablename__ = "sales_daily"
+
+    day = Column(Date, primary_key=True)
+    purchases = Column(BigInteger, nullable=False, default=0)
+    items_sold = Column(BigInteger, nullable=False, default=0) # Units across all lines
+    revenue = Column(Money, nullable=False, default=0) # Sum of total_amount (tax included)
+    tax = Column(Money, nullable=False, default=0) # Sum of tax_amount
+
+class SalesDailyTax(Base):
+    __tablename__ = "sales_daily_tax"
+
+    day = Column(Date, primary_key=True)
+    tax_percentage = Column(TaxRate, primary_key=True) # tax_percentage_at_purchase
+    taxable_amount = Column(Money, nullable=False, default=0) # Sum of line_subtotal
+    tax = Column(Money, nullable=False, default=0) # Sum of line_tax
+
+class SalesDailyProduct(Base):
+    __tablename__ = "sales_daily_product"
+
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True) # Product.id; no FK so deleting a product keeps its history
+    quantity = Column(BigInteger, nullable=False, default=0)
+    revenue = Column(Money, nullable=False, default=0) # Sum of line_total
+
+class CustomerTotals(Base):
+    # Lifetime totals per customer, for the purchase history header; kept like the sales rollups
+    __tablename__ = "customer_totals"
+
+    customer_id = Column(Integer, primary_key=True) # Customer.id
+    purchases = Column(BigInteger, nullable=False, default=0)
+    total_spent = Column(Money, nullable=False, default=0) # Sum of total_amount (tax included)
+    tax = Column(Money, nullable=False, default=0)
+
+class LowStock(Base):
+    # Products at or below their reorder level; kept by low_stock.py as stock changes, never by a catalog scan
+    __tablename__ = "low_stock"
+
+    product_id = Column(Integer, primary_key=True) # Product.id
+    since = Column(DateTime(timezone=True), nullable=False)
+    alerted_at = Column(DateTime(timezone=True), nullable=True) # Reported in a digest; NULL = not yet
+
+# Purchases older than the archive horizon, moved out of the hot tables by archive.py
+# with their ids unchanged. Same columns, no foreign keys (the tables may sit in an
+# attached SQLite file); crud reads them wherever a purchase id or history page isn't hot.
+class PurchaseArchive(Base):
+    __tablename__ = "purchases_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    customer_id = Column(Integer)
+    total_amount = Column(Money)
+    tax_amount = Column(Money, nullable=False, default=0)
+    paid_amount = Column(Money)
+    purchase_time = Column(DateTime(timezone=True))
+
+    customer = relationship("Customer", primaryjoin="foreign(PurchaseArchive.customer_id) == Customer.id", viewonly=True)
+    items = relationship("PurchaseItemArchive", primaryjoin="PurchaseArchive.id == foreign(PurchaseItemArchive.purchase_id)",
+                         viewonly=True)
+    change_notes = relationship("PurchaseChangeArchive", order_by="PurchaseChangeArchive.denomination.desc()",
+                                primaryjoin="PurchaseArchive.id == foreign(PurchaseChangeArchive.purchase_id)",
+                                viewonly=True)
+
+    __table_args__ = (Index("ix_purchases_archive_customer_id_purchase_time", "customer_id", "purchase_time", "id"),
+                      Index("ix_purchases_archive_purchase_time", "purchase_time"), # purchase_export
+                      {"schema": ARCHIVE_SCHEMA})
+
+class PurchaseItemArchive(Base):
+    __tablename__ = "purchase_items_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    purchase_id = Column(Integer, index=True)
+    product_id = Column(Integer)
+    quantity = Column(Integer)
+    price_at_purchase = Column(Money)
+    tax_percentage_at_purchase = Column(TaxRate)
+    product_name_at_purchase = Column(String)
+    product_code_at_purchase = Column(String)
+    line_subtotal = Column(Money, nullable=False, default=0)
+    line_tax = Column(Money, nullable=False, default=0)
+    line_total = Column(Money, nullable=False, default=0)
+
+    product = relationship("Product", primaryjoin="foreign(PurchaseItemArchive.product_id) == Product.id", viewonly=True)
+
+    __table_args__ = {"schema": ARCHIVE_SCHEMA}
+
+class PurchaseChangeArchive(Base):
+    __tablename__ = "purchase_change_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    purchase_id = Column(Integer, index=True)
+    denomination = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = {"schema": ARCHIVE_SCHEMA}
@@ -0,0 +1,80 @@
+# Money handling: amounts are stored as integer paise and tax rates as integer
+# basis points, and surface in Python as Decimal rupees / percent.
+#
+# All billing math goes through line_amounts, in integers, so the invoice, the
+# stored purchase and reconcile.py's SQL recompute always agree to the paisa.
+from decimal import ROUND_HALF_UP, Decimal
+
+from sqlalchemy import BigInteger, Integer
+from sqlalchemy.types import TypeDecorator
+
+MINOR_UNITS = 100     # Paise per rupee
+BASIS_POINTS = 10000  # Tax rate 18.00% == 1800
+
+_CENT = Decimal("0.01")
+
+
+def _half_up(value: Decimal) -> int:
+    return int(value.quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def to_decimal(amount) -> Decimal:
+    # str() first so a float like 0.1 becomes Decimal("0.1"), not its binary expansion
+    return amount if isinstance(amount, Decimal) else Decimal(str(amount))
+
+
+def to_minor(amount) -> int:
+    return _half_up(to_decimal(amount) * MINOR_UNITS)
+
+
+def from_minor(minor: int) -> Decimal:
+    return (Decimal(minor) / MINOR_UNITS).quantize(_CENT)
+
+
+def to_basis_points(percentage) -> int:
+    return _half_up(to_decimal(percentage) * BASIS_POINTS / 100)
+
+
+def from_basis_points(basis_points: int) -> Decimal:
+    return (Decimal(basis_points) * 100 / BASIS_POINTS).quantize(_CENT)
+
+
+def divide_half_up(numerator: int, divisor: int) -> int:
+    # Non-negative integers only; mirrored in SQL by sql_divide_half_up
+    return (numerator + divisor // 2) // divisor
+
+
+def line_amounts(unit_price, quantity: int, tax_percentage):
+    """(subtotal, tax, total) in paise for one basket line; tax is rounded per line."""
+    subtotal = to_minor(unit_price) * quantity
+    tax = divide_half_up(subtotal * to_basis_points(tax_percentage), BASIS_POINTS)
+    return subtotal, tax, subtotal + tax
+
+
+def sql_divide_half_up(numerator, divisor: int):
+    """divide_half_up as a SQL expression over integer columns."""
+    return (numerator + divisor // 2) // divisor # FLOOR(...) on MySQL, integer "/" elsewhere
+
+
+class Money(TypeDecorator):
+    """Integer paise in the database, Decimal rupees in Python."""
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else to_minor(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else from_minor(int(value))
+
+
+class TaxRate(TypeDecorator):
+    """Integer basis points in the database, Decimal percent in Python."""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else to_basis_points(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else from_basis_points(int(value))
@@ -0,0 +1,213 @@
+# Bulk product import / export as CSV or JSON Lines, for price lists too big for /products/add/.
+#
+# Import reads rows one at a time from a file object, validates each with
+# schemas.ProductCreate and upserts by product_id in batches: one SELECT for the
+# batch's existing products and names, then one executemany INSERT and one
+# executemany UPDATE, committed per batch. Bad rows are reported by line number
+# and skipped; the rest still load.
+#
+# Export streams every product through a server-side cursor, so memory stays
+# flat however big the catalog is. Its files import back unchanged.
+#
+#   python product_io.py import products.csv [--batch-size 1000]
+#   python product_io.py export products.jsonl      (- for stdout; --format csv|jsonl)
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from typing import BinaryIO, Iterator, List, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import crud, schemas
+
+FIELDS = ("product_id", "name", "available_stocks", "price", "tax_percentage")
+OPTIONAL_FIELDS = ("reorder_level",) # Left out (or blank): new products get 0, existing ones keep theirs
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+MEDIA_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+PRODUCT_IMPORT_BATCH_SIZE = int(os.getenv("PRODUCT_IMPORT_BATCH_SIZE", "1000")) # Rows per transaction
+PRODUCT_EXPORT_BATCH_SIZE = int(os.getenv("PRODUCT_EXPORT_BATCH_SIZE", "1000")) # Rows per cursor fetch
+MAX_REPORTED_ERRORS = 200 # Row errors kept for the report; all of them are counted
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = [] # (line, message), at most MAX_REPORTED_ERRORS
+
+    def error(self, line: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+def format_for(filename: str) -> str:
+    fmt = FORMATS.get(os.path.splitext(filename or "")[1].lower())
+    if fmt is None:
+        raise ValueError(f"Can't tell the format of '{filename}'; use a .csv or .jsonl file")
+    return fmt
+
+
+# --- Import ---
+
+def iter_rows(stream: BinaryIO, fmt: str) -> Iterator[Tuple[int, object]]:
+    """Yields (line number, row dict) from a binary stream; a row that can't be parsed comes as a ValueError."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(text)
+            missing = [field for field in FIELDS if field not in (reader.fieldnames or [])]
+            if missing:
+                raise ValueError(f"CSV header is missing: {', '.join(missing)}")
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f"Invalid JSON: {e}")
+                continue
+            yield line_number, row if isinstance(row, dict) else ValueError("Expected a JSON object")
+    finally:
+        text.detach() # Leave the caller's stream open
+
+
+def validate_row(row) -> schemas.ProductCreate:
+    """ProductCreate from a parsed row; raises ValueError with a one-line message."""
+    if isinstance(row, ValueError):
+        raise row
+    values = {field: row.get(field) for field in FIELDS}
+    values.update({field: row[field] for field in OPTIONAL_FIELDS if row.get(field) not in (None, "")})
+    for field in ("product_id", "name"):
+        if isinstance(values[field], str):
+            values[field] = values[field].strip()
+        if not values[field]:
+            raise ValueError(f"{field}: is required")
+    try:
+        product = schemas.ProductCreate(**values)
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+                                   for error in e.errors()))
+    for field in ("available_stocks", "price", "tax_percentage", "reorder_level"):
+        if getattr(product, field) < 0:
+            raise ValueError(f"{field}: cannot be negative")
+    return product
+
+
+def _write_batch(db: Session, batch: List[Tuple[int, schemas.ProductCreate]], report: ImportReport):
+    existing = crud.get_product_ids_by_product_id_strs(db, [product.product_id for _, product in batch])
+    name_owners = crud.get_product_id_strs_by_names(db, [product.name for _, product in batch])
+    accepted = []
+    for line, product in batch:
+        owner = name_owners.get(product.name)
+        if owner is not None and owner != product.product_id:
+            report.error(line, f"name: '{product.name}' already belongs to product {owner}")
+            continue
+        accepted.append((line, product))
+    if not accepted:
+        return
+    try:
+        created, updated = crud.upsert_products(db, [product for _, product in accepted], existing)
+    except IntegrityError:
+        # Another writer took one of these product_ids or names since our SELECT; nothing in the batch was written
+        for line, _ in accepted:
+            report.error(line, "conflicts with a concurrent change to the catalog; import it again")
+        return
+    report.created += created
+    report.updated += updated
+
+
+def import_products(db: Session, stream: BinaryIO, fmt: str, batch_size: int = None) -> ImportReport:
+    """Upserts the products in `stream` (CSV or JSON Lines), one transaction per batch of rows."""
+    batch_size = batch_size or PRODUCT_IMPORT_BATCH_SIZE
+    report = ImportReport()
+    batch = []
+    batch_keys = set() # product_ids and names in `batch`
+    try:
+        for line, row in iter_rows(stream, fmt):
+            try:
+                product = validate_row(row)
+            except ValueError as e:
+                report.error(line, str(e))
+                continue
+            if product.product_id in batch_keys or product.name in batch_keys:
+                # A repeated product in one batch; write what came before so the later row wins
+                _write_batch(db, batch, report)
+                batch, batch_keys = [], set()
+            batch.append((line, product))
+            batch_keys.update((product.product_id, product.name))
+            if len(batch) >= batch_size:
+                _write_batch(db, batch, report)
+                batch, batch_keys = [], set()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        # The file itself is unreadable from here on; rows before it stand
+        report.error(0, f"Stopped reading the file: {e}")
+    if batch:
+        _write_batch(db, batch, report)
+    return report
+
+
+# --- Export ---
+
+def _values(row):
+    return row.product_id, row.name, row.available_stocks, str(row.price), str(row.tax_percentage), row.reorder_level
+
+
+def export_chunks(db: Session, fmt: str, batch_size: int = None) -> Iterator[str]:
+    """Every product as CSV (with a header) or JSON Lines, one chunk of text per cursor batch."""
+    if fmt == "csv":
+        header = io.StringIO()
+        csv.writer(header).writerow(FIELDS + OPTIONAL_FIELDS)
+        yield header.getvalue()
+    for rows in crud.iter_products(db, batch_size or PRODUCT_EXPORT_BATCH_SIZE).partitions():
+        if fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(_values(row) for row in rows)
+            yield buffer.getvalue()
+        else:
+            yield "".join(json.dumps(dict(zip(FIELDS + OPTIONAL_FIELDS, _values(row))), ensure_ascii=False) + "\n" for row in rows)
+
+
+def main(argv=None):
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Import or export the product catalog as CSV or JSON Lines.")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("file", help="Path, or - for stdin/stdout")
+    parser.add_argument("--format", choices=sorted(MEDIA_TYPES), help="Default: from the file extension")
+    parser.add_argument("--batch-size", type=int, default=None, help="Rows per transaction (import)")
+    args = parser.parse_args(argv)
+    fmt = args.format or format_for(args.file)
+
+    with SessionLocal() as db:
+        if args.command == "export":
+            if args.file == "-":
+                sys.stdout.writelines(export_chunks(db, fmt))
+            else:
+                with open(args.file, "w", encoding="utf-8", newline="") as out:
+                    out.writelines(export_chunks(db, fmt))
+            return 0
+
+        stream = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+        with stream:
+            report = import_products(db, stream, fmt, args.batch_size)
+    print(f"Created {report.created}, updated {report.updated}, failed {report.failed}")
+    for line, message in report.errors:
+        print(f"  line {line}: {message}")
+    if report.failed > len(report.errors):
+        print(f"  ... and {report.failed - len(report.errors)} more")
+    return 1 if report.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+# Export of every sale over a date range, one row per purchase line, for accounting.
+#
+# Purchases are read PURCHASE_EXPORT_BATCH_SIZE at a time, keyset-paged on
+# (purchase_time, id) along the purchase_time index, archived ones and then hot
+# ones; each batch's lines are then read along the purchase_id index, which
+# already has them in order. No query sorts or scans more than its batch, and each batch
+# is encoded and handed on before the next is fetched, so memory stays flat
+# however many millions of lines the range holds. Amounts are read as the
+# stored integers and formatted without going through Decimal.
+#
+#   csv.gz  -> gzip-compressed CSV with a header, written a batch at a time
+#   parquet -> one row group per batch (Arrow record batches); needs pyarrow
+#
+# Days are calendar days in rollups.REPORT_TIMEZONE, like the sales reports, and
+# both ends are included. Served as GET /purchases/export, or:
+#
+#   python purchase_export.py 2026-09-01 2026-09-30 sales-2026-09.csv.gz   (- for stdout; --format csv.gz|parquet)
+import argparse
+import csv
+import io
+import os
+import sys
+import zlib
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Iterator, List, Tuple
+
+from sqlalchemy import BigInteger, DateTime, Integer, String, column, or_, select, table
+from sqlalchemy.orm import Session
+
+from database import ARCHIVE_SCHEMA
+from money import from_basis_points, from_minor
+from rollups import REPORT_TIMEZONE
+
+FIELDS = ("purchase_id", "purchase_time", "customer_email", "product_id", "product_name", "quantity",
+          "unit_price", "tax_percentage", "line_subtotal", "line_tax", "line_total",
+          "purchase_total", "purchase_tax", "paid_amount")
+AMOUNT_FIELDS = {"unit_price", "line_subtotal", "line_tax", "line_total", "purchase_total", "purchase_tax", "paid_amount"}
+FORMATS = ("csv.gz", "parquet")
+MEDIA_TYPES = {"csv.gz": "application/gzip", "parquet": "application/vnd.apache.parquet"}
+
+PURCHASE_EXPORT_BATCH_SIZE = int(os.getenv("PURCHASE_EXPORT_BATCH_SIZE", "2500")) # Purchases per fetch and per row group
+GZIP_LEVEL = 6
+
+
+# Raw integer views (models' Money / TaxRate types would convert every value to Decimal)
+def _purchases_view(name: str, schema: str = None):
+    return table(name, column("id", BigInteger), column("customer_id", BigInteger),
+                 column("purchase_time", DateTime(timezone=True)), column("total_amount", BigInteger),
+                 column("tax_amount", BigInteger), column("paid_amount", BigInteger), schema=schema)
+
+
+def _items_view(name: str, schema: str = None):
+    return table(name, column("id", BigInteger), column("purchase_id", BigInteger), column("product_id", BigInteger),
+                 column("quantity", Integer), column("price_at_purchase", BigInteger),
+                 column("tax_percentage_at_purchase", BigInteger), column("line_subtotal", BigInteger),
+                 column("line_tax", BigInteger), column("line_total", BigInteger),
+                 column("product_name_at_purchase", String), column("product_code_at_purchase", String), schema=schema)
+
+
+customers = table("customers", column("id", BigInteger), column("email", String))
+SOURCES = ( # Archived first: they are the older sales
+    (_purchases_view("purchases_archive", ARCHIVE_SCHEMA), _items_view("purchase_items_archive", ARCHIVE_SCHEMA)),
+    (_purchases_view("purchases"), _items_view("purchase_items")),
+)
+
+
+def format_for(filename: str) -> str:
+    for fmt in FORMATS:
+        if filename.lower().endswith("." + fmt):
+            return fmt
+    raise ValueError(f"Can't tell the format of '{filename}'; use a .csv.gz or .parquet file")
+
+
+def utc_range(start: date, end: date) -> Tuple[datetime, datetime]:
+    """[from, to) in UTC covering the calendar days start..end (inclusive) in REPORT_TIMEZONE."""
+    return tuple(datetime.combine(day, time(), REPORT_TIMEZONE).astimezone(timezone.utc)
+                 for day in (start, end + timedelta(days=1)))
+
+
+def _purchases_statement(purchases, start: datetime, end: datetime, after: tuple, limit: int):
+    # The next `limit` purchases in (purchase_time, id) order after `after`, read along the
+    # purchase_time index (id is the rowid on SQLite, so the index is already in that order)
+    stmt = (select(purchases.c.id, purchases.c.purchase_time, customers.c.email,
+                   purchases.c.total_amount, purchases.c.tax_amount, purchases.c.paid_amount)
+            .select_from(purchases)
+            .outerjoin(customers, customers.c.id == purchases.c.customer_id)
+            .where(purchases.c.purchase_time >= start, purchases.c.purchase_time < end)
+            .order_by(purchases.c.purchase_time, purchases.c.id)
+            .limit(limit))
+    if after:
+        last_time, last_id = after
+        stmt = stmt.where(purchases.c.purchase_time >= last_time,
+                          or_(purchases.c.purchase_time > last_time, purchases.c.id > last_id))
+    return stmt
+
+
+def _lines_statement(items, purchase_ids: List[int]):
+    return (select(items.c.purchase_id, items.c.id, items.c.product_code_at_purchase, items.c.product_name_at_purchase,
+                   items.c.quantity, items.c.price_at_purchase, items.c.tax_percentage_at_purchase,
+                   items.c.line_subtotal, items.c.line_tax, items.c.line_total)
+            .select_from(items)
+            .where(items.c.purchase_id.in_(purchase_ids))
+            .order_by(items.c.purchase_id, items.c.id)) # The purchase_id index's own order: no sort
+
+
+def iter_batches(db: Session, start: date, end: date, batch_size: int = None) -> Iterator[List[tuple]]:
+    """The lines of up to batch_size purchases at a time (FIELDS order; amounts in paise, tax in basis points)."""
+    window = utc_range(start, end)
+    batch_size = batch_size or PURCHASE_EXPORT_BATCH_SIZE
+    for purchases, items in SOURCES:
+        after = None
+        while True:
+            batch = db.execute(_purchases_statement(purchases, *window, after, batch_size)).all()
+            if not batch:
+                break
+            after = batch[-1].purchase_time, batch[-1].id
+            lines = {}
+            for line in db.execute(_lines_statement(items, [purchase.id for purchase in batch])).tuples():
+                lines.setdefault(line[0], []).append(line[2:])
+            rows = [(purchase_id, purchase_time, email, *line, purchase_total, purchase_tax, paid)
+                    for purchase_id, purchase_time, email, purchase_total, purchase_tax, paid in batch
+                    for line in lines.get(purchase_id, ())]
+            if rows:
+                yield rows
+            if len(batch) < batch_size:
+                break
+
+
+# --- Encoders ---
+
+def _decimal_text(value: int) -> str:
+    # 123456 -> "1234.56", without a Decimal per value
+    if value >= 0:
+        return "%d.%02d" % divmod(value, 100)
+    return "-%d.%02d" % divmod(-value, 100)
+
+
+def _time_text(moment: datetime) -> str:
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc) # Stored times are UTC
+    return moment.astimezone(timezone.utc).isoformat()
+
+
+def _csv_row(row) -> tuple:
+    (purchase_id, purchase_time, email, product_id, name, quantity, unit_price, tax_bp,
+     subtotal, tax, total, purchase_total, purchase_tax, paid) = row
+    return (purchase_id, _time_text(purchase_time), email, product_id, name, quantity, _decimal_text(unit_price),
+            _decimal_text(tax_bp), _decimal_text(subtotal), _decimal_text(tax), _decimal_text(total),
+            _decimal_text(purchase_total), _decimal_text(purchase_tax), _decimal_text(paid))
+
+
+def csv_gz_chunks(batches: Iterator[List[tuple]]) -> Iterator[bytes]:
+    """One gzip member for the whole export, flushed out a batch at a time."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # wbits 31: gzip container
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(FIELDS)
+    for rows in batches:
+        writer.writerows(_csv_row(row) for row in rows)
+        chunk = compressor.compress(text.getvalue().encode())
+        text.seek(0)
+        text.truncate()
+        if chunk:
+            yield chunk
+    yield compressor.compress(text.getvalue().encode()) + compressor.flush()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands what was written to the caller instead of keeping it."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def parquet_schema():
+    import pyarrow as pa
+
+    amount = pa.decimal128(18, 2)
+    return pa.schema([
+        ("purchase_id", pa.int64()), ("purchase_time", pa.timestamp("us", tz="UTC")),
+        ("customer_email", pa.string()), ("product_id", pa.string()), ("product_name", pa.string()),
+        ("quantity", pa.int64()), ("unit_price", amount), ("tax_percentage", pa.decimal128(7, 2)),
+        ("line_subtotal", amount), ("line_tax", amount), ("line_total", amount),
+        ("purchase_total", amount), ("purchase_tax", amount), ("paid_amount", amount),
+    ])
+
+
+def parquet_chunks(batches: Iterator[List[tuple]]) -> Iterator[bytes]:
+    """A Parquet file, one row group per batch, streamed as the row groups are written."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in batches:
+            columns = list(zip(*rows))
+            arrays = []
+            for field, values in zip(schema, columns):
+                if field.name in AMOUNT_FIELDS:
+                    values = [from_minor(value) for value in values]
+                elif field.name == "tax_percentage":
+                    values = [from_basis_points(value) for value in values]
+                elif field.name == "purchase_time":
+                    values = [value if value.tzinfo else value.replace(tzinfo=timezone.utc) for value in values]
+                arrays.append(pa.array(values, type=field.type))
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+    yield sink.drain() # The footer
+
+
+def export_chunks(db: Session, fmt: str, start: date, end: date, batch_size: int = None) -> Iterator[bytes]:
+    """The lines of every purchase made from start to end (inclusive), encoded as `fmt`."""
+    batches = iter_batches(db, start, end, batch_size)
+    return csv_gz_chunks(batches) if fmt == "csv.gz" else parquet_chunks(batches)
+
+
+def check_format(fmt: str):
+    """Raises ValueError if `fmt` can't be written here."""
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+    if fmt == "parquet":
+        try:
+            import pyarrow.parquet # noqa: F401
+        except ImportError:
+            raise ValueError("Parquet export needs pyarrow (pip install pyarrow)")
+
+
+def main(argv=None):
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Export purchase lines over a date range as CSV.gz or Parquet.")
+    parser.add_argument("start", type=date.fromisoformat, help="First day, YYYY-MM-DD")
+    parser.add_argument("end", type=date.fromisoformat, help="Last day, YYYY-MM-DD (included)")
+    parser.add_argument("file", help="Path, or - for stdout")
+    parser.add_argument("--format", choices=FORMATS, help="Default: from the file extension (csv.gz for stdout)")
+    parser.add_argument("--batch-size", type=int, default=None, help="Lines per fetch / row group")
+    args = parser.parse_args(argv)
+    try:
+        fmt = args.format or ("csv.gz" if args.file == "-" else format_for(args.file))
+        check_format(fmt)
+    except ValueError as e:
+        parser.error(str(e))
+
+    with SessionLocal() as db:
+        if args.file == "-":
+            sys.stdout.buffer.writelines(export_chunks(db, fmt, args.start, args.end, args.batch_size))
+        else:
+            with open(args.file, "wb") as out:
+                out.writelines(export_chunks(db, fmt, args.start, args.end, args.batch_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# Recompute / verify the stored money amounts of historical purchases.
+#
+# Everything is set-based SQL over integer columns, processed in id ranges, so it
+# runs in the database at table-scan speed instead of loading purchases into
+# Python. The formulas mirror money.line_amounts exactly:
+#   line_subtotal = price_at_purchase * quantity
+#   line_tax      = round_half_up(line_subtotal * tax_basis_points / 10000)
+#   line_total    = line_subtotal + line_tax
+#   purchases.tax_amount   = SUM(line_tax)
+#   purchases.total_amount = SUM(line_total)
+# Archived purchases (archive.py) are checked and rewritten the same way.
+#
+#   python reconcile.py verify                 -> exits 1 if any stored amount disagrees
+#   python reconcile.py recompute [--totals]   -> rewrites line amounts and tax_amount
+#                                                 (and total_amount with --totals), then
+#                                                 rebuilds the rollups (rollups.py) from them
+import argparse
+import sys
+
+from sqlalchemy import BigInteger, column, func, inspect, or_, select, table, update
+
+import rollups
+from database import ARCHIVE_SCHEMA
+from money import BASIS_POINTS, sql_divide_half_up
+
+RECONCILE_BATCH_SIZE = 50000
+
+
+# Raw integer views of the money columns (models' Money/TaxRate types would convert to Decimal)
+def _purchase_items_view(name: str, schema: str = None):
+    return table(
+        name,
+        column("id", BigInteger),
+        column("purchase_id", BigInteger),
+        column("quantity", BigInteger),
+        column("price_at_purchase", BigInteger),
+        column("tax_percentage_at_purchase", BigInteger),
+        column("line_subtotal", BigInteger),
+        column("line_tax", BigInteger),
+        column("line_total", BigInteger),
+        schema=schema,
+    )
+
+
+def _purchases_view(name: str, schema: str = None):
+    return table(
+        name,
+        column("id", BigInteger),
+        column("total_amount", BigInteger),
+        column("tax_amount", BigInteger),
+        schema=schema,
+    )
+
+
+purchase_items = _purchase_items_view("purchase_items")
+purchases = _purchases_view("purchases")
+purchase_items_archive = _purchase_items_view("purchase_items_archive", ARCHIVE_SCHEMA)
+purchases_archive = _purchases_view("purchases_archive", ARCHIVE_SCHEMA)
+
+
+def _sources(conn):
+    # (purchases, their items): hot, then archived (archive.py) once the archive tables exist.
+    # Ids are never reused across the two, so an id in a report names one row.
+    sources = [(purchases, purchase_items)]
+    if inspect(conn).has_table(purchases_archive.name, schema=ARCHIVE_SCHEMA):
+        sources.append((purchases_archive, purchase_items_archive))
+    return sources
+
+
+def _expected_line_amounts(items):
+    subtotal = items.c.price_at_purchase * items.c.quantity
+    tax = sql_divide_half_up(subtotal * items.c.tax_percentage_at_purchase, BASIS_POINTS)
+    return subtotal, tax, subtotal + tax
+
+
+def _id_ranges(conn, id_column, batch_size: int):
+    low, high = conn.execute(select(func.min(id_column), func.max(id_column))).one()
+    if low is None:
+        return
+    for start in range(low, high + 1, batch_size):
+        yield start, start + batch_size - 1
+
+
+def recompute_lines(conn, batch_size: int = RECONCILE_BATCH_SIZE) -> int:
+    updated = 0
+    for _, items in _sources(conn):
+        subtotal, tax, total = _expected_line_amounts(items)
+        for start, end in _id_ranges(conn, items.c.id, batch_size):
+            updated += conn.execute(
+                update(items)
+                .where(items.c.id.between(start, end))
+                .values(line_subtotal=subtotal, line_tax=tax, line_total=total)
+            ).rowcount
+    return updated
+
+
+def recompute_purchases(conn, batch_size: int = RECONCILE_BATCH_SIZE, totals: bool = False) -> int:
+    # total_amount is what the customer was charged, so it is only rewritten on request
+    updated = 0
+    for head, items in _sources(conn):
+        def line_sum(line_column):
+            return (select(func.coalesce(func.sum(line_column), 0))
+                    .where(items.c.purchase_id == head.c.id)
+                    .scalar_subquery())
+
+        values = {"tax_amount": line_sum(items.c.line_tax)}
+        if totals:
+            values["total_amount"] = line_sum(items.c.line_total)
+        for start, end in _id_ranges(conn, head.c.id, batch_size):
+            updated += conn.execute(
+                update(head).where(head.c.id.between(start, end)).values(**values)
+            ).rowcount
+    return updated
+
+
+def verify(conn, batch_size: int = RECONCILE_BATCH_SIZE, sample: int = 10) -> dict:
+    """Counts stored amounts that disagree with the formulas, hot or archived; keeps a few ids of each for the report."""
+    report = {"line_mismatches": 0, "purchase_mismatches": 0, "line_sample": [], "purchase_sample": []}
+
+    for head, items in _sources(conn):
+        subtotal, tax, total = _expected_line_amounts(items)
+        for start, end in _id_ranges(conn, items.c.id, batch_size):
+            rows = conn.execute(
+                select(items.c.id)
+                .where(items.c.id.between(start, end))
+                .where(or_(items.c.line_subtotal != subtotal,
+                           items.c.line_tax != tax,
+                           items.c.line_total != total))
+            ).scalars().all()
+            report["line_mismatches"] += len(rows)
+            report["line_sample"].extend(rows[:sample - len(report["line_sample"])])
+
+        sums = (
+            select(items.c.purchase_id,
+                   func.sum(items.c.line_total).label("line_total"),
+                   func.sum(items.c.line_tax).label("line_tax"))
+            .group_by(items.c.purchase_id)
+            .subquery()
+        )
+        for start, end in _id_ranges(conn, head.c.id, batch_size):
+            rows = conn.execute(
+                select(head.c.id)
+                .select_from(head.outerjoin(sums, sums.c.purchase_id == head.c.id))
+                .where(head.c.id.between(start, end))
+                .where(or_(head.c.total_amount != func.coalesce(sums.c.line_total, 0),
+                           head.c.tax_amount != func.coalesce(sums.c.line_tax, 0)))
+            ).scalars().all()
+            report["purchase_mismatches"] += len(rows)
+            report["purchase_sample"].extend(rows[:sample - len(report["purchase_sample"])])
+    return report
+
+
+def main(argv=None):
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Recompute or verify stored purchase amounts.")
+    parser.add_argument("command", choices=["verify", "recompute"])
+    parser.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE, help="Rows per id range")
+    parser.add_argument("--totals", action="store_true", help="recompute: also rewrite purchases.total_amount")
+    args = parser.parse_args(argv)
+
+    if args.command == "recompute":
+        # The rollups sum the rewritten amounts, so they are rebuilt in the same transaction,
+        # with checkouts held off as in `rollups.py rebuild`
+        with engine.connect() as conn, conn.begin():
+            rollups._begin(conn, exclusive=True)
+            lines = recompute_lines(conn, args.batch_size)
+            purchase_count = recompute_purchases(conn, args.batch_size, totals=args.totals)
+            totals = rollups.rebuild(conn)
+        print(f"Recomputed {lines} purchase lines and {purchase_count} purchases; "
+              f"rebuilt rollups for {len(totals.daily)} days")
+        return 0
+
+    with engine.connect() as conn:
+        report = verify(conn, args.batch_size)
+    print(f"Line mismatches: {report['line_mismatches']} (e.g. purchase line ids {report['line_sample']})")
+    print(f"Purchase mismatches: {report['purchase_mismatches']} (e.g. purchase ids {report['purchase_sample']})")
+    return 1 if report["line_mismatches"] or report["purchase_mismatches"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
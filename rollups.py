@@ -0,0 +1,287 @@
+# Sales rollups: revenue per day, tax per day and rate, units / revenue per day
+# and product (models.SalesDaily, SalesDailyTax and SalesDailyProduct), and each
+# customer's lifetime totals (models.CustomerTotals).
+#
+# They are kept incrementally: every path that records purchases
+# (crud.create_purchase, crud_async.create_purchase, crud.insert_purchases) adds
+# its purchases with one upsert per table in its own transaction, so the rollups
+# commit or roll back together with the purchases. Reports and the dashboard read
+# only these tables, never purchases / purchase_items.
+#
+# Archiving purchases (archive.py) leaves the rollups alone. The checker rebuilds
+# them from the raw rows, hot and archived, in memory and diffs them against the
+# stored ones:
+#   python rollups.py check     -> exits 1 and lists the differing rows on a mismatch
+#   python rollups.py rebuild   -> replaces the stored rollups with the rebuilt ones
+import argparse
+import functools
+import os
+import sys
+from collections import defaultdict
+from datetime import date, datetime, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import BigInteger, Date, DateTime, column, delete, insert, inspect, select, table
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+import money
+from database import ARCHIVE_SCHEMA
+
+REPORT_TIMEZONE = ZoneInfo(os.getenv("REPORT_TIMEZONE", "UTC")) # Where a sales day starts and ends
+ROLLUP_SCAN_BATCH_SIZE = 10000 # Rows per cursor fetch while rebuilding
+
+# Raw integer views (models' Money / TaxRate types would convert to Decimal)
+sales_daily = table(
+    "sales_daily",
+    column("day", Date),
+    column("purchases", BigInteger),
+    column("items_sold", BigInteger),
+    column("revenue", BigInteger),
+    column("tax", BigInteger),
+)
+sales_daily_tax = table(
+    "sales_daily_tax",
+    column("day", Date),
+    column("tax_percentage", BigInteger),
+    column("taxable_amount", BigInteger),
+    column("tax", BigInteger),
+)
+sales_daily_product = table(
+    "sales_daily_product",
+    column("day", Date),
+    column("product_id", BigInteger),
+    column("quantity", BigInteger),
+    column("revenue", BigInteger),
+)
+customer_totals = table(
+    "customer_totals",
+    column("customer_id", BigInteger),
+    column("purchases", BigInteger),
+    column("total_spent", BigInteger),
+    column("tax", BigInteger),
+)
+
+
+def _purchases_view(name: str, schema: str = None):
+    return table(
+        name,
+        column("id", BigInteger),
+        column("customer_id", BigInteger),
+        column("purchase_time", DateTime(timezone=True)),
+        column("total_amount", BigInteger),
+        column("tax_amount", BigInteger),
+        schema=schema,
+    )
+
+
+def _purchase_items_view(name: str, schema: str = None):
+    return table(
+        name,
+        column("purchase_id", BigInteger),
+        column("product_id", BigInteger),
+        column("quantity", BigInteger),
+        column("tax_percentage_at_purchase", BigInteger),
+        column("line_subtotal", BigInteger),
+        column("line_tax", BigInteger),
+        column("line_total", BigInteger),
+        schema=schema,
+    )
+
+
+purchases = _purchases_view("purchases")
+purchase_items = _purchase_items_view("purchase_items")
+purchases_archive = _purchases_view("purchases_archive", ARCHIVE_SCHEMA)
+purchase_items_archive = _purchase_items_view("purchase_items_archive", ARCHIVE_SCHEMA)
+
+# (table, key columns, summed columns); SalesTotals keeps one dict per entry, in this order
+ROLLUP_TABLES = (
+    (sales_daily, ("day",), ("purchases", "items_sold", "revenue", "tax")),
+    (sales_daily_tax, ("day", "tax_percentage"), ("taxable_amount", "tax")),
+    (sales_daily_product, ("day", "product_id"), ("quantity", "revenue")),
+    (customer_totals, ("customer_id",), ("purchases", "total_spent", "tax")),
+)
+
+
+def sales_day(purchase_time: datetime) -> date:
+    # Purchase times are UTC; SQLite hands them back without a zone
+    if purchase_time.tzinfo is None:
+        purchase_time = purchase_time.replace(tzinfo=timezone.utc)
+    return purchase_time.astimezone(REPORT_TIMEZONE).date()
+
+
+def today() -> date:
+    return datetime.now(REPORT_TIMEZONE).date()
+
+
+class SalesTotals:
+    """Rollup amounts to add (or rebuilt / stored ones), keyed like the tables, in paise and basis points."""
+
+    def __init__(self):
+        self.daily = defaultdict(lambda: [0, 0, 0, 0])   # day -> [purchases, items_sold, revenue, tax]
+        self.tax = defaultdict(lambda: [0, 0])           # (day, tax basis points) -> [taxable_amount, tax]
+        self.product = defaultdict(lambda: [0, 0])       # (day, product id) -> [quantity, revenue]
+        self.customer = defaultdict(lambda: [0, 0, 0])   # customer id -> [purchases, total_spent, tax]
+
+    def tables(self):
+        return self.daily, self.tax, self.product, self.customer
+
+    def add_purchase(self, day: date, customer_id: int, total_minor: int, tax_minor: int):
+        daily = self.daily[day]
+        daily[0] += 1
+        daily[2] += total_minor
+        daily[3] += tax_minor
+        if customer_id is not None:
+            customer = self.customer[customer_id]
+            customer[0] += 1
+            customer[1] += total_minor
+            customer[2] += tax_minor
+
+    def add_line(self, day: date, product_id: int, quantity: int, tax_basis_points: int,
+                 subtotal_minor: int, tax_minor: int, total_minor: int):
+        self.daily[day][1] += quantity
+        by_rate = self.tax[(day, tax_basis_points)]
+        by_rate[0] += subtotal_minor
+        by_rate[1] += tax_minor
+        by_product = self.product[(day, product_id)]
+        by_product[0] += quantity
+        by_product[1] += total_minor
+
+    def add_sale(self, purchase_time: datetime, customer_id: int, total_minor: int, tax_minor: int, item_rows: list):
+        """One purchase as crud writes it; item_rows as built by sales.purchase_item_rows."""
+        day = sales_day(purchase_time)
+        self.add_purchase(day, customer_id, total_minor, tax_minor)
+        for row in item_rows:
+            self.add_line(day, row["product_id"], row["quantity"],
+                          money.to_basis_points(row["tax_percentage_at_purchase"]),
+                          money.to_minor(row["line_subtotal"]), money.to_minor(row["line_tax"]),
+                          money.to_minor(row["line_total"]))
+
+    def rows(self):
+        """(rollup table, rows) per table, sorted by key so concurrent upserts lock rows in the same order."""
+        for (rollup, keys, fields), totals in zip(ROLLUP_TABLES, self.tables()):
+            rows = []
+            for key in sorted(totals):
+                key_values = key if isinstance(key, tuple) else (key,)
+                rows.append(dict(zip(keys, key_values), **dict(zip(fields, totals[key]))))
+            yield rollup, rows
+
+    def statements(self, dialect_name: str):
+        """(upsert, rows) adding these totals to the stored rollups, for each table with something to add."""
+        for rollup, rows in self.rows():
+            if rows:
+                yield _upsert(dialect_name, rollup.name), rows
+
+
+@functools.lru_cache(maxsize=None)
+def _upsert(dialect_name: str, table_name: str):
+    rollup, keys, fields = next(entry for entry in ROLLUP_TABLES if entry[0].name == table_name)
+    if dialect_name in ("sqlite", "postgresql"):
+        stmt = (sqlite.insert if dialect_name == "sqlite" else postgresql.insert)(rollup)
+        return stmt.on_conflict_do_update(index_elements=list(keys),
+                                          set_={field: rollup.c[field] + stmt.excluded[field] for field in fields})
+    if dialect_name in ("mysql", "mariadb"):
+        stmt = mysql.insert(rollup)
+        return stmt.on_duplicate_key_update({field: rollup.c[field] + stmt.inserted[field] for field in fields})
+    raise NotImplementedError(f"Sales rollups have no upsert for {dialect_name}")
+
+
+def record(db, totals: SalesTotals):
+    """Adds `totals` to the rollups in the session's current transaction (sync Session)."""
+    for stmt, rows in totals.statements(db.get_bind().dialect.name):
+        db.execute(stmt, rows)
+
+
+# --- Checker ---
+
+def compute(conn, batch_size: int = ROLLUP_SCAN_BATCH_SIZE) -> SalesTotals:
+    """The rollups as they should be, from every purchase and purchase item, hot or archived."""
+    totals = SalesTotals()
+    sources = [(purchases, purchase_items)]
+    if inspect(conn).has_table(purchases_archive.name, schema=ARCHIVE_SCHEMA): # Not yet during migrations 2 and 3
+        sources.append((purchases_archive, purchase_items_archive))
+    for head, lines in sources:
+        stmt = select(head.c.purchase_time, head.c.customer_id, head.c.total_amount, head.c.tax_amount)
+        for purchase_time, customer_id, total_minor, tax_minor in conn.execute(stmt.execution_options(yield_per=batch_size)):
+            totals.add_purchase(sales_day(purchase_time), customer_id, total_minor, tax_minor)
+        stmt = (select(head.c.purchase_time, lines.c.product_id, lines.c.quantity,
+                       lines.c.tax_percentage_at_purchase, lines.c.line_subtotal,
+                       lines.c.line_tax, lines.c.line_total)
+                .join_from(lines, head, lines.c.purchase_id == head.c.id))
+        for purchase_time, *line in conn.execute(stmt.execution_options(yield_per=batch_size)):
+            totals.add_line(sales_day(purchase_time), *line)
+    return totals
+
+
+def stored(conn) -> SalesTotals:
+    totals = SalesTotals()
+    for (rollup, keys, fields), into in zip(ROLLUP_TABLES, totals.tables()):
+        for row in conn.execute(select(*(rollup.c[name] for name in keys + fields))):
+            key = tuple(row[:len(keys)])
+            into[key if len(keys) > 1 else key[0]] = list(row[len(keys):])
+    return totals
+
+
+def diff(expected: SalesTotals, actual: SalesTotals):
+    """One line per rollup row that differs; empty when they match."""
+    lines = []
+    for (rollup, keys, fields), want, have in zip(ROLLUP_TABLES, expected.tables(), actual.tables()):
+        for key in sorted(set(want) | set(have)):
+            expected_values = want.get(key, [0] * len(fields))
+            stored_values = have.get(key, [0] * len(fields))
+            if expected_values != stored_values:
+                lines.append(f"{rollup.name} {key}: stored {dict(zip(fields, stored_values))}, "
+                             f"expected {dict(zip(fields, expected_values))}")
+    return lines
+
+
+def rebuild(conn, batch_size: int = ROLLUP_SCAN_BATCH_SIZE, table_names=None) -> SalesTotals:
+    """Replaces the stored rollups (or just those in `table_names`) with ones computed from the raw rows."""
+    totals = compute(conn, batch_size)
+    for rollup, rows in totals.rows():
+        if table_names is not None and rollup.name not in table_names:
+            continue
+        conn.execute(delete(rollup))
+        if rows:
+            conn.execute(insert(rollup), rows)
+    return totals
+
+
+def _begin(conn, exclusive: bool):
+    # Everything the check or rebuild reads has to come from one snapshot, and a rebuild
+    # must not miss a purchase committed while it runs, so checkouts wait for it.
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("BEGIN IMMEDIATE" if exclusive else "BEGIN")
+    elif conn.dialect.name == "postgresql":
+        if exclusive:
+            conn.exec_driver_sql(f"LOCK TABLE {', '.join(rollup.name for rollup, _, _ in ROLLUP_TABLES)} "
+                                 f"IN EXCLUSIVE MODE")
+        else:
+            conn.exec_driver_sql("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    # MySQL / MariaDB: InnoDB's default REPEATABLE READ gives the snapshot; rebuild while the tills are idle
+
+
+def main(argv=None):
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Check or rebuild the sales rollups from the raw purchases.")
+    parser.add_argument("command", choices=["check", "rebuild"])
+    parser.add_argument("--batch-size", type=int, default=ROLLUP_SCAN_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    with engine.connect() as conn, conn.begin():
+        _begin(conn, exclusive=args.command == "rebuild")
+        if args.command == "rebuild":
+            totals = rebuild(conn, args.batch_size)
+            print(f"Rebuilt rollups for {len(totals.daily)} days")
+            return 0
+        mismatches = diff(compute(conn, args.batch_size), stored(conn))
+    for line in mismatches[:100]:
+        print(line)
+    if len(mismatches) > 100:
+        print(f"... and {len(mismatches) - 100} more")
+    print(f"{len(mismatches)} rollup rows differ" if mismatches else "Rollups match the purchases")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
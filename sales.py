@@ -0,0 +1,160 @@
+# The parts of recording a sale that don't depend on the session: checking and
+# pricing the basket lines, the stock and drawer UPDATE statements, and working
+# out change against the drawer. Shared by crud (one sale), crud_async (the same
+# on an AsyncSession) and billing (a chunk of baskets in one transaction).
+import logging
+import os
+from decimal import Decimal
+from typing import Dict, List
+
+from sqlalchemy import bindparam, update
+
+import change, models, money, schemas
+
+# How create_purchase reserves stock:
+#   "conditional" - UPDATE ... SET available_stocks = available_stocks - :q WHERE id = :id AND available_stocks >= :q
+#   "row_lock"    - SELECT ... FOR UPDATE, then decrement (falls back to "conditional" on SQLite)
+STOCK_RESERVATION_MODE = os.getenv("STOCK_RESERVATION_MODE", "conditional")
+ROW_LOCK_DIALECTS = {"postgresql", "mysql", "mariadb"}
+DRAWER_LOW_COUNT = int(os.getenv("DRAWER_LOW_COUNT", "5")) # Warn when a drawer denomination drops below this
+
+logger = logging.getLogger("sales")
+
+
+class InsufficientStockError(Exception):
+    """Raised by create_purchase when one or more basket lines can't be reserved.
+
+    `failures` holds one dict per failed line: line (index into `items`), product_id,
+    requested and available (0 for a product that doesn't exist). Nothing has been
+    written when this is raised.
+    """
+    def __init__(self, failures: List[dict]):
+        self.failures = failures
+        super().__init__(", ".join(
+            f"product {f['product_id']}: requested {f['requested']}, available {f['available']}" for f in failures
+        ))
+
+
+def requested_quantities(items: List[schemas.PurchaseItemCreate]) -> Dict[int, int]:
+    # Total quantity per product, in id order so concurrent tills always lock rows in the same order
+    requested = {}
+    for item_data in items:
+        requested[item_data.product_id] = requested.get(item_data.product_id, 0) + item_data.quantity
+    return dict(sorted(requested.items()))
+
+
+def stock_failures(items: List[schemas.PurchaseItemCreate], requested: Dict[int, int], available: Dict[int, int]):
+    failures = []
+    for line, item_data in enumerate(items):
+        if available.get(item_data.product_id, 0) < requested[item_data.product_id]:
+            failures.append({"line": line, "product_id": item_data.product_id,
+                             "requested": item_data.quantity, "available": available.get(item_data.product_id, 0)})
+    if not failures:
+        # Stock was replenished after our UPDATE missed; report every line and let the till resubmit
+        failures = [{"line": line, "product_id": item_data.product_id, "requested": item_data.quantity,
+                     "available": available.get(item_data.product_id, 0)} for line, item_data in enumerate(items)]
+    return failures
+
+
+def check_items(items: List[schemas.PurchaseItemCreate], products: Dict[int, models.Product]):
+    # Every line must be billed: an empty basket or a line whose product is gone fails the whole purchase
+    if not items:
+        raise ValueError("A purchase needs at least one item")
+    unknown = [{"line": line, "product_id": item_data.product_id, "requested": item_data.quantity, "available": 0}
+               for line, item_data in enumerate(items) if item_data.product_id not in products]
+    if unknown:
+        raise InsufficientStockError(unknown)
+
+
+def purchase_item_rows(items: List[schemas.PurchaseItemCreate], products: Dict[int, models.Product]):
+    """Item rows (purchase_id still to fill in) and the purchase's (total, tax) in paise."""
+    rows = []
+    total_minor = tax_minor = 0
+    for item_data in items:
+        product = products[item_data.product_id]
+        subtotal, tax, total = money.line_amounts(product.price, item_data.quantity, product.tax_percentage)
+        rows.append({
+            "product_id": item_data.product_id,
+            "quantity": item_data.quantity,
+            "price_at_purchase": product.price,
+            "tax_percentage_at_purchase": product.tax_percentage,
+            "product_name_at_purchase": product.name,
+            "product_code_at_purchase": product.product_id,
+            "line_subtotal": money.from_minor(subtotal),
+            "line_tax": money.from_minor(tax),
+            "line_total": money.from_minor(total)
+        })
+        total_minor += total
+        tax_minor += tax
+    return rows, total_minor, tax_minor
+
+
+def reserve_stock_statement():
+    # Executed with [{"b_id": ..., "b_qty": ...}, ...]
+    products_table = models.Product.__table__
+    return (
+        update(products_table)
+        .where(products_table.c.id == bindparam("b_id"))
+        .where(products_table.c.available_stocks >= bindparam("b_qty"))
+        .values(available_stocks=products_table.c.available_stocks - bindparam("b_qty"))
+    )
+
+
+def use_row_lock(dialect) -> bool:
+    return STOCK_RESERVATION_MODE == "row_lock" and dialect.name in ROW_LOCK_DIALECTS
+
+
+def low_denominations(counts: Dict[int, int]) -> List[int]:
+    return sorted((d for d, count in counts.items() if count < DRAWER_LOW_COUNT), reverse=True)
+
+
+def settle_drawer(counts: Dict[int, int], total_amount: Decimal, paid_amount: Decimal, tracked: bool = True):
+    """Works out change for a sale against `counts`; returns (ChangeResult, updated counts).
+
+    The form only records the amount paid, so the cash taken is booked as its
+    largest-notes breakdown (whole rupees; the drawer holds no paise coins); it
+    goes into the drawer before change is counted out.
+    """
+    balance_paise = money.to_minor(paid_amount) - money.to_minor(total_amount)
+    if not tracked:
+        return change.engine.make_change(balance_paise), counts
+    after = dict(counts)
+    for denomination, count in change.unlimited_breakdown(money.to_minor(paid_amount) // money.MINOR_UNITS).items():
+        if denomination in after:
+            after[denomination] += count
+    result = change.engine.make_change(balance_paise, after)
+    for denomination, count in result.notes.items():
+        after[denomination] -= count
+    newly_low = [d for d in low_denominations(after) if counts.get(d, 0) >= DRAWER_LOW_COUNT]
+    if newly_low:
+        logger.warning("Cash drawer running low on %s", ", ".join(f"₹{d} ({after[d]} left)" for d in newly_low))
+    if result.remainder_paise >= 100:
+        logger.warning("Cash drawer could not cover %.2f of the change", result.remainder)
+    return result, after
+
+
+def drawer_update_rows(before: Dict[int, int], after: Dict[int, int]):
+    return [{"b_denomination": d, "b_count": count} for d, count in after.items() if count != before.get(d)]
+
+
+def drawer_update_statement():
+    # Executed with [{"b_denomination": ..., "b_count": ...}, ...]
+    drawer_table = models.DrawerDenomination.__table__
+    return (
+        update(drawer_table)
+        .where(drawer_table.c.denomination == bindparam("b_denomination"))
+        .values(count=bindparam("b_count"))
+    )
+
+
+def change_notes(result: change.ChangeResult) -> List[models.PurchaseChange]:
+    notes = [models.PurchaseChange(denomination=d, count=count) for d, count in result.notes.items()]
+    if result.remainder_paise:
+        notes.append(models.PurchaseChange(denomination=0, count=result.remainder_paise))
+    return notes
+
+
+def change_rows(purchase_id: int, result: change.ChangeResult) -> List[dict]:
+    # purchase_change rows for one executemany (the ORM would insert them one at a time)
+    return [{"purchase_id": purchase_id, "denomination": note.denomination, "count": note.count}
+            for note in change_notes(result)]
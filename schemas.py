@@ -1,13 +1,15 @@
 from pydantic import BaseModel
-from typing import List, Optional
-from datetime import datetime
+from typing import Dict, List, Optional
+from datetime import date, datetime
+from decimal import Decimal
 
 class ProductBase(BaseModel):
     name: str
     product_id: str
     available_stocks: int
-    price: float
-    tax_percentage: float
+    price: Decimal
+    tax_percentage: Decimal
+    reorder_level: int = 0 # Stock at or below this is reported as low; 0 = never
 
 class ProductCreate(ProductBase):
     pass
@@ -40,28 +42,130 @@ class PurchaseItemCreate(PurchaseItemBase):
 
 class PurchaseItem(PurchaseItemBase):
     id: int
-    price_at_purchase: float
-    tax_percentage_at_purchase: float
+    price_at_purchase: Decimal
+    tax_percentage_at_purchase: Decimal
+    line_subtotal: Decimal
+    line_tax: Decimal
+    line_total: Decimal
 
     class Config:
         orm_mode = True
 
 class PurchaseBase(BaseModel):
     customer_id: int
-    total_amount: float
-    paid_amount: float
+    total_amount: Decimal
+    paid_amount: Decimal
 
 class PurchaseCreate(PurchaseBase):
     items: List[PurchaseItemCreate]
 
 class Purchase(PurchaseBase):
     id: int
+    tax_amount: Decimal
     purchase_time: datetime
     items: List[PurchaseItem] = []
 
     class Config:
         orm_mode = True
 
+# --- JSON billing API (api.py) ---
+
+class BasketLine(BaseModel):
+    product_id: str # Product.product_id, as typed at the till
+    quantity: int
+
+class BasketCreate(BaseModel):
+    customer_email: str
+    items: List[BasketLine]
+    paid_amount: Decimal
+    idempotency_key: Optional[str] = None
+
+class OfflineBasket(BasketCreate):
+    purchase_time: Optional[datetime] = None # When the offline till made the sale; default now
+
+class BasketBatch(BaseModel):
+    baskets: List[OfflineBasket]
+    use_drawer: bool = False # Offline tills gave change from their own drawers
+    send_invoices: bool = False
+
+class ReceiptLine(BaseModel):
+    product_id: str
+    product_name: str
+    quantity: int
+    unit_price: Decimal
+    tax_percentage: Decimal
+    subtotal: Decimal
+    tax: Decimal
+    total: Decimal
+
+class Receipt(BaseModel):
+    purchase_id: int
+    purchase_time: str
+    customer_email: str
+    lines: List[ReceiptLine]
+    total_amount: Decimal
+    tax_amount: Decimal
+    paid_amount: Decimal
+    balance_to_return: Decimal
+    change: Dict[int, int] # Denomination -> notes handed out
+    change_remainder: Decimal # Part of the balance the drawer couldn't cover
+
+class BasketResult(BaseModel):
+    index: int # Position in BasketBatch.baskets
+    status: str # "created", "replayed" (idempotency key already used) or "rejected"
+    purchase_id: Optional[int] = None
+    total_amount: Optional[Decimal] = None
+    balance_to_return: Optional[Decimal] = None
+    errors: Dict[str, str] = {}
+
+class BatchResult(BaseModel):
+    created: int
+    replayed: int
+    rejected: int
+    results: List[BasketResult]
+
+class PurchaseSummary(BaseModel):
+    id: int
+    purchase_time: datetime
+    total_amount: Decimal
+    tax_amount: Decimal
+    paid_amount: Decimal
+
+class CustomerTotals(BaseModel):
+    purchases: int = 0
+    total_spent: Decimal = Decimal("0.00")
+    tax: Decimal = Decimal("0.00")
+
+class CustomerPurchasePage(BaseModel):
+    customer_email: str
+    totals: CustomerTotals # Lifetime, not just this page
+    purchases: List[PurchaseSummary] # Newest first
+    next_after: Optional[int] = None # ?after= for the next (older) page; None on the last page
+    prev_before: Optional[int] = None # ?before= for the previous (newer) page; None on the first page
+
+# --- Sales reports (api.py, read from the rollups) ---
+
+class DailySales(BaseModel):
+    day: date
+    purchases: int
+    items_sold: int
+    revenue: Decimal # Tax included
+    tax: Decimal
+
+    class Config:
+        orm_mode = True
+
+class TaxByRate(BaseModel):
+    tax_percentage: Decimal
+    taxable_amount: Decimal
+    tax: Decimal
+
+class TopProduct(BaseModel):
+    product_id: Optional[str] = None # None once the product has been deleted
+    name: Optional[str] = None
+    quantity: int
+    revenue: Decimal # Tax included
+
 # Update forward refs for models that reference each other
 Customer.update_forward_refs()
 Purchase.update_forward_refs()
\ No newline at end of file
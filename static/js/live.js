@@ -0,0 +1,64 @@
+// Live updates for pages with [data-live] regions (see live.py): one WebSocket,
+// reconnecting with backoff; the server sends the current state, coalesced.
+(function () {
+    const regions = document.querySelectorAll('[data-live]');
+    if (!regions.length || !('WebSocket' in window)) {
+        return;
+    }
+    const topics = new Set();
+    regions.forEach(region => topics.add(region.dataset.live === 'products' ? 'products' : 'sales'));
+    const url = (location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host +
+        '/ws/live?topics=' + Array.from(topics).join(',');
+    let delay = 1000;
+
+    function showSales(message) {
+        // Server-rendered fragments, keyed by the region they replace
+        Object.entries(message.html).forEach(([name, html]) => {
+            const region = document.querySelector('[data-live="' + name + '"]');
+            if (region) {
+                region.innerHTML = html;
+            }
+        });
+    }
+
+    function showProducts(message) {
+        if (message.reload) {
+            // Too many changes to patch (a bulk import): reload, spread out over a few seconds
+            setTimeout(() => location.reload(), Math.random() * 5000);
+            return;
+        }
+        message.products.forEach(product => {
+            const row = document.querySelector('tr[data-product-id="' + product.id + '"]');
+            if (!row) {
+                return; // Not on this page
+            }
+            row.querySelectorAll('[data-field]').forEach(cell => {
+                cell.textContent = product[cell.dataset.field];
+            });
+        });
+        message.deleted.forEach(id => {
+            const row = document.querySelector('tr[data-product-id="' + id + '"]');
+            if (row) {
+                row.classList.add('removed');
+            }
+        });
+    }
+
+    function connect() {
+        const socket = new WebSocket(url);
+        socket.onopen = () => { delay = 1000; };
+        socket.onmessage = event => {
+            const message = JSON.parse(event.data);
+            if (message.topic === 'sales') {
+                showSales(message);
+            } else if (message.topic === 'products') {
+                showProducts(message);
+            }
+        };
+        socket.onclose = () => {
+            setTimeout(connect, delay + Math.random() * 1000);
+            delay = Math.min(delay * 2, 30000);
+        };
+    }
+    connect();
+})();